@@ -1,13 +1,35 @@
 import asyncio
+import contextlib
+import copy
+import functools
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import signal
+import socket
 import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import httpx
 import yt_dlp
 import dotenv
-from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Message
+from yt_dlp.postprocessor import FFmpegPostProcessor
+from yt_dlp.utils import prepend_extension, replace_extension
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from telegram import Update, Bot, Chat, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Message
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ConversationHandler
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 # ==============================================================================
 # ١. الإعدادات (بديل لـ config.py)
@@ -28,25 +50,285 @@ DATABASE_NAME = os.path.join(DATABASE_PATH, "bot_data.db") if DATABASE_PATH else
 if not BOT_TOKEN:
     raise ValueError("لم يتم العثور على متغير البيئة BOT_TOKEN. يرجى إضافته.")
 
-# الحد الأقصى للرفع عبر واجهة برمجة التطبيقات القياسية لتليجرام (50 ميجابايت)
-BOT_API_UPLOAD_LIMIT = 50 * 1024 * 1024
+# خادم Bot API محلي (telegram-bot-api) بدلاً من api.telegram.org، مثال: http://localhost:8081/bot
+# في الوضع المحلي (--local) يُمرر الملف بمساره file:// فيقرأه الخادم مباشرة من القرص دون نسخه عبر البوت،
+# لذا يجب أن يشترك الخادم والبوت في نفس نظام الملفات
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "")
+BOT_API_BASE_FILE_URL = os.getenv("BOT_API_BASE_FILE_URL", "")
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "").lower() in ("1", "true", "yes")
+
+if BOT_API_LOCAL_MODE and not BOT_API_BASE_URL:
+    raise ValueError("BOT_API_LOCAL_MODE يتطلب خادماً محلياً. يرجى إضافة BOT_API_BASE_URL.")
+
+# الحد الأقصى للرفع: 50 ميجابايت مع الخادم الرسمي، ويصل إلى 2000 ميجابايت مع خادم محلي
+_MAX_LOCAL_UPLOAD_MB = 2000
+BOT_API_UPLOAD_LIMIT = min(
+    int(os.getenv("BOT_API_UPLOAD_LIMIT_MB", str(_MAX_LOCAL_UPLOAD_MB if BOT_API_LOCAL_MODE else 50))),
+    _MAX_LOCAL_UPLOAD_MB,
+) * 1024 * 1024
+
+# حجم القطعة المقروءة من الملف أثناء الرفع، وأقل سرعة رفع متوقعة (بايت/ثانية)
+# تُستخدم لحساب مهلة الرفع حسب حجم الملف بدلاً من مهلة ثابتة
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_MIN_THROUGHPUT = int(os.getenv("UPLOAD_MIN_THROUGHPUT", str(128 * 1024)))
+
+# مجلد التنزيلات. كل عملية تحميل تعمل داخل مجلد فرعي خاص بها يُحذف عند انتهائها
+DOWNLOAD_DIR = "downloads"
+
+# ميزانية القرص لمجلد التنزيلات (ميجابايت) مشتركة بين كل العمال: يُحجز الحجم المتوقع في قاعدة البيانات
+# قبل كل عملية وتنتظر العمليات التي تتجاوزها
+# مع فحص دوري (بالثواني) لحذف الملفات اليتيمة الأقدم من ORPHAN_MAX_AGE (بالثواني)
+DISK_BUDGET_MB = int(os.getenv("DISK_BUDGET_MB", "4096"))
+STORAGE_SWEEP_INTERVAL = int(os.getenv("STORAGE_SWEEP_INTERVAL", "600"))
+ORPHAN_MAX_AGE = int(os.getenv("ORPHAN_MAX_AGE", "3600"))
+# الحجم المحجوز (ميجابايت) لعملية لا يُعرف حجمها مسبقاً (بث، صيغة بلا حجم)، بحد أقصى حد الرفع.
+# حجز حد الرفع كاملاً (2000 ميجابايت مع خادم محلي) يجعل هذه العمليات تعمل واحدة تلو الأخرى
+DEFAULT_SIZE_ESTIMATE = min(int(os.getenv("DEFAULT_SIZE_ESTIMATE_MB", "256")) * 1024 * 1024, BOT_API_UPLOAD_LIMIT)
+
+# وضع "ضغط ليناسب الحد": عدد عمال الضغط، عدد خيوط ffmpeg لكل عملية، أولوية العملية (nice)
+# ومعدل بت الصوت (kbps) في الملف المضغوط. العمال منفصلون عن التحميل حتى لا يؤخروه
+COMPRESS_WORKERS = int(os.getenv("COMPRESS_WORKERS", "1"))
+COMPRESS_THREADS = int(os.getenv("COMPRESS_THREADS", "2"))
+COMPRESS_NICE = int(os.getenv("COMPRESS_NICE", "19"))
+COMPRESS_AUDIO_BITRATE = 96
+
+# عدد العمال المخصصين لجلب معلومات الروابط (extract_info) بعيداً عن حلقة الأحداث
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+# نوع المنفذ المستخدم لجلب المعلومات: thread (خيوط) أو process (عمليات منفصلة)
+EXTRACT_EXECUTOR = os.getenv("EXTRACT_EXECUTOR", "thread").lower()
+if EXTRACT_EXECUTOR not in ('thread', 'process'):
+    raise ValueError("قيمة EXTRACT_EXECUTOR يجب أن تكون thread أو process.")
+
+# تحديثات رسالة تقدم التحميل: أقل فاصل بين تحديثين لنفس العملية، وأقصى عدد تحديثات
+# لكل عملية، وأقل فاصل بين تعديلين لرسائل نفس المحادثة
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "4"))
+PROGRESS_UPDATE_BUDGET = int(os.getenv("PROGRESS_UPDATE_BUDGET", "20"))
+CHAT_EDIT_INTERVAL = float(os.getenv("CHAT_EDIT_INTERVAL", "3"))
+
+# مدة صلاحية معلومات الروابط المخزنة مؤقتاً (بالثواني) والحد الأقصى لحجمها في الذاكرة (ميجابايت)
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "600"))
+METADATA_CACHE_MAX_MB = int(os.getenv("METADATA_CACHE_MAX_MB", "64"))
+
+# مدة صلاحية قوائم الصيغ المعروضة (بالثواني) والحد الأقصى للقوائم المعلقة في كل محادثة
+MENU_TTL = int(os.getenv("MENU_TTL", "1800"))
+MENU_MAX_PER_CHAT = int(os.getenv("MENU_MAX_PER_CHAT", "5"))
+# فترة الفحص الدوري (بالثواني) لحذف القوائم المنتهية من محادثات لم تعد تتفاعل مع البوت
+MENU_SWEEP_INTERVAL = int(os.getenv("MENU_SWEEP_INTERVAL", "300"))
+
+# عدد عمليات التحميل المتزامنة في كل عامل، والحد الأقصى للمهام الجارية لكل مستخدم (في كل العمال).
+# المنفذ يُحرر بعد انتهاء التحميل، فالضغط (له مجمعه الخاص) والرفع لا يؤخران تحميلات المهام التالية
+DOWNLOAD_SLOTS = int(os.getenv("DOWNLOAD_SLOTS", "3"))
+DOWNLOAD_SLOTS_PER_USER = int(os.getenv("DOWNLOAD_SLOTS_PER_USER", "1"))
+
+# طابور مهام التحميل الدائم (في قاعدة البيانات): تنفذه عمليات عمال منفصلة ("python app.py worker")
+# JOB_WORKERS: عدد العمال الذين يشغلهم البوت محلياً (0 = الاعتماد على عمال خارجيين يتشاركون نفس القرص)
+# JOB_LEASE_SECONDS: مدة عقد المهمة الذي يجدده العامل دورياً، وعند انتهائه تُعاد المهمة لعامل آخر
+# JOB_MAX_ATTEMPTS: عدد المحاولات قبل اعتبار المهمة فاشلة
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# الفاصل (بالثواني) بين محاولات العامل لاستلام مهمة عندما يكون الطابور فارغاً،
+# والفاصل بين نشر إحصائيات العامل، ومدة الاحتفاظ بالمهام المنتهية
+JOB_POLL_INTERVAL = 1.0
+WORKER_STATS_INTERVAL = 10
+JOB_RETENTION = 86400
+# فترة تحديث ترتيب المهام المنتظرة في رسائلها (بالثواني)، وأقصى عدد تعديلات في كل تحديث (الأقرب للدور أولاً)
+QUEUE_POSITION_INTERVAL = int(os.getenv("QUEUE_POSITION_INTERVAL", "5"))
+QUEUE_POSITION_MAX_EDITS = int(os.getenv("QUEUE_POSITION_MAX_EDITS", "30"))
+
+# وضع قوائم التشغيل: أقصى عدد عناصر يتم جلبها من القائمة، عدد عناصر القائمة الواحدة التي تُنفذ في نفس الوقت
+# (عنصر يُرفع بينما التالي يُحمّل)، عدد القوائم الجارية لكل مستخدم، وأقصى دقة لفيديوهات القائمة
+PLAYLIST_MAX_ENTRIES = int(os.getenv("PLAYLIST_MAX_ENTRIES", "50"))
+PLAYLIST_CONCURRENCY = int(os.getenv("PLAYLIST_CONCURRENCY", "2"))
+PLAYLIST_MAX_ACTIVE_PER_USER = int(os.getenv("PLAYLIST_MAX_ACTIVE_PER_USER", "1"))
+PLAYLIST_MAX_HEIGHT = int(os.getenv("PLAYLIST_MAX_HEIGHT", "720"))
+# الفاصل (بالثواني) بين فحوص إلغاء القائمة وانتظار دور الرفع أثناء تنفيذ عناصرها
+PLAYLIST_POLL_INTERVAL = 2
+
+# مدة تخزين نتيجة التحقق من الاشتراك في القناة (بالثواني): للمشتركين ولغير المشتركين
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", "600"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "30"))
+
+# إعدادات الإذاعة: أقصى عدد رسائل في الثانية (حد تليجرام العام حوالي 30)،
+# عدد الإرسالات المتزامنة، وحجم صفحة المستخدمين المقروءة من قاعدة البيانات
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+# أقل فاصل زمني (بالثواني) بين تحديثين لرسالة حالة الإذاعة
+BROADCAST_STATUS_INTERVAL = 5
+
+# الفاصل الزمني (بالثواني) لتجميع عمليات الكتابة المؤجلة في قاعدة البيانات، وأقصى حجم للدفعة
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "2"))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "500"))
+
+# وضع webhook: عند ضبط WEBHOOK_URL (العنوان العام خلف الوكيل العكسي) يستقبل البوت التحديثات
+# عبر خادم HTTP مدمج بدلاً من run_polling. WEBHOOK_SECRET يُرسل من تليجرام في كل طلب للتحقق منه
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or uuid.uuid4().hex
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# منفذ خادم مقاييس Prometheus المحلي (/metrics) في عملية البوت الرئيسية، يعرض مقاييسها مع مقاييس العمال
+# (0 = تعطيل)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# الحد الأقصى للتحديثات المنتظرة في الطابور الداخلي. عند امتلائه يرد الخادم بـ 503
+# فيعيد تليجرام المحاولة لاحقاً بدلاً من تراكمها في الذاكرة
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# معالجات block=False تسحب التحديثات من الطابور فوراً إلى مهام غير محدودة، لذلك يرد الخادم بـ 503 أيضاً
+# عند تجاوز المعالجات الجارية أو طلبات جلب المعلومات المنتظرة هذين الحدين
+MAX_IN_FLIGHT_UPDATES = int(os.getenv("MAX_IN_FLIGHT_UPDATES", "200"))
+MAX_EXTRACT_QUEUE = int(os.getenv("MAX_EXTRACT_QUEUE", "100"))
 
 # ==============================================================================
 # ٢. دوال قاعدة البيانات (بديل لـ database.py)
 # ==============================================================================
 
+# اتصال واحد دائم بقاعدة البيانات يتشاركه البوت كله، محمي بقفل لأن عمليات
+# التحميل تعمل في خيوط أخرى
+_db_conn: sqlite3.Connection | None = None
+_db_lock = threading.RLock()
+
+# إحصائيات زمن الكتابة في قاعدة البيانات (لكل معاملة)
+DB_WRITE_STATS = {'transactions': 0, 'rows': 0, 'total_time': 0.0, 'max_time': 0.0, 'last_time': 0.0}
+
+# نسخة في الذاكرة من جدول الإعدادات، تُحمّل عند التشغيل وتُحدّث مع كل كتابة
+_settings_cache: dict[str, str] = {}
+
+# عمليات الكتابة المؤجلة (تسجيل المستخدمين ووقت آخر ظهور) التي تُجمع وتُكتب دفعة واحدة
+_pending_users: dict[int, float] = {}
+_pending_lock = threading.Lock()
+_flush_wakeup = threading.Event()
+_flush_thread: threading.Thread | None = None
+
+def get_db() -> sqlite3.Connection:
+    """
+    يعيد الاتصال الدائم بقاعدة البيانات وينشئه عند أول استخدام بوضع WAL.
+    """
+    global _db_conn
+    with _db_lock:
+        if _db_conn is None:
+            conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # مع WAL يكفي synchronous=NORMAL ويقلل عدد عمليات fsync
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _db_conn = conn
+        return _db_conn
+
+@contextlib.contextmanager
+def db_read():
+    """يعطي مؤشراً للقراءة من الاتصال الدائم."""
+    with _db_lock:
+        yield get_db().cursor()
+
+@contextlib.contextmanager
+def db_write(rows: int = 1):
+    """
+    يعطي مؤشراً داخل معاملة واحدة، ثم يثبتها ويسجل زمن الكتابة في DB_WRITE_STATS.
+    """
+    with _db_lock:
+        conn = get_db()
+        start = time.perf_counter()
+        with conn:
+            yield conn.cursor()
+        elapsed = time.perf_counter() - start
+        DB_WRITE_STATS['transactions'] += 1
+        DB_WRITE_STATS['rows'] += rows
+        DB_WRITE_STATS['total_time'] += elapsed
+        DB_WRITE_STATS['last_time'] = elapsed
+        DB_WRITE_STATS['max_time'] = max(DB_WRITE_STATS['max_time'], elapsed)
+
+def flush_pending_writes():
+    """
+    يكتب كل عمليات الكتابة المؤجلة في معاملة واحدة.
+    """
+    with _pending_lock:
+        users = dict(_pending_users)
+        _pending_users.clear()
+    if not users:
+        return
+    try:
+        with db_write(len(users)) as cursor:
+            # المستخدم الذي تفاعل مع البوت من جديد لم يعد حاظراً له
+            cursor.executemany(
+                "INSERT INTO users (user_id, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen, is_blocked = 0",
+                list(users.items())
+            )
+    except sqlite3.Error:
+        # نعيد المستخدمين إلى الدفعة حتى لا يضيعوا ونحاول في المرة القادمة
+        with _pending_lock:
+            for user_id, last_seen in users.items():
+                _pending_users.setdefault(user_id, last_seen)
+        raise
+
+def _flush_loop():
+    """حلقة خيط الخلفية التي تكتب الدفعات المؤجلة بشكل دوري."""
+    while True:
+        _flush_wakeup.wait(DB_FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        try:
+            flush_pending_writes()
+        except sqlite3.Error as e:
+            logging.error(f"فشل كتابة الدفعة المؤجلة في قاعدة البيانات: {e}")
+
+def close_db():
+    """
+    يكتب الدفعات المتبقية ويغلق الاتصال الدائم (عند إيقاف البوت).
+    """
+    global _db_conn
+    flush_pending_writes()
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+# أعمدة حالة التوصيل التي أضيفت لاحقاً إلى جدول المستخدمين
+_USERS_EXTRA_COLUMNS = {
+    'last_seen': 'REAL',
+    'is_blocked': 'INTEGER NOT NULL DEFAULT 0',
+    'last_failure': 'TEXT',
+    'last_failure_at': 'REAL',
+    'failure_count': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+# أعمدة أضيفت لاحقاً إلى جدول المهام: قوائم التشغيل، ومعلومات الرابط المستخرجة (JSON)
+# التي يحمّل منها العامل مباشرة لأن ذاكرة metadata_cache خاصة بعملية البوت
+_JOBS_EXTRA_COLUMNS = {
+    'playlist_id': 'INTEGER',
+    'position': 'INTEGER',
+    'info': 'TEXT',
+}
+
+def _add_missing_columns(cursor: sqlite3.Cursor, table: str, columns: dict[str, str]):
+    """يضيف الأعمدة الناقصة إلى جدول في قواعد البيانات القديمة."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column, definition in columns.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migrate_users_table(cursor: sqlite3.Cursor):
+    """يضيف أعمدة حالة التوصيل إلى جدول المستخدمين في قواعد البيانات القديمة."""
+    _add_missing_columns(cursor, 'users', _USERS_EXTRA_COLUMNS)
+
 def init_db():
     """
     يقوم بإنشاء الجداول في قاعدة البيانات إذا لم تكن موجودة.
     """
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
+    global _flush_thread
+    with db_write(0) as cursor:
         # جدول لتخزين المستخدمين
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users ( 
                 user_id INTEGER PRIMARY KEY
             )
         ''')
+        _migrate_users_table(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users (is_blocked, user_id)")
         # جدول لتخزين الإعدادات (مثل قناة الاشتراك الإجباري)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS settings (
@@ -54,62 +336,680 @@ def init_db():
                 value TEXT
             )
         ''')
-        conn.commit()
+        # جدول لتخزين file_id الخاص بتليجرام لكل ملف تم رفعه سابقاً
+        # حتى نعيد إرساله مباشرة دون تحميل أو رفع جديد
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_cache (
+                extractor TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                format_id TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                PRIMARY KEY (extractor, video_id, media_type, format_id)
+            )
+        ''')
+        # جدول لتخزين الإذاعات وتقدمها حتى يمكن استئنافها بعد إعادة التشغيل
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_user_id INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )
+        ''')
+        # طابور مهام التحميل: يكتبها البوت وتستلمها عمليات العمال بعقود مؤقتة (lease)
+        # المهام المطابقة لمهمة جارية تُربط بها عبر parent_id وحالتها 'attached'
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                status_message_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                extractor TEXT,
+                video_id TEXT,
+                media_type TEXT NOT NULL,
+                format_id TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                duration REAL,
+                parent_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                file_id TEXT,
+                file_type TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        _add_missing_columns(cursor, 'jobs', _JOBS_EXTRA_COLUMNS)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_parent ON jobs (parent_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_playlist ON jobs (playlist_id, status)")
+        # قوائم التشغيل: كل عنصر مهمة في جدول jobs مرتبطة بالقائمة عبر playlist_id وترتيبها position
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS playlists (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                status_message_id INTEGER NOT NULL,
+                title TEXT,
+                total INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # حجوزات مساحة القرص لكل مجلد عمل، حتى تكون ميزانية القرص واحدة لكل العمال.
+        # الحجز محسوب فقط ما دام عقد مهمته سارياً، فلا تبقى حجوزات العمال المتوقفين فجأة
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS storage_reservations (
+                job_dir TEXT PRIMARY KEY,
+                job_id INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        # آخر إحصائيات نشرها كل عامل (لعرضها في لوحة الأدمن)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                stats TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+    load_settings()
+
+    # تشغيل خيط كتابة الدفعات المؤجلة
+    if _flush_thread is None:
+        _flush_thread = threading.Thread(target=_flush_loop, name='db-flush', daemon=True)
+        _flush_thread.start()
 
 def add_user(user_id: int):
     """
     يضيف مستخدمًا جديدًا إلى قاعدة البيانات إذا لم يكن موجودًا.
+    الكتابة مؤجلة وتتم ضمن دفعة دورية بدلاً من معاملة لكل رسالة.
     """
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
+    with _pending_lock:
+        _pending_users[user_id] = time.time()
+        batch_full = len(_pending_users) >= DB_BATCH_SIZE
+    if batch_full:
+        _flush_wakeup.set()
 
 def get_all_users() -> list[int]:
     """
-    يعيد قائمة بجميع معرفات المستخدمين المسجلين في البوت.
+    يعيد قائمة بجميع معرفات المستخدمين النشطين (غير الحاظرين للبوت).
     """
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users")
+    flush_pending_writes()
+    with db_read() as cursor:
+        cursor.execute("SELECT user_id FROM users WHERE is_blocked = 0")
         return [row[0] for row in cursor.fetchall()]
 
 def get_user_count() -> int:
     """
-    يعيد عدد المستخدمين الكلي.
+    يعيد عدد المستخدمين النشطين (بدون من حظروا البوت).
     """
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
+    flush_pending_writes()
+    with db_read() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 0")
         return cursor.fetchone()[0]
 
+def get_blocked_user_count() -> int:
+    """
+    يعيد عدد المستخدمين الذين حظروا البوت أو حذفوا حساباتهم.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 1")
+        return cursor.fetchone()[0]
+
+def record_delivery_failures(failures: list[tuple[int, str, bool]]):
+    """
+    يسجل فشل التوصيل لمجموعة مستخدمين في معاملة واحدة.
+    كل عنصر: (user_id, سبب الفشل, هل المستخدم ميت: حظر البوت أو المحادثة غير موجودة).
+    """
+    if not failures:
+        return
+    now = time.time()
+    with db_write(len(failures)) as cursor:
+        cursor.executemany(
+            "UPDATE users SET last_failure = ?, last_failure_at = ?, failure_count = failure_count + 1, "
+            "is_blocked = MAX(is_blocked, ?) WHERE user_id = ?",
+            [(reason, now, int(dead), user_id) for user_id, reason, dead in failures]
+        )
+
+def load_settings():
+    """
+    يحمّل جدول الإعدادات بالكامل إلى الذاكرة.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT key, value FROM settings")
+        rows = cursor.fetchall()
+    _settings_cache.clear()
+    _settings_cache.update(rows)
+
 def set_setting(key: str, value: str):
     """
     يضبط قيمة مفتاح معين في جدول الإعدادات (مثل قناة الاشتراك).
+    يتم تحديث النسخة الموجودة في الذاكرة بعد نجاح الكتابة.
     """
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
+    with db_write() as cursor:
         cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-        conn.commit()
+    _settings_cache[key] = value
 
 def get_setting(key: str) -> str | None:
     """
-    يجلب قيمة مفتاح معين من جدول الإعدادات.
+    يجلب قيمة مفتاح معين من الإعدادات المحمّلة في الذاكرة بدون الرجوع لقاعدة البيانات.
+    """
+    return _settings_cache.get(key)
+
+# عدادات الإصابة/الإخفاق في ذاكرة التخزين المؤقت لـ file_id (منذ آخر تشغيل)
+FILE_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+def get_cached_file(extractor: str, video_id: str, media_type: str, format_id: str) -> tuple[str, str] | None:
     """
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+    يجلب file_id ونوع الملف المخزنين لوسائط تم رفعها سابقاً، ويحدّث عدادات الإصابة/الإخفاق.
+    """
+    with db_read() as cursor:
+        cursor.execute(
+            "SELECT file_id, file_type FROM file_cache WHERE extractor = ? AND video_id = ? AND media_type = ? AND format_id = ?",
+            (extractor, video_id, media_type, format_id)
+        )
         result = cursor.fetchone()
-        return result[0] if result else None
+    FILE_CACHE_STATS['hits' if result else 'misses'] += 1
+    return (result[0], result[1]) if result else None
+
+def save_cached_file(extractor: str, video_id: str, media_type: str, format_id: str, file_id: str, file_type: str):
+    """
+    يخزن file_id الناتج عن أول رفع ناجح لإعادة استخدامه في الطلبات المطابقة.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO file_cache (extractor, video_id, media_type, format_id, file_id, file_type) VALUES (?, ?, ?, ?, ?, ?)",
+            (extractor, video_id, media_type, format_id, file_id, file_type)
+        )
+
+def delete_cached_file(extractor: str, video_id: str, media_type: str, format_id: str):
+    """
+    يحذف file_id مخزناً لم يعد صالحاً (مثلاً إذا رفضه تليجرام).
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "DELETE FROM file_cache WHERE extractor = ? AND video_id = ? AND media_type = ? AND format_id = ?",
+            (extractor, video_id, media_type, format_id)
+        )
+
+def get_file_cache_count() -> int:
+    """
+    يعيد عدد الملفات المخزنة في ذاكرة file_id.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM file_cache")
+        return cursor.fetchone()[0]
+
+def get_users_page(after_user_id: int, limit: int) -> list[int]:
+    """
+    يعيد صفحة من معرفات المستخدمين النشطين الأكبر من after_user_id بالترتيب،
+    حتى يمكن المرور على كل المستخدمين دون تحميلهم في الذاكرة دفعة واحدة.
+    """
+    flush_pending_writes()
+    with db_read() as cursor:
+        cursor.execute(
+            "SELECT user_id FROM users WHERE is_blocked = 0 AND user_id > ? ORDER BY user_id LIMIT ?",
+            (after_user_id, limit)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+def create_broadcast(from_chat_id: int, message_id: int, total: int) -> int:
+    """
+    يسجل إذاعة جديدة ويعيد معرفها.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "INSERT INTO broadcasts (from_chat_id, message_id, total, created_at) VALUES (?, ?, ?, ?)",
+            (from_chat_id, message_id, total, time.time())
+        )
+        return cursor.lastrowid
+
+def set_broadcast_status_message(broadcast_id: int, chat_id: int, message_id: int):
+    """
+    يحفظ رسالة الحالة الخاصة بالإذاعة لتعديلها لاحقاً (حتى بعد الاستئناف).
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE broadcasts SET status_chat_id = ?, status_message_id = ? WHERE id = ?",
+            (chat_id, message_id, broadcast_id)
+        )
+
+def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, status: str = 'running'):
+    """
+    يحفظ آخر مستخدم تمت معالجته وعدادات الإرسال.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, status = ? WHERE id = ?",
+            (last_user_id, sent, failed, status, broadcast_id)
+        )
+
+def get_unfinished_broadcasts() -> list[dict]:
+    """
+    يعيد الإذاعات التي لم تكتمل (لاستئنافها عند التشغيل).
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def _rows_to_dicts(cursor: sqlite3.Cursor) -> list[dict]:
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def enqueue_job(job: dict) -> tuple[int, int | None]:
+    """
+    يضيف مهمة تحميل إلى الطابور. إذا وُجدت مهمة مطابقة (نفس الفيديو والصيغة والنوع) قيد الانتظار أو التنفيذ،
+    تُربط بها المهمة الجديدة لتستلم نفس الملف عبر file_id بدلاً من تحميله مرة ثانية.
+    job['info'] (اختياري) معلومات الرابط المختصرة بصيغة JSON، لا تُحفظ للمهام المرتبطة لأنها لا تُحمّل.
+    يعيد (معرف المهمة، معرف المهمة المرتبطة بها أو None).
+    """
+    now = time.time()
+    with db_write() as cursor:
+        parent_id = None
+        if job['extractor'] and job['video_id']:
+            cursor.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') AND parent_id IS NULL AND playlist_id IS NULL "
+                "AND extractor = ? AND video_id = ? AND media_type = ? AND format_id = ? ORDER BY id LIMIT 1",
+                (job['extractor'], job['video_id'], job['media_type'], job['format_id'])
+            )
+            row = cursor.fetchone()
+            parent_id = row[0] if row else None
+        cursor.execute(
+            "INSERT INTO jobs (user_id, chat_id, status_message_id, url, extractor, video_id, media_type, format_id, "
+            "size, duration, parent_id, status, info, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job['user_id'], job['chat_id'], job['status_message_id'], job['url'], job['extractor'], job['video_id'],
+             job['media_type'], job['format_id'], job['size'], job['duration'], parent_id,
+             'attached' if parent_id else 'queued', None if parent_id else job.get('info'), now, now)
+        )
+        return cursor.lastrowid, parent_id
+
+# دور المهمة في التوزيع بالتناوب: ترتيبها بين مهام صاحبها المنتظرة مضافاً إليه عدد مهامه الجارية،
+# فتُقدَّم المهمة الأولى لكل مستخدم على المهمة الثانية لأي مستخدم آخر مهما كان وقت إضافتها
+_JOB_TURN_SQL = (
+    "ROW_NUMBER() OVER (PARTITION BY candidate.user_id ORDER BY candidate.id) "
+    "+ (SELECT COUNT(*) FROM jobs AS active WHERE active.user_id = candidate.user_id "
+    "   AND active.status = 'running' AND active.lease_expires >= ?)"
+)
+
+def get_job_position(job_id: int) -> int:
+    """
+    يعيد ترتيب المهمة بين المهام المنتظرة (0 إذا لم تعد منتظرة).
+    """
+    with db_read() as cursor:
+        cursor.execute(
+            "SELECT position FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY turn, id) AS position FROM ("
+            f"  SELECT candidate.id AS id, {_JOB_TURN_SQL} AS turn FROM jobs AS candidate "
+            "  WHERE candidate.status = 'queued')) WHERE id = ?",
+            (time.time(), job_id)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+def get_queued_jobs() -> list[dict]:
+    """
+    يعيد المهام المنتظرة بترتيب الطابور (لتحديث ترتيبها في رسائل أصحابها).
+    """
+    with db_read() as cursor:
+        cursor.execute(
+            "SELECT id, chat_id, status_message_id, playlist_id FROM ("
+            f"  SELECT candidate.*, {_JOB_TURN_SQL} AS turn FROM jobs AS candidate "
+            "  WHERE candidate.status = 'queued') ORDER BY turn, id",
+            (time.time(),)
+        )
+        return _rows_to_dicts(cursor)
+
+def is_job_queued(job_id: int) -> bool:
+    """
+    هل ما زالت المهمة تنتظر في الطابور؟
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT 1 FROM jobs WHERE id = ? AND status = 'queued'", (job_id,))
+        return cursor.fetchone() is not None
+
+def claim_job(worker_id: str) -> dict | None:
+    """
+    يستلم المهمة التالية بالتناوب بين المستخدمين (أو مهمة انتهى عقد عاملها) بعقد جديد، في عبارة واحدة ذرية
+    حتى لا يستلم عاملان نفس المهمة. يتخطى المستخدمين الذين بلغوا حد المهام الجارية،
+    وعناصر قوائم التشغيل التي بلغت قائمتها حد PLAYLIST_CONCURRENCY (لها حدها الخاص بدلاً من حد المستخدم).
+    العنصر الذي يسبق عنصراً جارياً في قائمته (انتهى عقده أو أُعيد إلى الطابور) مستثنى من الحد،
+    لأن العناصر الجارية بعده تنتظره قبل الإرسال ولن تفرغ مكاناً له أبداً.
+    """
+    now = time.time()
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE id = (SELECT id FROM ("
+            f"  SELECT candidate.id AS id, {_JOB_TURN_SQL} AS turn FROM jobs AS candidate "
+            "  WHERE (candidate.status = 'queued' OR (candidate.status = 'running' AND candidate.lease_expires < ?)) "
+            "  AND candidate.attempts < ? "
+            "  AND (candidate.playlist_id IS NOT NULL OR candidate.user_id NOT IN ("
+            "    SELECT user_id FROM jobs WHERE status = 'running' AND lease_expires >= ? AND playlist_id IS NULL "
+            "    GROUP BY user_id HAVING COUNT(*) >= ?)) "
+            "  AND (candidate.playlist_id IS NULL OR candidate.playlist_id NOT IN ("
+            "    SELECT playlist_id FROM jobs WHERE status = 'running' AND lease_expires >= ? AND playlist_id IS NOT NULL "
+            "    GROUP BY playlist_id HAVING COUNT(*) >= ?) "
+            "    OR EXISTS (SELECT 1 FROM jobs AS later WHERE later.playlist_id = candidate.playlist_id "
+            "      AND later.status = 'running' AND later.lease_expires >= ? AND later.position > candidate.position)) "
+            "  ) ORDER BY turn, id LIMIT 1) "
+            "RETURNING *",
+            (worker_id, now + JOB_LEASE_SECONDS, now, now, now, JOB_MAX_ATTEMPTS, now, DOWNLOAD_SLOTS_PER_USER,
+             now, PLAYLIST_CONCURRENCY, now)
+        )
+        rows = _rows_to_dicts(cursor)
+    return rows[0] if rows else None
+
+def renew_job_lease(job_id: int, worker_id: str) -> bool:
+    """
+    يجدد عقد المهمة. يعيد False إذا لم تعد المهمة لهذا العامل.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (time.time() + JOB_LEASE_SECONDS, job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+def requeue_job(job_id: int, worker_id: str):
+    """
+    يعيد المهمة إلى الطابور فوراً عند إيقاف العامل، دون احتساب المحاولة.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires = NULL, "
+            "attempts = MAX(attempts - 1, 0), updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (time.time(), job_id, worker_id)
+        )
+
+def get_attached_jobs(job_id: int) -> list[dict]:
+    """
+    يعيد المهام المرتبطة بمهمة جارية.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT * FROM jobs WHERE parent_id = ? AND status = 'attached'", (job_id,))
+        return _rows_to_dicts(cursor)
+
+def complete_job(job_id: int, worker_id: str | None, file_id: str | None, file_type: str | None,
+                 error: str | None) -> list[dict] | None:
+    """
+    ينهي المهمة (ناجحة إذا وُجد file_id) وينقل النتيجة نفسها إلى المهام المرتبطة بها، ويعيد هذه المهام لتسليمها.
+    معلومات الرابط المخزنة تُحذف لأنها لم تعد لازمة. يعيد None إذا لم تعد المهمة لهذا العامل
+    (استلمها عامل آخر بعد انتهاء العقد).
+    """
+    status = 'done' if file_id else 'failed'
+    now = time.time()
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE jobs SET status = ?, file_id = ?, file_type = ?, error = ?, info = NULL, lease_owner = NULL, "
+            "updated_at = ? "
+            "WHERE id = ? AND status = 'running' AND (? IS NULL OR lease_owner = ?)",
+            (status, file_id, file_type, error, now, job_id, worker_id, worker_id)
+        )
+        if cursor.rowcount != 1:
+            return None
+        cursor.execute(
+            "UPDATE jobs SET status = ?, file_id = ?, file_type = ?, error = ?, updated_at = ? "
+            "WHERE parent_id = ? AND status = 'attached' RETURNING *",
+            (status, file_id, file_type, error, now, job_id)
+        )
+        return _rows_to_dicts(cursor)
+
+def expire_exhausted_jobs() -> list[dict]:
+    """
+    يعلّم المهام التي انتهى عقدها بعد استنفاد المحاولات كفاشلة، مع المهام المرتبطة بها، ويعيدها لإبلاغ أصحابها.
+    """
+    now = time.time()
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE jobs SET status = 'failed', error = 'lease expired', lease_owner = NULL, updated_at = ? "
+            "WHERE status = 'running' AND lease_expires < ? AND attempts >= ? RETURNING *",
+            (now, now, JOB_MAX_ATTEMPTS)
+        )
+        expired = _rows_to_dicts(cursor)
+        for job in list(expired):
+            cursor.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired', updated_at = ? "
+                "WHERE parent_id = ? AND status = 'attached' RETURNING *",
+                (now, job['id'])
+            )
+            expired.extend(_rows_to_dicts(cursor))
+        return expired
+
+def prune_finished_jobs():
+    """
+    يحذف المهام المنتهية الأقدم من مدة الاحتفاظ.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - JOB_RETENTION,)
+        )
+        cursor.execute(
+            "DELETE FROM playlists WHERE status != 'running' AND updated_at < ?",
+            (time.time() - JOB_RETENTION,)
+        )
+
+def enqueue_playlist(playlist: dict, entries: list[dict], media_type: str, format_id: str) -> int | None:
+    """
+    يضيف قائمة تشغيل وكل عناصرها إلى طابور المهام في معاملة واحدة، بنفس ترتيب القائمة.
+    الحقول الفارغة قد تغيب من العناصر المستعادة من الذاكرة المؤقتة، لذا لا يلزم إلا 'url'.
+    لا تُربط عناصر القوائم بالمهام المطابقة لأن رسالة حالتها مشتركة بين كل العناصر.
+    يعيد معرف القائمة، أو None إذا بلغ المستخدم حد PLAYLIST_MAX_ACTIVE_PER_USER
+    (الفحص والإضافة في نفس العبارة حتى لا تنشئ نقرتان سريعتان قائمتين).
+    """
+    now = time.time()
+    with db_write(len(entries) + 1) as cursor:
+        cursor.execute(
+            "INSERT INTO playlists (user_id, chat_id, status_message_id, title, total, created_at, updated_at) "
+            "SELECT ?, ?, ?, ?, ?, ?, ? "
+            "WHERE (SELECT COUNT(*) FROM playlists WHERE status = 'running' AND user_id = ?) < ?",
+            (playlist['user_id'], playlist['chat_id'], playlist['status_message_id'], playlist['title'],
+             len(entries), now, now, playlist['user_id'], PLAYLIST_MAX_ACTIVE_PER_USER)
+        )
+        if cursor.rowcount == 0:
+            return None
+        playlist_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO jobs (user_id, chat_id, status_message_id, url, extractor, video_id, media_type, format_id, "
+            "size, duration, playlist_id, position, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, 'queued', ?, ?)",
+            [(playlist['user_id'], playlist['chat_id'], playlist['status_message_id'], entry['url'], entry.get('extractor'),
+              entry.get('video_id'), media_type, format_id, entry.get('duration'), playlist_id, position, now, now)
+             for position, entry in enumerate(entries, 1)]
+        )
+        return playlist_id
+
+def get_playlist(playlist_id: int) -> dict | None:
+    """
+    يعيد بيانات قائمة التشغيل.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT * FROM playlists WHERE id = ?", (playlist_id,))
+        rows = _rows_to_dicts(cursor)
+    return rows[0] if rows else None
+
+def get_playlist_counts(playlist_id: int) -> dict[str, int]:
+    """
+    يعيد عدد عناصر القائمة في كل حالة.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT status, COUNT(*) FROM jobs WHERE playlist_id = ? GROUP BY status", (playlist_id,))
+        return dict(cursor.fetchall())
+
+def count_active_playlists(user_id: int | None = None) -> int:
+    """
+    يعيد عدد قوائم التشغيل الجارية (لمستخدم محدد أو للجميع).
+    """
+    with db_read() as cursor:
+        if user_id is None:
+            cursor.execute("SELECT COUNT(*) FROM playlists WHERE status = 'running'")
+        else:
+            cursor.execute("SELECT COUNT(*) FROM playlists WHERE status = 'running' AND user_id = ?", (user_id,))
+        return cursor.fetchone()[0]
+
+def playlist_entries_pending_before(playlist_id: int, position: int) -> bool:
+    """
+    هل بقي عنصر سابق في القائمة لم ينتهِ بعد؟ (حتى تصل العناصر إلى المستخدم بترتيب القائمة)
+    """
+    with db_read() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM jobs WHERE playlist_id = ? AND position < ? AND status NOT IN ('done', 'failed') LIMIT 1",
+            (playlist_id, position)
+        )
+        return cursor.fetchone() is not None
+
+def finish_playlist(playlist_id: int) -> dict | None:
+    """
+    يعلّم القائمة كمكتملة إذا انتهت كل عناصرها، ويعيدها مرة واحدة فقط (للعامل الذي أنهاها).
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE playlists SET status = 'done', updated_at = ? WHERE id = ? AND status = 'running' "
+            "AND NOT EXISTS (SELECT 1 FROM jobs WHERE playlist_id = ? AND status NOT IN ('done', 'failed')) "
+            "RETURNING *",
+            (time.time(), playlist_id, playlist_id)
+        )
+        rows = _rows_to_dicts(cursor)
+    return rows[0] if rows else None
+
+def cancel_playlist(playlist_id: int, user_id: int) -> dict | None:
+    """
+    يلغي قائمة جارية لصاحبها: العناصر المنتظرة والجارية تُعلّم كفاشلة، فيفقد العمال عقود الجارية منها ويوقفونها.
+    يعيد القائمة أو None إذا لم تكن جارية أو لا تخص المستخدم.
+    """
+    now = time.time()
+    with db_write() as cursor:
+        cursor.execute(
+            "UPDATE playlists SET status = 'cancelled', updated_at = ? WHERE id = ? AND user_id = ? AND status = 'running' "
+            "RETURNING *",
+            (now, playlist_id, user_id)
+        )
+        rows = _rows_to_dicts(cursor)
+        if not rows:
+            return None
+        cursor.execute(
+            "UPDATE jobs SET status = 'failed', error = 'cancelled', lease_owner = NULL, updated_at = ? "
+            "WHERE playlist_id = ? AND status IN ('queued', 'running')",
+            (now, playlist_id)
+        )
+    return rows[0]
+
+def get_leased_job_ids() -> set[int]:
+    """
+    يعيد معرفات المهام الجارية بعقد ساري (في كل العمال).
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT id FROM jobs WHERE status = 'running' AND lease_expires >= ?", (time.time(),))
+        return {row[0] for row in cursor.fetchall()}
+
+# مجموع الحجوزات التي ما زالت مهامها جارية بعقد ساري
+_LIVE_RESERVATIONS_SQL = (
+    "SELECT COALESCE(SUM(r.size), 0) FROM storage_reservations r JOIN jobs j ON j.id = r.job_id "
+    "WHERE j.status = 'running' AND j.lease_expires >= ?"
+)
+
+def reserve_storage(job_id: int, job_dir: str, size: int, budget: int) -> bool:
+    """
+    يحجز size بايت لمجلد العمل إذا بقي مجموع الحجوزات في كل العمال ضمن budget، في عبارة واحدة ذرية.
+    يعيد False إذا لم تتوفر المساحة بعد.
+    """
+    now = time.time()
+    with db_write() as cursor:
+        # حجز قديم لنفس المجلد (محاولة سابقة توقف عاملها) يُستبدل
+        cursor.execute("DELETE FROM storage_reservations WHERE job_dir = ?", (job_dir,))
+        cursor.execute(
+            "INSERT INTO storage_reservations (job_dir, job_id, size, created_at) "
+            f"SELECT ?, ?, ?, ? WHERE ({_LIVE_RESERVATIONS_SQL}) + ? <= ?",
+            (job_dir, job_id, size, now, now, size, budget)
+        )
+        return cursor.rowcount == 1
+
+def release_storage(job_dir: str):
+    """
+    يحذف حجز مجلد العمل.
+    """
+    with db_write() as cursor:
+        cursor.execute("DELETE FROM storage_reservations WHERE job_dir = ?", (job_dir,))
+
+def get_reserved_storage() -> int:
+    """
+    يعيد مجموع الحجوزات السارية في كل العمال.
+    """
+    with db_read() as cursor:
+        cursor.execute(_LIVE_RESERVATIONS_SQL, (time.time(),))
+        return cursor.fetchone()[0]
+
+def delete_stale_reservations() -> int:
+    """
+    يحذف حجوزات المهام التي لم تعد جارية بعقد ساري (عمال توقفوا قبل تحرير حجوزاتهم).
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "DELETE FROM storage_reservations WHERE job_id NOT IN "
+            "(SELECT id FROM jobs WHERE status = 'running' AND lease_expires >= ?)",
+            (time.time(),)
+        )
+        return cursor.rowcount
+
+def get_job_counts() -> dict[str, int]:
+    """
+    يعيد عدد المهام في كل حالة.
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(cursor.fetchall())
+
+def save_worker_stats(worker_id: str, stats: dict):
+    """
+    ينشر آخر إحصائيات العامل.
+    """
+    with db_write() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, stats, updated_at) VALUES (?, ?, ?)",
+            (worker_id, json.dumps(stats), time.time())
+        )
+
+def delete_worker_stats(worker_id: str):
+    """
+    يحذف إحصائيات العامل عند إيقافه.
+    """
+    with db_write() as cursor:
+        cursor.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+def get_worker_stats() -> list[dict]:
+    """
+    يعيد إحصائيات العمال الذين نشروها مؤخراً (الأحياء فقط).
+    """
+    with db_read() as cursor:
+        cursor.execute("SELECT stats FROM workers WHERE updated_at >= ?", (time.time() - WORKER_STATS_INTERVAL * 3,))
+        return [json.loads(row[0]) for row in cursor.fetchall()]
 
 # ==============================================================================
 # ٣. الدوال المساعدة (بديل لـ helpers.py)
 # ==============================================================================
 
-def get_ydl_opts(media_type='video'):
+def get_ydl_opts(media_type='video', work_dir: str = DOWNLOAD_DIR):
     """إرجاع إعدادات yt-dlp بدون أي كوكيز."""
     base_opts = {
-        'outtmpl': 'downloads/%(title).100s-%(id)s.%(ext)s',
+        'outtmpl': os.path.join(work_dir, '%(title).100s-%(id)s.%(ext)s'),
         'noplaylist': True,
         'restrictfilenames': True,
         'nooverwrites': True,
@@ -143,10 +1043,7 @@ def get_ydl_opts(media_type='video'):
         base_opts.update({
             'format': 'bestvideo+bestaudio/best',
             'merge_output_format': 'mp4',
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }],
+            # التحويل إلى mp4 يتم عبر SmartMp4PP (انظر create_ydl) بدلاً من FFmpegVideoConvertor
         })
     elif media_type == 'audio_m4a':
         base_opts.update({
@@ -169,97 +1066,1039 @@ def get_ydl_opts(media_type='video'):
     
     return base_opts
 
-def format_duration(seconds: float) -> str:
-    """يحول المدة من ثوانٍ إلى تنسيق مقروء (س:د:ث)."""
-    if not seconds:
-        return "غير معروف"
-    
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    
-    if hours > 0:
-        return f"{hours}:{minutes:02d}:{secs:02d}"
-    else:
-        return f"{minutes}:{secs:02d}"
-def _is_better_format(new_format: dict, current_format: dict) -> bool:
-    """يقارن بين صيغتين للفيديو ويحدد أيهما أفضل بناءً على معدل البت."""
-    # الأفضلية لمعدل البت للفيديو (vbr) إن وجد، وإلا فاستخدم معدل البت الكلي (tbr)
-    new_bitrate = new_format.get('vbr') or new_format.get('tbr') or 0
-    current_bitrate = current_format.get('vbr') or current_format.get('tbr') or 0
-    return new_bitrate > current_bitrate
+# الترميزات التي يمكن وضعها في mp4 وتشغيلها مباشرة في تليجرام بدون إعادة ترميز
+MP4_VIDEO_CODECS = {'h264'}
+MP4_AUDIO_CODECS = {'aac'}
+
+# عدد مرات كل مسار (بدون معالجة / إعادة تغليف / إعادة ترميز) ومجموع الوقت الذي استغرقه
+TRANSCODE_STATS = {mode: {'count': 0, 'time': 0.0} for mode in ('none', 'remux', 'transcode')}
+
+class SmartMp4PP(FFmpegPostProcessor):
+    """
+    معالج yt-dlp يضمن أن الفيديو النهائي mp4 متوافق مع تليجرام بأقل تكلفة:
+    - لا شيء إذا كان الملف mp4 بترميزات متوافقة.
+    - إعادة تغليف بنسخ المسارات (stream copy) إذا كانت الترميزات متوافقة والحاوية مختلفة.
+    - إعادة ترميز المسار غير المتوافق فقط (الفيديو أو الصوت) عند الحاجة.
+    """
+    def run(self, info):
+        path = info['filepath']
+        source_ext = info.get('ext') or os.path.splitext(path)[1].lstrip('.')
+        streams = self.get_metadata_object(path).get('streams', [])
+        video_codecs = {
+            st.get('codec_name') for st in streams
+            if st.get('codec_type') == 'video' and not (st.get('disposition') or {}).get('attached_pic')
+        }
+        audio_codecs = {st.get('codec_name') for st in streams if st.get('codec_type') == 'audio'}
+        video_ok = video_codecs <= MP4_VIDEO_CODECS
+        audio_ok = audio_codecs <= MP4_AUDIO_CODECS
+
+        start = time.perf_counter()
+        files_to_delete = []
+        if video_ok and audio_ok and source_ext == 'mp4':
+            mode = 'none'
+        else:
+            mode = 'remux' if video_ok and audio_ok else 'transcode'
+            options = ['-map', '0:v?', '-map', '0:a?', '-dn', '-sn']
+            options += ['-c:v', 'copy'] if video_ok else ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p']
+            options += ['-c:a', 'copy'] if audio_ok else ['-c:a', 'aac', '-b:a', '160k']
+            options += ['-movflags', '+faststart']
+
+            out_path = replace_extension(path, 'mp4', source_ext)
+            temp_path = prepend_extension(out_path, 'temp') if out_path == path else out_path
+            self.to_screen(f'{mode}: {path} ({", ".join(sorted(video_codecs | audio_codecs))})')
+            self.run_ffmpeg(path, temp_path, options)
+            if temp_path != out_path:
+                os.replace(temp_path, out_path)
+            else:
+                files_to_delete.append(path)
+            info['filepath'] = out_path
+            info['ext'] = 'mp4'
+        elapsed = time.perf_counter() - start
+
+        TRANSCODE_STATS[mode]['count'] += 1
+        TRANSCODE_STATS[mode]['time'] += elapsed
+        info['__smart_mp4'] = {'mode': mode, 'seconds': elapsed}
+        return files_to_delete, info
+
+class CompressionError(Exception):
+    """خطأ في ضغط الفيديو ليناسب حد الرفع."""
+
+def _low_priority_command(command: list[str]) -> list[str]:
+    """
+    يشغّل الأمر عبر nice بأولوية منخفضة حتى لا ينافس ffmpeg التحميلات العادية على المعالج.
+    (preexec_fn غير آمن في عملية متعددة الخيوط، والضغط يعمل داخل خيوط المنفذ.)
+    """
+    nice = shutil.which('nice')
+    return [nice, '-n', str(COMPRESS_NICE), *command] if nice else command
+
+def _compress_sync(source_path: str, duration: float, target_size: int) -> tuple[str, float]:
+    """
+    يضغط الفيديو بترميز h264 على مرحلتين (two-pass) بمعدل بت محسوب من المدة والحجم المستهدف.
+    يعيد مسار الملف الناتج ومدة الترميز بالثواني.
+    """
+    # نترك 3% هامشاً لبيانات الحاوية
+    total_kbps = target_size * 8 * 0.97 / duration / 1000
+    video_kbps = int(total_kbps - COMPRESS_AUDIO_BITRATE)
+    if video_kbps < 100:
+        raise CompressionError("الفيديو طويل جداً ولا يمكن ضغطه بجودة مقبولة ضمن الحد.")
+    # تخفيض الدقة عند معدلات البت المنخفضة حتى تبقى الصورة مقبولة
+    scale = []
+    if video_kbps < 300:
+        scale = ['-vf', 'scale=-2:min(360\\,ih)']
+    elif video_kbps < 700:
+        scale = ['-vf', 'scale=-2:min(480\\,ih)']
+
+    base, _ = os.path.splitext(source_path)
+    out_path = f"{base}.compressed.mp4"
+    passlog = f"{base}.2pass"
+    video_opts = [
+        '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', f'{video_kbps}k',
+        '-maxrate', f'{int(video_kbps * 1.2)}k', '-bufsize', f'{video_kbps * 2}k',
+        '-threads', str(COMPRESS_THREADS), '-passlogfile', passlog, *scale,
+    ]
+    start = time.perf_counter()
+    try:
+        for args in (
+            ['-pass', '1', '-an', '-f', 'mp4', os.devnull],
+            ['-pass', '2', '-c:a', 'aac', '-b:a', f'{COMPRESS_AUDIO_BITRATE}k', '-movflags', '+faststart', out_path],
+        ):
+            result = subprocess.run(
+                _low_priority_command(['ffmpeg', '-y', '-loglevel', 'error', '-i', source_path, *video_opts, *args]),
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            if result.returncode != 0:
+                raise CompressionError(f"فشل ffmpeg: {result.stderr.decode(errors='replace')[-300:]}")
+    finally:
+        for suffix in ('-0.log', '-0.log.mbtree'):
+            with contextlib.suppress(OSError):
+                os.remove(passlog + suffix)
+    if os.path.getsize(out_path) > target_size:
+        os.remove(out_path)
+        raise CompressionError("الملف المضغوط ما زال أكبر من الحد المسموح.")
+    return out_path, time.perf_counter() - start
+
+class CompressionPool:
+    """
+    مجمع عمال منخفض الأولوية لضغط الفيديوهات الكبيرة، منفصل عن مجدول التحميل.
+    يسجل زمن الانتظار في الطابور وسرعة الترميز (بالنسبة لمدة الفيديو).
+    """
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='compress')
+        # العدادات تتغير من خيوط المنفذ ومن حلقة الأحداث معاً
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_queue_time = 0.0
+        self.total_encode_time = 0.0
+        self.total_media_time = 0.0
+
+    async def compress(self, source_path: str, duration: float, target_size: int) -> str:
+        """يضغط الملف ويعيد مسار الناتج، ويحذف الملف الأصلي عند النجاح."""
+        submitted = time.monotonic()
+        with self._lock:
+            self.queued += 1
+        started = False
+
+        def run():
+            nonlocal started
+            with self._lock:
+                started = True
+                self.total_queue_time += time.monotonic() - submitted
+                self.queued -= 1
+                self.running += 1
+            try:
+                return _compress_sync(source_path, duration, target_size)
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+        try:
+            out_path, encode_time = await asyncio.get_running_loop().run_in_executor(self._executor, run)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                if not started:
+                    self.queued -= 1
+        with self._lock:
+            self.completed += 1
+            self.total_encode_time += encode_time
+            self.total_media_time += duration
+        logging.info(f"تم ضغط {source_path} في {encode_time:.1f} ثانية ({duration / encode_time:.2f}x)")
+        with contextlib.suppress(OSError):
+            os.remove(source_path)
+        return out_path
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queued': self.queued, 'running': self.running, 'completed': self.completed, 'failed': self.failed,
+                'total_queue_time': self.total_queue_time, 'total_encode_time': self.total_encode_time,
+                'total_media_time': self.total_media_time,
+            }
+
+    def shutdown(self):
+        """يوقف العمال عند إيقاف البوت."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+compression_pool = CompressionPool(COMPRESS_WORKERS)
+
+def create_ydl(opts: dict, media_type: str | None = None) -> yt_dlp.YoutubeDL:
+    """
+    ينشئ كائن YoutubeDL ويضيف معالج SmartMp4PP عند تحميل فيديو.
+    """
+    ydl = yt_dlp.YoutubeDL(opts)
+    if media_type == 'video':
+        ydl.add_post_processor(SmartMp4PP(ydl), when='post_process')
+    return ydl
+
+def _extract_info_sync(url: str) -> dict | None:
+    """
+    يجلب معلومات الرابط فقط بدون تحميل. تعمل داخل عامل منفصل (خيط أو عملية).
+    """
+    info_opts = get_ydl_opts('video')
+    # عناصر قوائم التشغيل تُعدّد فقط (بدون استخراج كل فيديو) وبحد أقصى PLAYLIST_MAX_ENTRIES
+    info_opts.update({
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'playlistend': PLAYLIST_MAX_ENTRIES,
+        'ignoreerrors': True,
+    })
+    with create_ydl(info_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        # في وضع العمليات يجب أن تكون النتيجة قابلة للنقل بين العمليات
+        if info and EXTRACT_EXECUTOR == 'process':
+            info = ydl.sanitize_info(info)
+        return info
+
+class ExtractionPool:
+    """
+    مجمع عمال محدود لتشغيل extract_info خارج حلقة الأحداث.
+    الطلبات الزائدة عن عدد العمال تنتظر في الطابور ويتم احتساب عمقه.
+    """
+    def __init__(self, max_workers: int, kind: str = 'thread'):
+        self._max_workers = max(1, max_workers)
+        self._kind = kind
+        self._executor: Executor | None = None
+        self._semaphore = asyncio.Semaphore(self._max_workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_queued = 0
+
+    def _get_executor(self) -> Executor:
+        """ينشئ المنفذ عند أول استخدام."""
+        if self._executor is None:
+            if self._kind == 'process':
+                # spawn أكثر أماناً من fork داخل عملية تعمل فيها خيوط أخرى
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._max_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers,
+                    thread_name_prefix='extract'
+                )
+        return self._executor
+
+    async def extract(self, url: str) -> dict | None:
+        """يجلب معلومات الرابط في أحد العمال وينتظر دوره إذا كان الجميع مشغولين."""
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        waiting = True
+        try:
+            async with self._semaphore:
+                self.queued -= 1
+                waiting = False
+                self.running += 1
+                try:
+                    info = await asyncio.get_running_loop().run_in_executor(
+                        self._get_executor(), _extract_info_sync, url
+                    )
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.running -= 1
+                self.completed += 1
+                return info
+        finally:
+            if waiting:
+                self.queued -= 1
+
+    def shutdown(self):
+        """يوقف العمال عند إيقاف البوت."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+extraction_pool = ExtractionPool(EXTRACT_WORKERS, EXTRACT_EXECUTOR)
+
+# معاملات التتبع التي لا تغيّر محتوى الرابط ويمكن حذفها عند توحيده
+_TRACKING_QUERY_PARAMS = {'si', 'feature', 'fbclid', 'igshid', 'igsh', 'gclid'}
+# مفاتيح كبيرة في معلومات yt-dlp لا نحتاجها لعرض الصيغ أو للتحميل
+_UNUSED_INFO_KEYS = (
+    'thumbnails', 'automatic_captions', 'subtitles', 'requested_subtitles', 'heatmap',
+    'description', 'chapters', 'tags', 'categories', 'comments',
+)
+
+def normalize_url(url: str) -> str:
+    """
+    يوحّد شكل الرابط حتى تتطابق الروابط المتكافئة في الذاكرة المؤقتة
+    (حروف صغيرة للنطاق، بدون www أو معاملات التتبع أو الجزء بعد #).
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in _TRACKING_QUERY_PARAMS and not k.startswith('utm_')
+    )
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip('/') or '/', urlencode(query), ''))
+
+def trim_info(info: dict) -> dict:
+    """يحذف الحقول الكبيرة غير المستخدمة وينتج نسخة نظيفة قابلة للتحويل إلى JSON."""
+    trimmed = {k: v for k, v in info.items() if k not in _UNUSED_INFO_KEYS}
+    return yt_dlp.YoutubeDL.sanitize_info(trimmed, remove_private_keys=True)
+
+class MetadataCache:
+    """
+    ذاكرة مؤقتة (TTL + LRU) لمعلومات الروابط بميزانية محددة من الذاكرة.
+    المفتاح الأساسي هو (extractor, id)، والروابط الموحدة تشير إليه حتى تتشارك
+    الصيغ المختلفة لنفس الرابط نفس المدخل.
+    """
+    def __init__(self, ttl: int, max_bytes: int):
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, tuple[float, int, dict]] = OrderedDict()
+        self._aliases: dict[str, tuple] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: tuple):
+        _, entry_size, _ = self._entries.pop(key)
+        self.size -= entry_size
+        for alias in [a for a, k in self._aliases.items() if k == key]:
+            del self._aliases[alias]
+
+    def get(self, url: str) -> dict | None:
+        """يعيد نسخة من المعلومات المخزنة للرابط إن كانت صالحة."""
+        key = self._aliases.get(normalize_url(url))
+        entry = self._entries.get(key) if key else None
+        if entry and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if not entry:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # نعيد نسخة لأن yt-dlp ومعالج الرسائل يعدّلان القاموس
+        return copy.deepcopy(entry[2])
+
+    def put(self, url: str, info: dict):
+        """يخزن نسخة مختصرة من معلومات الرابط ويحذف الأقدم عند تجاوز الميزانية."""
+        key = (info.get('extractor_key') or info.get('extractor'), info.get('id'))
+        if not all(key):
+            return
+        trimmed = trim_info(info)
+        entry_size = len(json.dumps(trimmed))
+        if entry_size > self._max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self._ttl, entry_size, trimmed)
+        self.size += entry_size
+        self._aliases[normalize_url(url)] = key
+        for alias_url in (info.get('webpage_url'), info.get('original_url')):
+            if alias_url:
+                self._aliases[normalize_url(alias_url)] = key
+        while self.size > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+
+metadata_cache = MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_MAX_MB * 1024 * 1024)
+
+# معاملات شائعة في روابط البث تحمل وقت انتهاء صلاحيتها (بتوقيت يونكس)
+_STREAM_EXPIRY_PARAMS = ('expire', 'expires', 'Expires', 'x-expires')
+# هامش أمان (بالثواني) قبل انتهاء صلاحية رابط البث
+STREAM_EXPIRY_MARGIN = 120
+
+def stream_urls_valid(info: dict) -> bool:
+    """
+    يتحقق من أن روابط البث في معلومات yt-dlp لم تنتهِ صلاحيتها بعد،
+    حتى يمكن التحميل منها مباشرة دون استخراج الصفحة من جديد.
+    """
+    deadline = time.time() + STREAM_EXPIRY_MARGIN
+    for fmt in info.get('formats') or [info]:
+        stream_url = fmt.get('url')
+        if not stream_url:
+            continue
+        query = dict(parse_qsl(urlsplit(stream_url).query))
+        for param in _STREAM_EXPIRY_PARAMS:
+            value = query.get(param)
+            if value and value.isdigit() and int(value) < deadline:
+                return False
+        # روابط فيسبوك وإنستغرام تحمل وقت الانتهاء بالنظام الست عشري في المعامل oe
+        value = query.get('oe')
+        if value:
+            try:
+                if int(value, 16) < deadline:
+                    return False
+            except ValueError:
+                pass
+    return True
+
+def format_duration(seconds: float) -> str:
+    """يحول المدة من ثوانٍ إلى تنسيق مقروء (س:د:ث)."""
+    if not seconds:
+        return "غير معروف"
+    
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+    
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    else:
+        return f"{minutes}:{secs:02d}"
+def _pair_quality(candidate: tuple[dict, dict | None, float]) -> tuple:
+    """مفتاح مقارنة جودة زوج (فيديو، صوت): معدل بت الفيديو ثم الصوت."""
+    video, audio, _ = candidate
+    # الأفضلية لمعدل البت للفيديو (vbr) إن وجد، وإلا فاستخدم معدل البت الكلي (tbr)
+    video_bitrate = video.get('vbr') or video.get('tbr') or 0
+    audio_bitrate = (audio.get('abr') or audio.get('tbr') or 0) if audio else 0
+    # عند التساوي نفضّل h264 لأنه لا يحتاج إعادة ترميز
+    return video_bitrate, audio_bitrate, (video.get('vcodec') or '').startswith('avc1')
+
+def plan_video_formats(formats: list[dict], duration: float | None, limit: float) -> list[dict]:
+    """
+    يختار لكل دقة أفضل زوج (فيديو + صوت) يتسع حجمه المقدّر ضمن الحد،
+    بدلاً من اختيار أعلى معدل بت ثم إخفاء الدقة كلها إذا تجاوز الحد.
+    إذا لم يتسع أي زوج يُعاد أصغرها مع fits=False.
+    صيغ الصوت مجهولة الحجم تُستخدم فقط إذا لم توجد صيغة صوت معروفة الحجم، عبر bestaudio
+    ويُحسب الحجم من الفيديو وحده، حتى لا تُعرض صيغة فيديو فقط بلا صوت.
+    النتيجة مرتبة من الدقة الأعلى للأقل.
+    """
+    audio_candidates = []
+    has_unsized_audio = False
+    for f in formats:
+        if f.get('vcodec') == 'none' and f.get('acodec') != 'none':
+            size = get_estimated_size(f, duration) or 0
+            if size > 0:
+                audio_candidates.append((f, size))
+            else:
+                has_unsized_audio = True
+    if not audio_candidates and has_unsized_audio:
+        audio_candidates.append(({'format_id': 'bestaudio'}, 0))
+
+    candidates_by_height: dict[int, list] = {}
+    for f in formats:
+        # تجاهل الصيغ التي لا تحتوي على فيديو
+        if f.get('vcodec') == 'none' or not f.get('height'):
+            continue
+        video_size = get_estimated_size(f, duration) or 0
+        if video_size <= 0:
+            continue
+        if f.get('acodec') == 'none' and audio_candidates:
+            # صيغة فيديو فقط: نجرب كل صيغ الصوت معها
+            pairs = [(f, audio, video_size + audio_size) for audio, audio_size in audio_candidates]
+        else:
+            # صيغة مدمجة (فيديو+صوت)
+            pairs = [(f, None, video_size)]
+        candidates_by_height.setdefault(f['height'], []).extend(pairs)
+
+    plans = []
+    for height in sorted(candidates_by_height, reverse=True):
+        candidates = candidates_by_height[height]
+        fitting = [c for c in candidates if c[2] <= limit]
+        if fitting:
+            video, audio, size = max(fitting, key=_pair_quality)
+        else:
+            video, audio, size = min(candidates, key=lambda c: c[2])
+        plan = {
+            'height': height,
+            'format_id': video['format_id'],
+            'vcodec': video.get('vcodec'),
+            'calculated_size': size,
+            'fits': bool(fitting),
+        }
+        if audio:
+            plan['combined_format'] = f"{video['format_id']}+{audio['format_id']}"
+        plans.append(plan)
+    return plans
+
+def auto_format_selector(plans: list[dict], limit: float) -> str | None:
+    """
+    ينشئ صيغة yt-dlp لخيار "أفضل جودة مناسبة": أفضل زوج يتسع ضمن الحد،
+    ثم فلاتر الحجم في yt-dlp كبديل إذا لم يتوفر الزوج عند التحميل.
+    """
+    best = next((plan for plan in plans if plan['fits']), None)
+    if not best:
+        return None
+    limit = int(limit)
+    return (
+        f"{best.get('combined_format') or best['format_id']}"
+        f"/b[filesize<{limit}]/b[filesize_approx<{limit}]"
+    )
+
+def playlist_format_selector(limit: float) -> str:
+    """
+    صيغة yt-dlp لفيديوهات قوائم التشغيل، إذ لا نعرف صيغ كل عنصر مسبقاً: أفضل جودة حتى PLAYLIST_MAX_HEIGHT،
+    ثم فلاتر الحجم كما في auto_format_selector.
+    """
+    limit = int(limit)
+    return (
+        f"bv*[height<={PLAYLIST_MAX_HEIGHT}]+ba/b[height<={PLAYLIST_MAX_HEIGHT}]"
+        f"/b[filesize<{limit}]/b[filesize_approx<{limit}]"
+    )
+
+def get_playlist_entries(info: dict) -> list[dict]:
+    """
+    يحوّل عناصر قائمة التشغيل (المعددة بـ extract_flat) إلى بيانات مختصرة تكفي لإنشاء مهمة لكل عنصر.
+    العناصر التي ليس لها رابط صالح (محذوفة أو خاصة) يتم تخطيها.
+    """
+    entries = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        url = entry.get('url') if entry.get('_type') == 'url' else entry.get('webpage_url') or entry.get('url')
+        if not url or not url.startswith(('http://', 'https://')):
+            continue
+        entries.append({
+            'url': url,
+            'extractor': entry.get('ie_key') or entry.get('extractor_key'),
+            'video_id': entry.get('id'),
+            'duration': entry.get('duration'),
+        })
+    return entries[:PLAYLIST_MAX_ENTRIES]
+
+def compact_playlist_info(info: dict) -> dict:
+    """
+    نسخة مختصرة من معلومات قائمة التشغيل تكفي لعرض قائمتها، وعناصرها في 'playlist_entries'
+    بصيغة get_playlist_entries. الذاكرة المؤقتة تحذف 'entries' مع الحقول الخاصة، لذا نخزن هذه النسخة.
+    """
+    compact = {key: info.get(key) for key in (
+        'id', 'title', 'extractor', 'extractor_key', 'webpage_url', 'original_url', 'playlist_count',
+    )}
+    compact['_type'] = 'playlist'
+    compact['playlist_entries'] = get_playlist_entries(info)
+    return compact
+
+def format_bytes(size):
+    """يحول البايت إلى صيغة مقروءة (KB, MB, GB) بدقة."""
+    if size is None or size <= 0:
+        return "غير معروف"
+    
+    # تحويل الحجم إلى عدد صحيح لتجنب الأخطاء مع الأرقام العشرية
+    size = int(size)
+    
+    power = 1024
+    power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB'}
+    
+    n = 0
+    while size >= power and n < len(power_labels) - 1:
+        size /= power
+        n += 1
+    
+    if n == 0:  # بايت
+        return f"{size:.0f} {power_labels[n]}"
+    elif size < 10:  # أرقام صغيرة
+        return f"{size:.2f} {power_labels[n]}"
+    elif size < 100:  # أرقام متوسطة
+        return f"{size:.1f} {power_labels[n]}"
+    else:  # أرقام كبيرة
+        return f"{size:.0f} {power_labels[n]}"
+
+def generate_progress_bar(percentage: float) -> str:
+    """ينشئ شريط تقدم نصي."""
+    filled_length = int(10 * percentage / 100)
+    bar = '█' * filled_length + '░' * (10 - filled_length)
+    return f"[{bar}] {percentage:.1f}%"
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """
+    عدادات ومدرجات تكرارية (histograms) بصيغة Prometheus بدون مكتبات إضافية.
+    كل سلسلة مخزنة بمفتاح نصي بصيغة Prometheus (الاسم مع التسميات) وقيم رقمية فقط،
+    حتى يمكن نشر لقطات العمال وجمعها مع sum_worker_stats.
+    """
+    def __init__(self):
+        self._definitions: dict[str, tuple[str, str, tuple]] = {}
+        self._lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        self.histograms: dict[str, dict] = {}
+
+    def counter(self, name: str, help_text: str):
+        self._definitions[name] = ('counter', help_text, ())
+
+    def histogram(self, name: str, help_text: str, buckets: tuple):
+        self._definitions[name] = ('histogram', help_text, buckets)
+
+    @staticmethod
+    def _series(name: str, labels: dict) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in sorted(labels.items())) + "}"
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._series(name, labels)
+        with self._lock:
+            self.counters[series] = self.counters.get(series, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._series(name, labels)
+        buckets = self._definitions[name][2]
+        with self._lock:
+            histogram = self.histograms.get(series)
+            if histogram is None:
+                histogram = self.histograms[series] = {
+                    'buckets': {**{str(bound): 0 for bound in buckets}, '+Inf': 0}, 'sum': 0.0, 'count': 0,
+                }
+            for bound in buckets:
+                if value <= bound:
+                    histogram['buckets'][str(bound)] += 1
+            histogram['buckets']['+Inf'] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'counters': dict(self.counters), 'histograms': copy.deepcopy(self.histograms)}
+
+    def render(self, snapshot: dict) -> str:
+        """يحوّل لقطة (أو مجموع لقطات) إلى صيغة Prometheus النصية."""
+        lines = []
+        for name, (kind, help_text, _) in self._definitions.items():
+            source = snapshot['counters'] if kind == 'counter' else snapshot['histograms']
+            series_list = [series for series in source if series.split('{', 1)[0] == name]
+            if not series_list:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for series in series_list:
+                if kind == 'counter':
+                    lines.append(f"{series} {source[series]}")
+                    continue
+                labels = series[len(name):].strip('{}')
+                prefix = f"{labels}," if labels else ""
+                for bound, count in source[series]['buckets'].items():
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {source[series]['sum']}")
+                lines.append(f"{name}_count{suffix} {source[series]['count']}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def summarize(snapshot: dict, name: str, label: str) -> dict[str, tuple[int, float, str]]:
+        """
+        يجمع مدرجاً حسب تسمية واحدة (مثل stage) ويعيد لكل قيمة: (العدد، المتوسط، الحد الأعلى التقريبي لـ p95).
+        """
+        grouped: dict[str, dict] = {}
+        pattern = f'{label}="'
+        for series, histogram in snapshot['histograms'].items():
+            if series.split('{', 1)[0] != name or pattern not in series:
+                continue
+            value = series.split(pattern, 1)[1].split('"', 1)[0]
+            total = grouped.setdefault(value, {'buckets': {}, 'sum': 0.0, 'count': 0})
+            for bound, count in histogram['buckets'].items():
+                total['buckets'][bound] = total['buckets'].get(bound, 0) + count
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+        summary = {}
+        for value, total in grouped.items():
+            if not total['count']:
+                continue
+            p95 = next(bound for bound, count in total['buckets'].items() if count >= total['count'] * 0.95)
+            summary[value] = (total['count'], total['sum'] / total['count'], p95)
+        return summary
+
+metrics = Metrics()
+metrics.histogram(
+    'bot_stage_duration_seconds', "Duration of each pipeline stage by extractor and media type",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+metrics.histogram(
+    'bot_transfer_speed_bytes_per_second', "Download and upload throughput per job",
+    (65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456),
+)
+metrics.counter('bot_transfer_bytes_total', "Bytes downloaded and uploaded")
+metrics.counter('bot_extractions_total', "Metadata extractions by result")
+metrics.counter('bot_jobs_total', "Finished download jobs by result")
+metrics.histogram(
+    'bot_telegram_api_duration_seconds', "Latency of Telegram Bot API calls by method",
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+metrics.counter('bot_telegram_api_errors_total', "Failed Telegram Bot API calls by method")
+
+
+class ChatEditLimiter:
+    """يحدد معدل تعديل الرسائل في كل محادثة حتى لا نتجاوز حدود تليجرام."""
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._next_allowed: dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        """ينتظر حتى يُسمح بتعديل جديد في المحادثة ثم يحجز الدور التالي."""
+        now = time.monotonic()
+        allowed_at = max(now, self._next_allowed.get(chat_id, 0))
+        self._next_allowed[chat_id] = allowed_at + self._interval
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+chat_edit_limiter = ChatEditLimiter(CHAT_EDIT_INTERVAL)
+
+class DownloadProgress:
+    """
+    ينقل تقدم التحميل من خيط yt-dlp إلى حلقة الأحداث بأمان، ويحدّث رسالة الحالة
+    من مهمة واحدة تجمع التحديثات، بحد أقصى ثابت لعدد التعديلات لكل عملية.
+    """
+    # أقل فاصل (بالثواني) بين تمريرين للتقدم من خيط التحميل
+    _HOOK_INTERVAL = 0.5
+
+    def __init__(self, status_message: Message, loop: asyncio.AbstractEventLoop):
+        self._status_message = status_message
+        self._loop = loop
+        self._files: dict[str, tuple[int, int]] = {}
+        self._speed = None
+        self._eta = None
+        self._stage = 'download'
+        self._last_hook_time = 0.0
+        self._changed = asyncio.Event()
+        self._last_text = None
+        self._postprocess_started = None
+        self.postprocess_time = 0.0
+
+    @property
+    def downloaded_bytes(self) -> int:
+        return sum(d for d, _ in self._files.values())
+
+    def hook(self, d: dict):
+        """progress_hook الخاص بـ yt-dlp. يعمل داخل خيط التحميل."""
+        now = time.monotonic()
+        if d.get('status') == 'downloading' and now - self._last_hook_time < self._HOOK_INTERVAL:
+            return
+        self._last_hook_time = now
+        self._loop.call_soon_threadsafe(
+            self._update,
+            d.get('filename') or '',
+            d.get('downloaded_bytes') or 0,
+            d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+            d.get('speed'),
+            d.get('eta'),
+        )
+
+    def postprocessor_hook(self, d: dict):
+        """postprocessor_hook الخاص بـ yt-dlp لإظهار مرحلة المعالجة وقياس زمنها."""
+        if d.get('status') == 'started':
+            self._postprocess_started = time.monotonic()
+            self._loop.call_soon_threadsafe(self._set_stage, 'postprocess')
+        elif d.get('status') == 'finished' and self._postprocess_started is not None:
+            self.postprocess_time += time.monotonic() - self._postprocess_started
+            self._postprocess_started = None
+
+    def _update(self, filename: str, downloaded: int, total: int, speed, eta):
+        self._files[filename] = (downloaded, max(total, downloaded))
+        self._speed = speed
+        self._eta = eta
+        self._changed.set()
+
+    def _set_stage(self, stage: str):
+        self._stage = stage
+        self._changed.set()
+
+    def _render(self) -> str:
+        """ينشئ نص رسالة التقدم."""
+        if self._stage == 'postprocess':
+            return "⚙️ اكتمل التحميل، جارٍ معالجة الملف..."
+        downloaded = sum(d for d, _ in self._files.values())
+        total = sum(t for _, t in self._files.values())
+        text = "⬇️ جارٍ التحميل..."
+        if total:
+            text += f"\n{generate_progress_bar(min(downloaded / total * 100, 100))}"
+        text += f"\n📦 {format_bytes(downloaded)} / {format_bytes(total)}"
+        if self._speed:
+            text += f"\n⚡ {format_bytes(self._speed)}/s"
+        if self._eta:
+            text += f" • ⏱️ {format_duration(self._eta)}"
+        return text
+
+    async def run(self):
+        """يحدّث رسالة الحالة عند وجود تقدم جديد، حتى نفاد عدد التحديثات المسموح."""
+        for _ in range(PROGRESS_UPDATE_BUDGET):
+            await self._changed.wait()
+            self._changed.clear()
+            await chat_edit_limiter.wait(self._status_message.chat_id)
+            text = self._render()
+            if text != self._last_text:
+                try:
+                    await self._status_message.edit_text(text)
+                    self._last_text = text
+                except TelegramError as e:
+                    if "Message is not modified" not in str(e):
+                        logger.warning(f"خطأ أثناء تحديث شريط تقدم التحميل: {e}")
+            await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+
+def create_job_dir(job_id: int) -> str:
+    """
+    ينشئ مجلد العمل الخاص بمهمة داخل مجلد التنزيلات.
+    إذا بقي مجلد من محاولة سابقة لنفس المهمة (عامل توقف فجأة) يُحذف أولاً.
+    """
+    job_dir = os.path.join(DOWNLOAD_DIR, f"job-{job_id}")
+    remove_job_dir(job_dir)
+    os.makedirs(job_dir)
+    return job_dir
+
+def remove_job_dir(job_dir: str):
+    """
+    يحذف مجلد العمل بكل محتوياته (ملفات .part والأجزاء والناتج).
+    نعيد تسميته أولاً (عملية ذرية) حتى لا يبقى مجلد نصف محذوف باسمه الأصلي.
+    """
+    trash_dir = f"{job_dir}.trash"
+    try:
+        os.rename(job_dir, trash_dir)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logger.warning(f"تعذرت إعادة تسمية مجلد العمل {job_dir}: {e}")
+        trash_dir = job_dir
+    shutil.rmtree(trash_dir, ignore_errors=True)
+    logger.info(f"تم حذف مجلد العمل: {job_dir}")
+
+class StorageBudgetError(Exception):
+    """الحجم المطلوب أكبر من ميزانية القرص كاملة."""
+
+def _path_size(path: str) -> int:
+    """يحسب حجم ملف أو مجلد بكل محتوياته."""
+    if not os.path.isdir(path):
+        with contextlib.suppress(OSError):
+            return os.path.getsize(path)
+        return 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+class StorageManager:
+    """
+    يدير مساحة مجلد التنزيلات المشترك بين العمال: يحجز الحجم المتوقع لكل عملية في قاعدة البيانات قبل بدئها
+    (فالميزانية واحدة مهما كان عدد العمال)، ويجعل العمليات التي تتجاوز الميزانية تنتظر،
+    ويحذف الملفات اليتيمة (بقايا الأعطال وإعادة التشغيل).
+    """
+    def __init__(self, directory: str, budget: int):
+        self.directory = directory
+        self.budget = budget
+        # مجلدات العمليات الجارية أو المنتظرة في هذه العملية، لا يحذفها الفحص الدوري
+        self._active: set[str] = set()
+        self._condition = asyncio.Condition()
+        self.waiting = 0
+        self.rejected = 0
+        self.swept_files = 0
+        self.swept_bytes = 0
+
+    @property
+    def reserved(self) -> int:
+        """مجموع الحجوزات في كل العمال."""
+        return get_reserved_storage()
 
-def format_bytes(size):
-    """يحول البايت إلى صيغة مقروءة (KB, MB, GB) بدقة."""
-    if size is None or size <= 0:
-        return "غير معروف"
-    
-    # تحويل الحجم إلى عدد صحيح لتجنب الأخطاء مع الأرقام العشرية
-    size = int(size)
-    
-    power = 1024
-    power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB'}
-    
-    n = 0
-    while size >= power and n < len(power_labels) - 1:
-        size /= power
-        n += 1
-    
-    if n == 0:  # بايت
-        return f"{size:.0f} {power_labels[n]}"
-    elif size < 10:  # أرقام صغيرة
-        return f"{size:.2f} {power_labels[n]}"
-    elif size < 100:  # أرقام متوسطة
-        return f"{size:.1f} {power_labels[n]}"
-    else:  # أرقام كبيرة
-        return f"{size:.0f} {power_labels[n]}"
+    async def acquire(self, job_id: int, job_dir: str, size: int, on_wait=None):
+        """يحجز size بايت لمجلد عمل المهمة، وينتظر حتى تتوفر المساحة ضمن الميزانية."""
+        if size > self.budget:
+            self.rejected += 1
+            raise StorageBudgetError(f"الحجم المتوقع ({format_bytes(size)}) أكبر من مساحة التخزين المتاحة.")
+        self._active.add(os.path.normpath(job_dir))
+        if reserve_storage(job_id, job_dir, size, self.budget):
+            return
+        self.waiting += 1
+        try:
+            if on_wait:
+                await on_wait()
+            # التحرير في هذه العملية يوقظ الانتظار فوراً، وتحرير العمال الآخرين يظهر في الفحص الدوري
+            async with self._condition:
+                while not reserve_storage(job_id, job_dir, size, self.budget):
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._condition.wait(), JOB_POLL_INTERVAL)
+        finally:
+            self.waiting -= 1
 
-def generate_progress_bar(percentage: float) -> str:
-    """ينشئ شريط تقدم نصي."""
-    filled_length = int(10 * percentage / 100)
-    bar = '█' * filled_length + '░' * (10 - filled_length)
-    return f"[{bar}] {percentage:.1f}%"
+    async def release(self, job_dir: str):
+        """يحرر حجز مجلد العمل (آمن عند الاستدعاء أكثر من مرة)."""
+        self._active.discard(os.path.normpath(job_dir))
+        release_storage(job_dir)
+        async with self._condition:
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """عدادات هذه العملية؛ الحجوزات والميزانية مشتركة وتُقرأ من reserved و budget."""
+        return {
+            'waiting': self.waiting, 'rejected': self.rejected,
+            'swept_files': self.swept_files, 'swept_bytes': self.swept_bytes,
+        }
+
+    def disk_usage(self) -> int:
+        """الحجم الفعلي لمجلد التنزيلات."""
+        return _path_size(self.directory)
 
+    def sweep(self, max_age: float = ORPHAN_MAX_AGE) -> int:
+        """
+        يحذف ما لا ينتمي لعملية جارية وعمره أكبر من max_age
+        (max_age=0 عند بدء التشغيل: كل ما في المجلد بقايا تشغيل سابق).
+        مجلدات المهام التي يملك عقدها عامل آخر يتشارك نفس المجلد لا تُحذف.
+        """
+        delete_stale_reservations()
+        if not os.path.isdir(self.directory):
+            return 0
+        active = set(self._active)
+        active.update(os.path.normpath(os.path.join(self.directory, f"job-{job_id}")) for job_id in get_leased_job_ids())
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.normpath(path) in active:
+                continue
+            try:
+                if now - os.path.getmtime(path) < max_age:
+                    continue
+            except OSError:
+                continue
+            size = _path_size(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+            removed += 1
+            self.swept_bytes += size
+        self.swept_files += removed
+        if removed:
+            logger.info(f"تم حذف {removed} من الملفات اليتيمة في {self.directory}")
+        return removed
+
+    async def sweep_loop(self):
+        """فحص دوري للملفات اليتيمة طوال عمل البوت."""
+        while True:
+            await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception as e:
+                logger.error(f"فشل فحص الملفات اليتيمة: {e}")
+
+storage_manager = StorageManager(DOWNLOAD_DIR, DISK_BUDGET_MB * 1024 * 1024)
+
+def get_downloaded_path(info: dict | None) -> str | None:
+    """
+    يعيد مسار الملف النهائي من requested_downloads كما حدّثته المعالجات اللاحقة (التحويل، استخراج الصوت).
+    """
+    for download in reversed((info or {}).get('requested_downloads') or []):
+        filepath = download.get('filepath')
+        if filepath and os.path.isfile(filepath) and os.path.getsize(filepath) > 0:
+            return filepath
+    return None
 
 async def download_media(
     url: str, 
     media_type: str, 
     format_id: str, 
     status_message: Message, 
-    context: ContextTypes.DEFAULT_TYPE
+    context: ContextTypes.DEFAULT_TYPE,
+    job_dir: str,
+    info: dict | None = None
 ) -> tuple[str | None, str | None]:
     """
-    يقوم بتحميل الفيديو أو الصوت من الرابط المحدد.
+    يقوم بتحميل الفيديو أو الصوت من الرابط المحدد إلى مجلد العمل job_dir.
     يدعم جميع المواقع المتاحة في yt-dlp.
+    إذا تم تمرير info (أو كانت مخزنة مؤقتاً) وروابط البث فيها ما زالت صالحة،
+    يتم التحميل منها مباشرة بدون استخراج الصفحة مرة ثانية.
     """
     
-    if not os.path.exists('downloads'):
-        os.makedirs('downloads')
-    
-    opts = get_ydl_opts(media_type)
+    # الضغط يحمّل الفيديو كالمعتاد ثم يضغطه لاحقاً، لذا لا نحتاج SmartMp4PP ولا حد الحجم
+    opts = get_ydl_opts('video' if media_type == 'compress' else media_type, job_dir)
     
     # إضافة format_id إذا كان موجوداً
     # نتجاهل format_id عند طلب صوت، لأن yt-dlp سيختار أفضل مصدر صوتي بنفسه
     if media_type == 'video' and format_id:
         opts['format'] = format_id
+        # لا نضيع وقتاً في تحميل ملف لن يمكن رفعه
+        opts['max_filesize'] = BOT_API_UPLOAD_LIMIT
+    elif media_type == 'compress' and format_id:
+        opts['format'] = format_id
     # حالة خاصة لدمج الفيديو مع أفضل صوت
     elif ':' in format_id: # e.g. "video_id:audio_id"
         opts['format'] = format_id
 
+    # ربط تقدم yt-dlp برسالة الحالة
+    progress = DownloadProgress(status_message, asyncio.get_running_loop())
+    opts['progress_hooks'] = [progress.hook]
+    opts['postprocessor_hooks'] = [progress.postprocessor_hook]
+    progress_task = asyncio.create_task(progress.run())
+    start = time.monotonic()
+
     try:
         await status_message.edit_text("⏳ جارٍ التحميل... يرجى الانتظار")
-        # تشغيل yt-dlp في منفذ منفصل
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = await asyncio.get_event_loop().run_in_executor(
-                None, 
-                lambda: ydl.extract_info(url, download=True)
-            )
+        # نعيد استخدام المعلومات المستخرجة مسبقاً (الممررة أو من الذاكرة المؤقتة)
+        source_info = copy.deepcopy(info) if info else metadata_cache.get(url)
+        info = None
+        if source_info and stream_urls_valid(source_info):
+            try:
+                # نوقف ignoreerrors هنا حتى يظهر فشل الروابط المنتهية كاستثناء ونعيد الاستخراج
+                with create_ydl({**opts, 'ignoreerrors': False}, media_type) as ydl:
+                    info = await asyncio.get_event_loop().run_in_executor(
+                        None,
+                        lambda: ydl.process_ie_result(source_info, download=True)
+                    )
+            except yt_dlp.utils.DownloadError as e:
+                logging.warning(f"فشل التحميل من المعلومات المخزنة لـ {url}، سيتم إعادة استخراج الرابط: {e}")
+                info = None
+
+        if not info:
+            # تشغيل yt-dlp في منفذ منفصل
+            with create_ydl(opts, media_type) as ydl:
+                info = await asyncio.get_event_loop().run_in_executor(
+                    None, 
+                    lambda: ydl.extract_info(url, download=True)
+                )
+            if info:
+                # تحديث الذاكرة المؤقتة بالروابط الجديدة
+                metadata_cache.put(url, info)
             
         # تحديد النوع الفعلي للملف بعد التحويل
         final_media_type = media_type
         if media_type == 'audio_m4a' or media_type == 'audio_mp3':
             final_media_type = 'audio'
+        elif media_type == 'compress':
+            final_media_type = 'video'
 
+        progress_task.cancel()
+        # مقاييس مرحلتي التحميل والمعالجة اللاحقة
+        if info:
+            labels = {'extractor': info.get('extractor_key') or 'unknown', 'media_type': media_type}
+            download_time = max(time.monotonic() - start - progress.postprocess_time, 0.001)
+            metrics.observe('bot_stage_duration_seconds', download_time, stage='download', **labels)
+            metrics.observe('bot_stage_duration_seconds', progress.postprocess_time, stage='postprocess', **labels)
+            metrics.inc('bot_transfer_bytes_total', progress.downloaded_bytes, direction='download', **labels)
+            metrics.observe('bot_transfer_speed_bytes_per_second', progress.downloaded_bytes / download_time,
+                            direction='download', **labels)
+        # تسجيل مسار التحويل إلى mp4 والوقت الذي استغرقه لهذه العملية
+        for download in (info or {}).get('requested_downloads') or []:
+            if download.get('__smart_mp4'):
+                smart_mp4 = download['__smart_mp4']
+                logging.info(f"معالجة mp4 لـ {url}: {smart_mp4['mode']} في {smart_mp4['seconds']:.1f} ثانية")
         await status_message.edit_text(f"✅ اكتمل التحميل، جارٍ الرفع...")
         
         
@@ -283,43 +2122,17 @@ async def download_media(
             
         await status_message.edit_text(error_msg)
         return None, None
+    finally:
+        # التأكد من إيقاف محدّث التقدم في كل الحالات
+        progress_task.cancel()
     
-    # البحث عن الملف الذي تم تحميله
-    try:
-        # الحصول على اسم الملف المتوقع
-        expected_filename = ydl.prepare_filename(info)
-        expected_path = os.path.join('downloads', os.path.basename(expected_filename))
-        
-        # التحقق من وجود الملف بالامتداد المتوقع أولاً
-        if os.path.exists(expected_path):
-            return expected_path, final_media_type
-        
-        # إذا لم يوجد، ابحث عن أي ملف في مجلد التنزيلات
-        video_id = info.get('id', '') or 'unknown'
-        for filename in os.listdir('downloads'):
-            if video_id in filename:
-                filepath = os.path.join('downloads', filename)
-                if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-                    logging.info(f"تم العثور على الملف: {filepath}")
-                    return filepath, final_media_type
-        
-        # محاولة أخيرة: احصل على أحدث ملف في المجلد
-        download_files = [f for f in os.listdir('downloads') 
-                         if os.path.isfile(os.path.join('downloads', f))]
-        if download_files:
-            latest_file = max([os.path.join('downloads', f) for f in download_files], 
-                            key=os.path.getmtime)
-            if os.path.exists(latest_file) and os.path.getsize(latest_file) > 0:
-                logging.info(f"تم العثور على أحدث ملف: {latest_file}")
-                return latest_file, final_media_type
-        
-        logging.error("لم يتم العثور على أي ملفات محملة")
-        return None, None
-        
-    except Exception as e:
-        logging.error(f"خطأ في العثور على الملف المحمل: {e}")
+    # مسار الملف النهائي كما سجله yt-dlp بعد المعالجة
+    filepath = get_downloaded_path(info)
+    if not filepath:
+        logging.error(f"لم يتم العثور على الملف المحمل لـ {url}")
         return None, None
-    
+    return filepath, final_media_type
+
 def get_estimated_size(fmt: dict, duration: float | None) -> float:
     """
     إصدار مبسط لحساب الحجم بدون تعقيدات.
@@ -378,6 +2191,162 @@ class UploadProgress:
             except TelegramError as e:
                 if "Message is not modified" not in str(e):
                     logger.warning(f"خطأ أثناء تحديث شريط تقدم الرفع: {e}")
+
+class MetricsRequest(HTTPXRequest):
+    """HTTPXRequest يسجل زمن كل استدعاء لـ Bot API وأخطاءه حسب اسم الدالة."""
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_telegram_api_errors_total', method=api_method)
+            raise
+        finally:
+            metrics.observe('bot_telegram_api_duration_seconds', time.perf_counter() - start, method=api_method)
+        if code >= 400:
+            metrics.inc('bot_telegram_api_errors_total', method=api_method)
+        return code, payload
+
+# اسم دالة Bot API واسم حقل الملف لكل نوع
+_UPLOAD_METHODS = {
+    'video': ('sendVideo', 'video'),
+    'audio': ('sendAudio', 'audio'),
+    'document': ('sendDocument', 'document'),
+}
+
+# عميل HTTP مشترك لعمليات الرفع المتدفق (يُنشأ عند أول رفع)
+_upload_client: httpx.AsyncClient | None = None
+
+def _raise_for_api_error(status_code: int, data: dict):
+    """يحوّل رد خطأ من Bot API إلى استثناء تليجرام المناسب."""
+    description = data.get('description') or f"HTTP {status_code}"
+    retry_after = (data.get('parameters') or {}).get('retry_after')
+    if retry_after:
+        raise RetryAfter(retry_after)
+    if status_code == 403:
+        raise Forbidden(description)
+    if status_code == 400:
+        raise BadRequest(description)
+    raise TelegramError(description)
+
+def _multipart_request(fields: dict, field: str, filename: str, file_path: str, file_size: int,
+                       status_message: Message) -> dict:
+    """
+    يبني جسم multipart متدفقاً قطعة بقطعة (بذاكرة محدودة) مع عرض تقدم الرفع عبر UploadProgress.
+    """
+    progress = UploadProgress(file_path, status_message)
+    boundary = uuid.uuid4().hex
+    head = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    async def body():
+        yield head
+        loop = asyncio.get_running_loop()
+        sent = 0
+        with open(file_path, 'rb') as f:
+            while chunk := await loop.run_in_executor(None, f.read, UPLOAD_CHUNK_SIZE):
+                yield chunk
+                sent += len(chunk)
+                await progress.update_progress(sent, file_size)
+        yield tail
+
+    return {
+        'content': body(),
+        'headers': {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(head) + file_size + len(tail)),
+        },
+    }
+
+async def upload_media_file(bot: Bot, chat_id: int, file_type: str, file_path: str, status_message: Message) -> Message:
+    """
+    يرفع الملف إلى تليجرام بتدفق قطعة بقطعة (بذاكرة محدودة) بدلاً من قراءته كاملاً،
+    أو بمساره المحلي عند استخدام خادم Bot API محلي، مع مهلة تتناسب مع حجم الملف.
+    """
+    global _upload_client
+    method, field = _UPLOAD_METHODS.get(file_type, _UPLOAD_METHODS['document'])
+    file_size = os.path.getsize(file_path)
+    filename = os.path.basename(file_path).replace('"', '')
+
+    fields = {'chat_id': str(chat_id), 'caption': f"تم التحميل بواسطة @{bot.username}"}
+    if file_type == 'video':
+        fields['supports_streaming'] = 'true'
+
+    # مهلة الكتابة حسب أقل سرعة متوقعة، ومهلة القراءة تشمل معالجة تليجرام للملف
+    transfer_timeout = max(60.0, file_size / UPLOAD_MIN_THROUGHPUT)
+    timeout = httpx.Timeout(connect=30.0, read=transfer_timeout, write=transfer_timeout, pool=30.0)
+    if _upload_client is None:
+        _upload_client = httpx.AsyncClient()
+
+    if BOT_API_LOCAL_MODE:
+        # الخادم المحلي يقرأ الملف من القرص بنفسه، فلا حاجة لتدفق البايتات عبر البوت
+        fields[field] = Path(file_path).resolve().as_uri()
+        request = {'data': fields}
+    else:
+        request = _multipart_request(fields, field, filename, file_path, file_size, status_message)
+
+    start = time.monotonic()
+    try:
+        response = await _upload_client.post(f"{bot.base_url}/{method}", timeout=timeout, **request)
+    except httpx.HTTPError as e:
+        metrics.inc('bot_telegram_api_errors_total', method=method)
+        raise NetworkError(f"فشل الاتصال أثناء الرفع: {e}") from e
+    elapsed = time.monotonic() - start
+    metrics.observe('bot_telegram_api_duration_seconds', elapsed, method=method)
+
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if not data.get('ok'):
+        metrics.inc('bot_telegram_api_errors_total', method=method)
+        _raise_for_api_error(response.status_code, data)
+
+    logger.info(
+        f"تم رفع {filename} ({format_bytes(file_size)}) في {elapsed:.1f} ثانية "
+        f"بمعدل {format_bytes(file_size / elapsed if elapsed else file_size)}/s"
+        f"{' (مسار محلي)' if BOT_API_LOCAL_MODE else ''}"
+    )
+    return Message.de_json(data['result'], bot)
+
+async def close_upload_client():
+    """يغلق عميل الرفع عند إيقاف البوت."""
+    global _upload_client
+    if _upload_client is not None:
+        await _upload_client.aclose()
+        _upload_client = None
+
+async def send_media_file(bot: Bot, chat_id: int, file_type: str, media, **kwargs) -> Message:
+    """
+    يرسل ملفاً (أو file_id مخزناً) بالطريقة المناسبة لنوعه: فيديو أو صوت أو مستند.
+    """
+    caption = f"تم التحميل بواسطة @{bot.username}"
+    if file_type == 'video':
+        return await bot.send_video(chat_id=chat_id, video=media, caption=caption, supports_streaming=True, **kwargs)
+    elif file_type == 'audio':
+        return await bot.send_audio(chat_id=chat_id, audio=media, caption=caption, **kwargs)
+    return await bot.send_document(chat_id=chat_id, document=media, caption=caption, **kwargs)
+
+def get_sent_file_id(message: Message) -> tuple[str | None, str | None]:
+    """
+    يستخرج file_id ونوع الملف من الرسالة التي أعادها تليجرام بعد الرفع.
+    قد يعيد تليجرام الفيديو كمستند إذا لم يتمكن من معالجته كفيديو.
+    """
+    if message.video:
+        return message.video.file_id, 'video'
+    if message.audio:
+        return message.audio.file_id, 'audio'
+    if message.document:
+        return message.document.file_id, 'document'
+    return None, None
 # ==============================================================================
 # ٤. منطق البوت الرئيسي (ملف bot.py سابقاً)
 # ==============================================================================
@@ -390,17 +2359,137 @@ logger = logging.getLogger(__name__)
 
 # --- دوال مساعدة ---
 
+class MembershipCache:
+    """
+    ذاكرة مؤقتة لنتائج التحقق من الاشتراك لكل (قناة، مستخدم)،
+    بمدة صلاحية مختلفة للنتائج الإيجابية والسلبية.
+    """
+    # عند تجاوز هذا العدد من المدخلات نحذف المنتهية صلاحيتها
+    _PRUNE_THRESHOLD = 50000
+
+    def __init__(self, positive_ttl: int, negative_ttl: int):
+        self._positive_ttl = positive_ttl
+        self._negative_ttl = negative_ttl
+        self._entries: dict[tuple[str, int], tuple[bool, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, channel_id: str, user_id: int) -> bool | None:
+        """يعيد النتيجة المخزنة أو None إذا لم تكن موجودة أو انتهت صلاحيتها."""
+        entry = self._entries.get((channel_id, user_id))
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, channel_id: str, user_id: int, is_member: bool):
+        """يخزن نتيجة التحقق."""
+        now = time.monotonic()
+        if len(self._entries) >= self._PRUNE_THRESHOLD:
+            self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+        ttl = self._positive_ttl if is_member else self._negative_ttl
+        self._entries[(channel_id, user_id)] = (is_member, now + ttl)
+
+    def flush(self):
+        """يمسح كل النتائج المخزنة (عند تغيير القناة الإجبارية مثلاً)."""
+        self._entries.clear()
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_TTL, MEMBERSHIP_NEGATIVE_TTL)
+
+class PendingMenus:
+    """
+    قوائم الصيغ المعروضة بانتظار اختيار المستخدم، محفوظة في chat_data بشكل مختصر
+    (format_id والحجم والنوع لكل خيار فقط) مع مدة صلاحية وحد أقصى لكل محادثة يُحذف فيه الأقدم استخداماً.
+    المعلومات الكاملة للرابط تبقى في metadata_cache، ويُعاد استخراجها عند التحميل إذا انتهت.
+    """
+    _KEY = 'pending_menus'
+
+    def __init__(self, ttl: int, max_per_chat: int):
+        self._ttl = ttl
+        self._max_per_chat = max_per_chat
+        self.expired = 0
+        self.evicted = 0
+
+    def _menus(self, chat_data: dict) -> OrderedDict:
+        """يعيد قوائم المحادثة بعد حذف المنتهية صلاحيتها."""
+        menus = chat_data.get(self._KEY)
+        if menus is None:
+            menus = chat_data[self._KEY] = OrderedDict()
+        now = time.monotonic()
+        for message_id in [k for k, menu in menus.items() if menu['expires'] <= now]:
+            del menus[message_id]
+            self.expired += 1
+        return menus
+
+    def put(self, chat_data: dict, message_id: int, menu: dict):
+        menus = self._menus(chat_data)
+        menu['expires'] = time.monotonic() + self._ttl
+        menus[message_id] = menu
+        menus.move_to_end(message_id)
+        while len(menus) > self._max_per_chat:
+            menus.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, chat_data: dict, message_id: int) -> dict | None:
+        menus = self._menus(chat_data)
+        menu = menus.get(message_id)
+        if menu:
+            menus.move_to_end(message_id)
+        return menu
+
+    def pop(self, chat_data: dict, message_id: int):
+        self._menus(chat_data).pop(message_id, None)
+
+    def sweep(self, application: Application) -> int:
+        """
+        يحذف القوائم المنتهية من كل المحادثات، لا من المحادثة التي تتفاعل الآن فقط،
+        ويحذف chat_data التي أصبحت فارغة حتى لا تنمو الذاكرة مع عدد المحادثات.
+        """
+        expired_before = self.expired
+        for chat_id, chat_data in list(application.chat_data.items()):
+            if self._KEY not in chat_data:
+                continue
+            if not self._menus(chat_data):
+                del chat_data[self._KEY]
+            if not chat_data:
+                application.drop_chat_data(chat_id)
+        return self.expired - expired_before
+
+    async def sweep_loop(self, application: Application):
+        """فحص دوري للقوائم المنتهية طوال عمل البوت."""
+        while True:
+            await asyncio.sleep(MENU_SWEEP_INTERVAL)
+            try:
+                removed = self.sweep(application)
+                if removed:
+                    logger.info(f"تم حذف {removed} من قوائم الصيغ المنتهية")
+            except Exception as e:
+                logger.error(f"فشل فحص قوائم الصيغ المنتهية: {e}")
+
+pending_menus = PendingMenus(MENU_TTL, MENU_MAX_PER_CHAT)
+
 async def is_user_subscribed(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     للتحقق مما إذا كان المستخدم مشتركًا في القناة الإجبارية.
+    النتيجة تُخزن مؤقتاً لتجنب استدعاء get_chat_member مع كل رسالة.
     """
     channel_id = get_setting('force_channel')
     if not channel_id:
         return True  # لا توجد قناة إجبارية، لذا نعتبره مشتركًا
 
+    cached = membership_cache.get(channel_id, user_id)
+    if cached is not None:
+        return cached
+
     try:
         member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in ['member', 'administrator', 'creator']
+        membership_cache.put(channel_id, user_id, is_member)
+        return is_member
     except TelegramError as e:
         logger.error(f"خطأ في التحقق من اشتراك المستخدم {user_id} في القناة {channel_id}: {e}")
         return False
@@ -440,6 +2529,38 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_html(help_text)
 
+async def show_playlist_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, status_message: Message, url: str, info: dict):
+    """يعرض عدد عناصر قائمة التشغيل (بصيغة compact_playlist_info) وخيارات تحميلها كاملة."""
+    entries = info['playlist_entries']
+    if not entries:
+        await status_message.edit_text("❌ لم يتم العثور على عناصر قابلة للتحميل في قائمة التشغيل.")
+        return
+
+    original_message_id = update.message.message_id
+    title = info.get('title') or 'قائمة تشغيل'
+    pending_menus.put(context.chat_data, original_message_id, {
+        'url': url,
+        'playlist': True,
+        'title': title[:100],
+        'entries': entries,
+    })
+
+    count_text = f"{len(entries)}"
+    total = info.get('playlist_count')
+    if total and total > len(entries):
+        count_text += f" (أول {len(entries)} من {total})"
+    keyboard = [
+        [InlineKeyboardButton(f"🎬 تحميل الكل فيديو (حتى {PLAYLIST_MAX_HEIGHT}p)", callback_data=f"playlist:video:{original_message_id}")],
+        [InlineKeyboardButton("🎵 تحميل الكل صوت M4A", callback_data=f"playlist:audio_m4a:{original_message_id}")],
+        [InlineKeyboardButton("🎵 تحميل الكل صوت MP3", callback_data=f"playlist:audio_mp3:{original_message_id}")],
+        [InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel:{original_message_id}")],
+    ]
+    await status_message.edit_text(
+        f"📃 <b>{title}</b>\n🔢 عدد العناصر: {count_text}\n\nاختر صيغة تحميل القائمة:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=ParseMode.HTML
+    )
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # التحقق من وجود مستخدم مرتبط بالرسالة
     if not update.effective_user:
@@ -468,29 +2589,53 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status_message = await update.message.reply_text("⏳ جارٍ جلب معلومات الفيديو...")
 
     try:
-            info_opts = get_ydl_opts('video')
-            info_opts.update({'extract_flat': False, 'ignoreerrors': True})
-            
-            # جلب المعلومات فقط بدون تحميل
-            with yt_dlp.YoutubeDL(info_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-            
+            # نستخدم المعلومات المخزنة مؤقتاً إن وجدت لتجنب استخراج الصفحة من جديد
+            info = metadata_cache.get(url)
             if not info:
-                await status_message.edit_text("❌ فشل جلب معلومات الفيديو. قد يكون المحتوى خاصاً، محذوفاً، أو يتطلب تسجيل الدخول.")
-                return
-            # إذا كان الرابط لقائمة تشغيل، خذ أول فيديو
-            if '_type' in info and info['_type'] == 'playlist':
-                if info['entries']:
-                    info = info['entries'][0]
-                else:
-                    await status_message.edit_text("❌ قائمة التشغيل فارغة")
+                # جلب المعلومات فقط بدون تحميل، في مجمع عمال منفصل حتى لا تتوقف حلقة الأحداث
+                extract_start = time.monotonic()
+                try:
+                    info = await extraction_pool.extract(url)
+                except Exception:
+                    metrics.inc('bot_extractions_total', result='error')
+                    raise
+                metrics.inc('bot_extractions_total', result='ok' if info else 'failed')
+                metrics.observe(
+                    'bot_stage_duration_seconds', time.monotonic() - extract_start,
+                    stage='extract', extractor=(info or {}).get('extractor_key') or 'unknown', media_type='metadata'
+                )
+                
+                if not info:
+                    await status_message.edit_text("❌ فشل جلب معلومات الفيديو. قد يكون المحتوى خاصاً، محذوفاً، أو يتطلب تسجيل الدخول.")
                     return
+                if info.get('_type') == 'playlist':
+                    entries = [entry for entry in info.get('entries') or [] if entry]
+                    if not entries:
+                        await status_message.edit_text("❌ قائمة التشغيل فارغة")
+                        return
+                    # قائمة بعنصر واحد (مثل منشور فيه فيديو واحد) تُعامل كفيديو عادي
+                    if len(entries) == 1:
+                        info = entries[0]
+                        if not info.get('formats'):
+                            entry_urls = get_playlist_entries({'entries': entries})
+                            info = await extraction_pool.extract(entry_urls[0]['url']) if entry_urls else None
+                            if not info:
+                                await status_message.edit_text("❌ فشل جلب معلومات الفيديو. قد يكون المحتوى خاصاً، محذوفاً، أو يتطلب تسجيل الدخول.")
+                                return
+                    else:
+                        info = compact_playlist_info(info)
+                metadata_cache.put(url, info)
+
+            if info.get('_type') == 'playlist':
+                await show_playlist_menu(update, context, status_message, url, info)
+                return
 
             duration = info.get('duration')
 
             # --- منطق جديد دقيق لحساب الأحجام ---
             keyboard = []
-            available_formats = {} # لتخزين أفضل صيغة لكل دقة
+            # الخيارات المعروضة بشكل مختصر: المفتاح ('audio' أو 'auto' أو الدقة) -> format_id والحجم والنوع
+            available_formats = {}
             
             # --- منطق محسن للبحث عن الصوت ---
             best_audio = None
@@ -501,7 +2646,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
             
             if audio_formats:
-                best_audio = max(audio_formats, 
+                # نفضّل أفضل صيغة صوت يتسع حجمها ضمن الحد
+                fitting_audio = [f for f in audio_formats
+                                 if 0 < (get_estimated_size(f, duration) or 0) <= BOT_API_UPLOAD_LIMIT]
+                best_audio = max(fitting_audio or audio_formats, 
                             key=lambda x: x.get('abr', 0) or x.get('tbr', 0) or 0)
             else:
                 # 2. إذا لم يوجد صوت منفصل، ابحث عن أفضل صيغة مدمجة (فيديو+صوت) لاستخراج الصوت منها
@@ -533,113 +2681,470 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     keyboard.append([InlineKeyboardButton(f"🎵 صوت MP3 ({size_str})", callback_data=f"download:audio_mp3:audio:{update.message.message_id}")])
                     
                     # تخزين معلومات الصوت. نستخدم مفتاح 'audio' عام
-                    # لأن المصدر هو نفسه لكلا الصيغتين
-                    available_formats['audio'] = best_audio 
-                    # لا نحتاج لتخزين حجم الصوت لأنه ثابت
-                    # ولا نحتاج لتخزين format_id لأنه سيتم تحديده من قبل yt-dlp
+                    # لأن المصدر هو نفسه لكلا الصيغتين (إذا كان فيديو مدمجاً، يستخرج yt-dlp الصوت منه)
+                    available_formats['audio'] = {
+                        'format_id': best_audio.get('format_id') or 'best',
+                        'size': int(audio_size),
+                        'kind': 'audio',
+                    }
+
+
+            # --- منطق دقيق للفيديو: أفضل زوج يتسع ضمن الحد لكل دقة ---
+            video_plans = plan_video_formats(info.get('formats', []), duration, BOT_API_UPLOAD_LIMIT)
+
+            # زر "تلقائي" لأفضل جودة يتسع حجمها ضمن الحد
+            auto_format = auto_format_selector(video_plans, BOT_API_UPLOAD_LIMIT)
+            if auto_format:
+                best_fit = next(plan for plan in video_plans if plan['fits'])
+                keyboard.append([InlineKeyboardButton(
+                    f"✨ تلقائي: أفضل جودة مناسبة ({best_fit['height']}p، {format_bytes(best_fit['calculated_size'])})",
+                    callback_data=f"download:video:auto:{update.message.message_id}"
+                )])
+                available_formats['auto'] = {
+                    'format_id': auto_format,
+                    'size': int(best_fit['calculated_size']),
+                    'kind': 'video',
+                }
+
+            for plan in video_plans:
+                height = plan['height']
+                size_str = format_bytes(plan['calculated_size'])
+                
+                # التحقق من حجم الملف
+                if not plan['fits'] and duration:
+                    # عرض خيار الضغط ليناسب الحد بدلاً من زر معطل
+                    keyboard.append([InlineKeyboardButton(f"🗜️ فيديو {height}p ({size_str}) - ضغط ليناسب الحد", callback_data=f"download:compress:{height}:{update.message.message_id}")])
+                elif not plan['fits']:
+                    keyboard.append([InlineKeyboardButton(f"🎬 فيديو {height}p ({size_str}) - حجم كبير", callback_data="noop")])
+                else:
+                    keyboard.append([InlineKeyboardButton(f"🎬 فيديو {height}p ({size_str})", callback_data=f"download:video:{height}:{update.message.message_id}")])
+                if plan['fits'] or duration:
+                    available_formats[str(height)] = {
+                        'format_id': plan.get('combined_format') or plan['format_id'],
+                        'size': int(plan['calculated_size'] or 0),
+                        'kind': 'video',
+                    }
+
+            if not keyboard:
+                error_text = "❌ عذراً، لم يتم العثور على صيغ تحميل مدعومة لهذا الرابط."
+                if info.get('live_status') == 'is_live':
+                    error_text += "\n\n⚠️ يبدو أن هذا بث مباشر. لا يمكن تحميل البث المباشر حالياً."
+                elif info.get('age_limit', 0) > 0:
+                    error_text += "\n\n🔞 المحتوى مقيد بالفئة العمرية وقد يتطلب تسجيل الدخول."
+                elif not info.get('formats'):
+                    error_text += "\n\n❓ قد يكون المحتوى خاصاً أو تم حذفه."
+                
+                await status_message.edit_text(error_text)
+                return
+
+            # تخزين الخيارات المختصرة في chat_data (المعلومات الكاملة في metadata_cache)
+            original_message_id = update.message.message_id
+            pending_menus.put(context.chat_data, original_message_id, {
+                'url': url, 
+                'extractor': info.get('extractor_key') or info.get('extractor'),
+                'video_id': info.get('id'),
+                'formats': available_formats,
+                'duration': duration,
+            })
+
+            # إضافة زر الإلغاء
+            keyboard.append([InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel:{original_message_id}")])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            title = info.get('title', 'فيديو')
+            duration_str = format_duration(duration) if duration else "غير معروف"
+            
+            await status_message.edit_text(
+                f"<b>{title}</b>\n⏱️ المدة: {duration_str}\n\nاختر الصيغة:", 
+                reply_markup=reply_markup, 
+                parse_mode=ParseMode.HTML
+            )
+
+    except Exception as e:
+        logging.error(f"فشل في جلب معلومات الفيديو من {url}: {e}")
+        
+        # رسائل خطأ محددة
+        error_msg = "❌ حدث خطأ أثناء جلب المعلومات"
+        if "Unsupported URL" in str(e):
+            error_msg = "❌ هذا الرابط غير مدعوم"
+        elif "No video formats found" in str(e):
+            error_msg = "❌ لم يتم العثور على صيغ فيديو"
+        elif "Private video" in str(e):
+            error_msg = "❌ الفيديو خاص أو محمي"
+        elif "Sign in" in str(e):
+            error_msg = "❌ يتطلب تسجيل الدخول"
+        else:
+            error_msg = f"❌ حدث خطأ: {str(e)}"
+            
+        await status_message.edit_text(error_msg)
+
+class SharedStatus:
+    """
+    رسالة حالة مشتركة: تعدّل رسالة صاحب التحميل وتنسخ النص نفسه إلى رسائل
+    المستخدمين الذين طلبوا نفس الملف وانضموا إلى التحميل الجاري.
+    فشل تعديل أي رسالة (محذوفة، حد المعدل...) يُسجَّل فقط ولا يوقف المهمة.
+    """
+    def __init__(self, message: Message):
+        self._message = message
+        self._followers: list[Message] = []
+        self.chat_id = message.chat_id
+        self.last_text = None
+
+    def attach(self, message: Message):
+        self._followers.append(message)
+
+    async def edit_text(self, text: str, **kwargs):
+        self.last_text = text
+        for message in [self._message, *self._followers]:
+            try:
+                await message.edit_text(text, **kwargs)
+            except TelegramError as e:
+                if "Message is not modified" not in str(e):
+                    logger.warning(f"خطأ أثناء تحديث رسالة حالة مشتركة: {e}")
+
+def playlist_cancel_markup(playlist_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🛑 إلغاء القائمة", callback_data=f"playlist_cancel:{playlist_id}")]])
+
+def playlist_summary_text(playlist: dict, counts: dict[str, int]) -> str:
+    """ملخص تقدم قائمة التشغيل أو نتيجتها النهائية."""
+    done, failed = counts.get('done', 0), counts.get('failed', 0)
+    if playlist['status'] == 'cancelled':
+        return f"🛑 تم إلغاء قائمة التشغيل: {playlist['title']}\n📦 تم إرسال {done} من {playlist['total']}"
+    if playlist['status'] == 'done':
+        text = f"✅ اكتملت قائمة التشغيل: {playlist['title']}\n📦 تم إرسال {done} من {playlist['total']}"
+        return text + (f"\n❌ فشل {failed}" if failed else "")
+    return (
+        f"📃 {playlist['title']}\n"
+        f"✅ {done}/{playlist['total']} | ❌ {failed} | 🕒 متبقٍ {playlist['total'] - done - failed}"
+    )
+
+class PlaylistStatus:
+    """
+    رسالة الحالة المجمعة لقائمة تشغيل: كل عنصر يكتب تقدمه تحت ملخص القائمة، مع إبقاء زر الإلغاء.
+    فشل التعديل يُسجَّل فقط ولا يوقف العنصر، كما في SharedStatus.
+    """
+    def __init__(self, message: Message, playlist: dict, position: int):
+        self._message = message
+        self._playlist = playlist
+        self._position = position
+        self.chat_id = message.chat_id
+        self.last_text = None
+
+    async def edit_text(self, text: str, **kwargs):
+        self.last_text = text
+        summary = playlist_summary_text(self._playlist, get_playlist_counts(self._playlist['id']))
+        try:
+            await self._message.edit_text(
+                f"{summary}\n\n▶️ {self._position}/{self._playlist['total']}: {text}",
+                reply_markup=playlist_cancel_markup(self._playlist['id']),
+                **kwargs
+            )
+        except TelegramError as e:
+            if "Message is not modified" not in str(e):
+                logger.warning(f"خطأ أثناء تحديث رسالة قائمة التشغيل: {e}")
+
+async def update_playlist_message(bot: Bot, playlist_id: int):
+    """
+    بعد انتهاء أحد عناصر القائمة: إذا انتهت القائمة كلها (أو أُلغيت) تُستبدل رسالة الحالة بالملخص النهائي.
+    """
+    playlist = finish_playlist(playlist_id) or get_playlist(playlist_id)
+    if not playlist or playlist['status'] == 'running':
+        return
+    with contextlib.suppress(TelegramError):
+        await job_message(bot, playlist['chat_id'], playlist['status_message_id']).edit_text(
+            playlist_summary_text(playlist, get_playlist_counts(playlist_id))
+        )
+
+async def wait_playlist_turn(job: dict, status: PlaylistStatus):
+    """
+    ينتظر انتهاء عناصر القائمة السابقة قبل إرسال هذا العنصر حتى تصل بالترتيب،
+    بينما يستمر تحميل العناصر التالية.
+    """
+    if not playlist_entries_pending_before(job['playlist_id'], job['position']):
+        return
+    await status.edit_text("⏸️ اكتمل التحميل، بانتظار إرسال العناصر السابقة...")
+    while playlist_entries_pending_before(job['playlist_id'], job['position']):
+        await asyncio.sleep(PLAYLIST_POLL_INTERVAL)
+
+def worker_stats_snapshot(active_jobs: int = 0, downloading: int = 0) -> dict:
+    """إحصائيات هذه العملية التي ينشرها العامل لتعرضها لوحة الأدمن."""
+    return {
+        'jobs': active_jobs,
+        'downloading': downloading,
+        'compress': compression_pool.stats(),
+        'transcode': copy.deepcopy(TRANSCODE_STATS),
+        'storage': storage_manager.stats(),
+        'metrics': metrics.snapshot(),
+    }
+
+def sum_worker_stats(snapshots: list[dict]) -> dict:
+    """يجمع إحصائيات كل العمال في قاموس واحد بنفس بنية worker_stats_snapshot."""
+    def add(total: dict, stats: dict, factor: int):
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                add(total.setdefault(key, {}), value, factor)
+            else:
+                total[key] = total.get(key, 0) + value * factor
+
+    # نبدأ ببنية صفرية حتى تكون كل المفاتيح موجودة ولو لم يعمل أي عامل
+    total = {}
+    add(total, worker_stats_snapshot(), 0)
+    for stats in snapshots:
+        add(total, stats, 1)
+    return total
+
+def job_message(bot: Bot, chat_id: int, message_id: int) -> Message:
+    """
+    ينشئ كائن رسالة لتعديل أو حذف رسالة حالة أرسلتها عملية أخرى (واجهة البوت) انطلاقاً من معرفاتها فقط.
+    """
+    message = Message(message_id, datetime.now(timezone.utc), Chat(chat_id, Chat.PRIVATE))
+    message.set_bot(bot)
+    return message
+
+async def _run_job(bot: Bot, job: dict, status_message: Message, status: SharedStatus,
+                   release_slot=None) -> tuple[tuple[str, str] | None, str | None]:
+    """
+    خط معالجة المهمة: حجز المساحة، التحميل، الضغط عند الطلب، ثم الرفع.
+    يعيد (file_id ونوعه أو None، رسالة الخطأ أو None) بعد إبلاغ صاحب المهمة بالنتيجة.
+    عناصر قوائم التشغيل تنتظر دورها قبل الرفع، ونتيجتها تظهر في رسالة القائمة المشتركة بدلاً من حذفها.
+    release_slot (اختياري) يحرر منفذ التحميل في العامل بمجرد انتهاء التحميل.
+    """
+    media_type = job['media_type']
+    labels = {'extractor': job['extractor'] or 'unknown', 'media_type': media_type}
+    in_playlist = job['playlist_id'] is not None
+    result_message = status if in_playlist else status_message
+
+    async def show_storage_wait():
+        await status.edit_text("💾 بانتظار توفر مساحة تخزين...")
+
+    # حجز المساحة المتوقعة: الملف المحمل، ونسخة ثانية عند الضغط أو التحويل إلى mp3
+    estimated_size = job['size'] or DEFAULT_SIZE_ESTIMATE
+    if media_type in ('compress', 'audio_mp3'):
+        estimated_size += min(estimated_size, BOT_API_UPLOAD_LIMIT)
+
+    job_dir = create_job_dir(job['id'])
+    try:
+        await status.edit_text("⏳ جارٍ التحميل..." if job['attempts'] <= 1 else "🔁 إعادة محاولة التحميل...")
+
+        # عنصر قائمة سبق رفعه بنفس الصيغة: نعيد إرسال file_id في دوره بدون تحميل
+        cached = get_cached_file(job['extractor'], job['video_id'], media_type, job['format_id']) \
+            if in_playlist and job['extractor'] and job['video_id'] else None
+        if cached:
+            if release_slot:
+                release_slot()
+            await wait_playlist_turn(job, status)
+            try:
+                await send_media_file(bot, job['chat_id'], cached[1], cached[0])
+                return cached, None
+            except TelegramError as e:
+                logger.warning(f"فشل إعادة إرسال file_id المخزن لـ {job['extractor']}:{job['video_id']}: {e}")
+                delete_cached_file(job['extractor'], job['video_id'], media_type, job['format_id'])
+
+        await storage_manager.acquire(job['id'], job_dir, int(estimated_size), show_storage_wait)
+
+        # معلومات الرابط المستخرجة عند عرض القائمة: يحمّل العامل منها مباشرة دون استخراج الصفحة مرة ثانية
+        filepath, downloaded_type = await download_media(
+            job['url'],
+            media_type,
+            job['format_id'],
+            status,
+            None,
+            job_dir,
+            json.loads(job['info']) if job['info'] else None
+        )
+        if release_slot:
+            release_slot()
+        if not filepath:
+            await result_message.edit_text("❌ فشل التحميل. حاول مرة أخرى.")
+            return None, "download failed"
+
+        if media_type == 'compress':
+            await status.edit_text(
+                f"🗜️ جارٍ ضغط الفيديو ليناسب حد الرفع... (في الطابور: {compression_pool.queued})"
+            )
+            compress_start = time.monotonic()
+            filepath = await compression_pool.compress(filepath, job['duration'], BOT_API_UPLOAD_LIMIT)
+            metrics.observe('bot_stage_duration_seconds', time.monotonic() - compress_start, stage='compress', **labels)
 
+        if in_playlist:
+            await wait_playlist_turn(job, status)
+        await status.edit_text(f"⬆️ جارٍ رفع الـ {downloaded_type}...")
 
-            # --- منطق دقيق للفيديو ---
-            video_formats_by_height = {} # قاموس لتخزين أفضل صيغة لكل دقة
-            
-            for f in info.get('formats', []):
-                # تجاهل الصيغ التي لا تحتوي على فيديو
-                if f.get('vcodec') == 'none' or not f.get('height'):
-                    continue
+        # رفع الملف بالتدفق مع شريط تقدم الرفع
+        upload_start = time.monotonic()
+        upload_size = os.path.getsize(filepath)
+        sent_message = await upload_media_file(bot, job['chat_id'], downloaded_type, filepath, status)
+        upload_time = max(time.monotonic() - upload_start, 0.001)
+        metrics.observe('bot_stage_duration_seconds', upload_time, stage='upload', **labels)
+        metrics.inc('bot_transfer_bytes_total', upload_size, direction='upload', **labels)
+        metrics.observe('bot_transfer_speed_bytes_per_second', upload_size / upload_time, direction='upload', **labels)
 
-                height = f['height']
-                current_format = video_formats_by_height.get(height)
-                
-                # اختيار أفضل صيغة لكل دقة
-                if not current_format or _is_better_format(f, current_format):
-                    video_formats_by_height[height] = f
+        # تخزين file_id لإعادة استخدامه في الطلبات المطابقة
+        sent_file_id, sent_type = get_sent_file_id(sent_message)
+        if sent_file_id and job['extractor'] and job['video_id']:
+            save_cached_file(job['extractor'], job['video_id'], media_type, job['format_id'], sent_file_id, sent_type)
 
-            # فرز الدقات المتاحة من الأعلى إلى الأقل
-            sorted_heights = sorted(video_formats_by_height.keys(), reverse=True)
+        # حذف الرسالة المؤقتة بعد الرفع بنجاح (رسالة القائمة تبقى لبقية العناصر)
+        if not in_playlist:
+            with contextlib.suppress(TelegramError):
+                await status_message.delete()
+        return ((sent_file_id, sent_type) if sent_file_id else None), None
 
-            for height in sorted_heights:
-                best_format = video_formats_by_height[height]
-                
-                # حساب الحجم الإجمالي (فيديو + صوت إذا لزم الأمر)
-                total_size = 0
-                
-                if best_format.get('acodec') == 'none' and best_audio and not audio_source_is_video:
-                    # صيغة فيديو فقط، نضيف حجم الصوت
-                    video_size = get_estimated_size(best_format, duration) or 0
-                    audio_size = get_estimated_size(best_audio, duration) or 0
-                    total_size = video_size + audio_size
-                    best_format['combined_format'] = f"{best_format['format_id']}+{best_audio['format_id']}"
-                else:
-                    # صيغة مدمجة (فيديو+صوت)
-                    total_size = get_estimated_size(best_format, duration) or 0
-                
-                size_str = format_bytes(total_size)
-                
-                # التحقق من حجم الملف
-                if total_size > 0 and total_size > BOT_API_UPLOAD_LIMIT:
-                    keyboard.append([InlineKeyboardButton(f"🎬 فيديو {height}p ({size_str}) - حجم كبير", callback_data="noop")])
-                elif total_size > 0:
-                    # إذا كان الحجم مناسباً، يتم إضافة الزر
-                    # تخزين الحجم المحسوب للاستخدام لاحقاً
-                    best_format['calculated_size'] = total_size
-                    keyboard.append([InlineKeyboardButton(f"🎬 فيديو {height}p ({size_str})", callback_data=f"download:video:{height}:{update.message.message_id}")])
-                    available_formats[height] = best_format
+    except TelegramError as e:
+        error_message = f"❌ فشل الرفع: {str(e)}"
+        if "File too large" in str(e):
+            error_message += f"\n\nالملف كبير جداً (الحد الأقصى {format_bytes(BOT_API_UPLOAD_LIMIT)})."
+        error = str(e)
+    except CompressionError as e:
+        error_message = error = f"❌ فشل ضغط الفيديو: {str(e)}"
+    except StorageBudgetError as e:
+        error_message = error = f"❌ {str(e)}"
+    except Exception as e:
+        logger.error(f"خطأ غير متوقع في المهمة {job['id']}: {e}", exc_info=True)
+        error_message = error = f"❌ حدث خطأ غير متوقع: {str(e)}"
+    finally:
+        # تنظيف مجلد العمل بكل ملفاته المؤقتة ثم تحرير المساحة المحجوزة
+        remove_job_dir(job_dir)
+        await storage_manager.release(job_dir)
 
-            if not keyboard:
-                error_text = "❌ عذراً، لم يتم العثور على صيغ تحميل مدعومة لهذا الرابط."
-                if info.get('live_status') == 'is_live':
-                    error_text += "\n\n⚠️ يبدو أن هذا بث مباشر. لا يمكن تحميل البث المباشر حالياً."
-                elif info.get('age_limit', 0) > 0:
-                    error_text += "\n\n🔞 المحتوى مقيد بالفئة العمرية وقد يتطلب تسجيل الدخول."
-                elif not info.get('formats'):
-                    error_text += "\n\n❓ قد يكون المحتوى خاصاً أو تم حذفه."
-                
-                await status_message.edit_text(error_text)
+    with contextlib.suppress(TelegramError):
+        await result_message.edit_text(error_message)
+    return None, error
+
+async def deliver_attached_jobs(bot: Bot, jobs: list[dict]):
+    """
+    يرسل نتيجة المهمة الأصلية (file_id) إلى أصحاب المهام المرتبطة بها، أو يبلغهم بالفشل.
+    """
+    for job in jobs:
+        status_message = job_message(bot, job['chat_id'], job['status_message_id'])
+        try:
+            if job['file_id']:
+                await send_media_file(bot, job['chat_id'], job['file_type'], job['file_id'])
+                await status_message.delete()
+            else:
+                await status_message.edit_text("❌ فشل التحميل. حاول مرة أخرى.")
+        except TelegramError as e:
+            logger.warning(f"فشل تسليم المهمة المرتبطة {job['id']}: {e}")
+
+async def process_job(bot: Bot, job: dict, worker_id: str, release_slot=None):
+    """
+    ينفذ مهمة مستلمة من الطابور مع تجديد عقدها دورياً. إذا استولى عامل آخر على المهمة
+    (انتهى العقد) تتوقف هنا، وعند إيقاف العامل تعود المهمة إلى الطابور فوراً.
+    release_slot يُمرر إلى _run_job ليحرر منفذ التحميل قبل الضغط والرفع.
+    """
+    labels = {'extractor': job['extractor'] or 'unknown', 'media_type': job['media_type']}
+    if job['attempts'] == 1:
+        metrics.observe('bot_stage_duration_seconds', time.time() - job['created_at'], stage='queue_wait', **labels)
+    status_message = job_message(bot, job['chat_id'], job['status_message_id'])
+    renew_interval = JOB_LEASE_SECONDS / 3
+    attached_ids = set()
+
+    def attach_new_jobs():
+        """أصحاب الطلبات المطابقة يرون نفس التقدم، بما فيها الطلبات التي ترتبط بالمهمة أثناء تنفيذها."""
+        for attached in get_attached_jobs(job['id']):
+            if attached['id'] not in attached_ids:
+                attached_ids.add(attached['id'])
+                status.attach(job_message(bot, attached['chat_id'], attached['status_message_id']))
+
+    if job['playlist_id'] is not None:
+        # إلغاء القائمة يسحب عقود عناصرها، لذا نجدد العقد بفواصل أقصر حتى يتوقف العنصر سريعاً
+        status = PlaylistStatus(status_message, get_playlist(job['playlist_id']), job['position'])
+        renew_interval = min(renew_interval, PLAYLIST_POLL_INTERVAL)
+    else:
+        status = SharedStatus(status_message)
+        attach_new_jobs()
+
+    work = asyncio.create_task(_run_job(bot, job, status_message, status, release_slot))
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=renew_interval)
+            if done:
+                break
+            if not renew_job_lease(job['id'], worker_id):
+                logger.warning(f"فقد العامل عقد المهمة {job['id']}، سيتم إيقافها")
+                work.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await work
+                if job['playlist_id'] is not None:
+                    await update_playlist_message(bot, job['playlist_id'])
                 return
+            if job['playlist_id'] is None:
+                attach_new_jobs()
+    except asyncio.CancelledError:
+        work.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await work
+        requeue_job(job['id'], worker_id)
+        raise
 
-            # تخزين معلومات الصيغ المتاحة في chat_data
-            original_message_id = update.message.message_id
-            context.chat_data[original_message_id] = {
-                'url': url, 
-                'formats': available_formats,
-                'duration': duration,
-                'best_audio': best_audio
-            }
+    result, error = work.result()
+    file_id, file_type = result or (None, None)
+    metrics.inc('bot_jobs_total', result='done' if file_id else 'failed', **labels)
+    attached_jobs = complete_job(job['id'], worker_id, file_id, file_type, error)
+    if attached_jobs:
+        await deliver_attached_jobs(bot, attached_jobs)
+    if job['playlist_id'] is not None:
+        await update_playlist_message(bot, job['playlist_id'])
 
-            # إضافة زر الإلغاء
-            keyboard.append([InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel:{original_message_id}")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            title = info.get('title', 'فيديو')
-            duration_str = format_duration(duration) if duration else "غير معروف"
-            
-            await status_message.edit_text(
-                f"<b>{title}</b>\n⏱️ المدة: {duration_str}\n\nاختر الصيغة:", 
-                reply_markup=reply_markup, 
-                parse_mode=ParseMode.HTML
-            )
+def queue_position_text(position: int) -> str:
+    return f"🕒 في طابور التحميل... ترتيبك: {position}"
+
+class QueuePositions:
+    """
+    يحدّث ترتيب المهام المنتظرة في رسائل حالتها دورياً حتى يرى المستخدم تقدمه في الطابور.
+    يعمل في عملية البوت وحدها (لا في العمال) حتى لا تتكرر التعديلات، ويعدّل الرسالة فقط عند تغير ترتيبها.
+    عناصر قوائم التشغيل تُحسب في الترتيب لكن رسالتها المشتركة تحدّثها العمال.
+    """
+    def __init__(self, interval: int, max_edits: int):
+        self._interval = interval
+        self._max_edits = max_edits
+        # آخر ترتيب معروض لكل مهمة
+        self._shown: dict[int, int] = {}
+        self.edits = 0
+
+    def shown(self, job_id: int, position: int):
+        """يسجل الترتيب المعروض عند إضافة المهمة."""
+        self._shown[job_id] = position
+
+    async def refresh(self, bot: Bot):
+        known = set(self._shown)
+        shown = {}
+        edits = 0
+        for position, job in enumerate(get_queued_jobs(), 1):
+            if job['playlist_id'] is not None:
+                continue
+            previous = self._shown.get(job['id'])
+            shown[job['id']] = previous
+            if previous == position or edits >= self._max_edits:
+                continue
+            # قد يستلم عامل المهمة في هذه الأثناء، فلا نعيد رسالة الطابور فوق حالة التحميل
+            if not is_job_queued(job['id']):
+                continue
+            with contextlib.suppress(TelegramError):
+                await job_message(bot, job['chat_id'], job['status_message_id']).edit_text(queue_position_text(position))
+                shown[job['id']] = position
+                self.edits += 1
+            edits += 1
+        # المهام التي غادرت الطابور تُنسى، والمضافة أثناء التحديث تبقى
+        for job_id in known - shown.keys():
+            self._shown.pop(job_id, None)
+        self._shown.update((job_id, position) for job_id, position in shown.items() if position is not None)
+
+    async def run(self, bot: Bot):
+        """تحديث دوري طوال عمل البوت."""
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.refresh(bot)
+            except Exception as e:
+                logger.error(f"فشل تحديث ترتيب الطابور: {e}")
+
+queue_positions = QueuePositions(QUEUE_POSITION_INTERVAL, QUEUE_POSITION_MAX_EDITS)
 
-    except Exception as e:
-        logging.error(f"فشل في جلب معلومات الفيديو من {url}: {e}")
-        
-        # رسائل خطأ محددة
-        error_msg = "❌ حدث خطأ أثناء جلب المعلومات"
-        if "Unsupported URL" in str(e):
-            error_msg = "❌ هذا الرابط غير مدعوم"
-        elif "No video formats found" in str(e):
-            error_msg = "❌ لم يتم العثور على صيغ فيديو"
-        elif "Private video" in str(e):
-            error_msg = "❌ الفيديو خاص أو محمي"
-        elif "Sign in" in str(e):
-            error_msg = "❌ يتطلب تسجيل الدخول"
-        else:
-            error_msg = f"❌ حدث خطأ: {str(e)}"
-            
-        await status_message.edit_text(error_msg)
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if query.data == "noop":
-        await query.answer("⚠️ هذا الخيار غير متاح لأن حجم الملف يتجاوز 50 ميجابايت.", show_alert=True)
+        await query.answer(f"⚠️ هذا الخيار غير متاح لأن حجم الملف يتجاوز {format_bytes(BOT_API_UPLOAD_LIMIT)}.", show_alert=True)
         return
     await query.answer()
 
@@ -656,7 +3161,40 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action == "cancel":
         original_message_id = int(parts[1])
         await query.message.delete()
-        context.chat_data.pop(original_message_id, None)
+        pending_menus.pop(context.chat_data, original_message_id)
+        return
+
+    if action == "playlist_cancel":
+        playlist = cancel_playlist(int(parts[1]), query.from_user.id)
+        if playlist:
+            await query.edit_message_text(text=playlist_summary_text(playlist, get_playlist_counts(playlist['id'])))
+        return
+
+    if action == "playlist" and len(parts) == 3:
+        media_type = parts[1]
+        original_message_id = int(parts[2])
+        media_info = pending_menus.get(context.chat_data, original_message_id)
+        if not media_info or not media_info.get('playlist'):
+            await query.edit_message_text(text="❌ انتهت صلاحية هذه القائمة. أعد إرسال الرابط.")
+            return
+        # كل عنصر مهمة في الطابور الدائم؛ العمال ينفذون حتى PLAYLIST_CONCURRENCY عناصر منها في نفس الوقت
+        format_id = playlist_format_selector(BOT_API_UPLOAD_LIMIT) if media_type == 'video' else 'audio'
+        playlist_id = enqueue_playlist({
+            'user_id': query.from_user.id,
+            'chat_id': query.message.chat_id,
+            'status_message_id': query.message.message_id,
+            'title': media_info['title'],
+        }, media_info['entries'], media_type, format_id)
+        if playlist_id is None:
+            # نبقي القائمة معروضة حتى يمكن اختيارها بعد انتهاء القائمة الجارية
+            await query.message.reply_text("⚠️ لديك قائمة تشغيل قيد التحميل. انتظر انتهاءها أو ألغها أولاً.")
+            return
+        pending_menus.pop(context.chat_data, original_message_id)
+        playlist = get_playlist(playlist_id)
+        await query.edit_message_text(
+            text=f"{playlist_summary_text(playlist, {})}\n\n🕒 في طابور التحميل...",
+            reply_markup=playlist_cancel_markup(playlist_id)
+        )
         return
 
     if action == "download" and len(parts) == 4:
@@ -665,102 +3203,63 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         original_message_id = int(parts[3])
 
         # استرجاع بيانات الرابط والصيغ من chat_data
-        media_info = context.chat_data.get(original_message_id)
+        media_info = pending_menus.get(context.chat_data, original_message_id)
         if not media_info:
-            await query.edit_message_text(text="❌ حدث خطأ. أعد إرسال الرابط.")
+            await query.edit_message_text(text="❌ انتهت صلاحية هذه القائمة. أعد إرسال الرابط.")
             return
 
         download_url = media_info.get('url')
         user_id = query.from_user.id
 
-        # استرجاع الصيغة المطلوبة من chat_data
-        try:
-            # format_key هو 'audio' أو رقم الدقة مثل '720'
-            selected_format = media_info['formats'].get(format_key)
-            if not selected_format:
-                # محاولة البحث بالمفتاح الرقمي
-                try:
-                    selected_format = media_info['formats'].get(int(format_key))
-                except ValueError:
-                    pass
-            
-            if not selected_format:
-                await query.edit_message_text(text="❌ لم يتم العثور على الصيغة.")
-                return
-                
-            # استخدام format_id المحسوب مسبقاً إن وجد
-            if 'combined_format' in selected_format:
-                format_id = selected_format['combined_format'].replace('audio_id', media_info['best_audio']['format_id'])
-            elif media_type.startswith('audio') and selected_format.get('vcodec') != 'none':
-                # إذا كان المطلوب صوت والمصدر هو صيغة فيديو مدمجة، استخدم format_id الخاص بها ليتمكن yt-dlp من استخراج الصوت
-                format_id = selected_format.get('format_id', '')
-            else:
-                format_id = selected_format.get('format_id', '') or 'best'
-            
-        except (KeyError, TypeError, ValueError) as e:
-            logging.error(f"خطأ في استرجاع الصيغة: {e}")
-            await query.edit_message_text(text="❌ حدث خطأ في معالجة الصيغة.")
-            return
-
-        await query.edit_message_text(text="⏳ جارٍ التحميل...")
-        
-        # تحميل الوسائط
-        filepath, downloaded_type = await download_media(
-            download_url, 
-            media_type, 
-            format_id, 
-            query.message, 
-            context
-        )
-        
-        if not filepath:
-            await query.edit_message_text(text="❌ فشل التحميل. حاول مرة أخرى.")
+        # استرجاع الصيغة المطلوبة (format_key هو 'audio' أو 'auto' أو رقم الدقة مثل '720')
+        selected_format = media_info['formats'].get(format_key)
+        if not selected_format:
+            await query.edit_message_text(text="❌ لم يتم العثور على الصيغة.")
             return
+        # format_id محسوب مسبقاً عند عرض القائمة
+        format_id = selected_format['format_id']
 
-        try:
-            await query.edit_message_text(text=f"⬆️ جارٍ رفع الـ {downloaded_type}...")
-            
-            # إرسال الملف بدون معامل progress لإصلاح الخطأ
-            with open(filepath, 'rb') as file:
-                if downloaded_type == 'video':
-                    await context.bot.send_video(
-                        chat_id=query.message.chat_id, 
-                        video=file, 
-                        caption=f"تم التحميل بواسطة @{context.bot.username}", 
-                        supports_streaming=True,
-                        read_timeout=60,
-                        write_timeout=60
-                    )
-                elif downloaded_type == 'audio':
-                    await context.bot.send_audio(
-                        chat_id=query.message.chat_id, 
-                        audio=file, 
-                        caption=f"تم التحميل بواسطة @{context.bot.username}",
-                        read_timeout=60,
-                        write_timeout=60
-                    )
-            
-            # حذف الرسالة المؤقتة بعد الرفع بنجاح
-            await query.message.delete()
-            
-        except TelegramError as e:
-            error_message = f"❌ فشل الرفع: {str(e)}"
-            if "File too large" in str(e):
-                error_message += "\n\nالملف كبير جداً (الحد الأقصى 50 ميجابايت)."
-            await query.edit_message_text(text=error_message)
-        except Exception as e:
-            await query.edit_message_text(text=f"❌ حدث خطأ غير متوقع: {str(e)}")
-        finally:
-            # تنظيف الملفات المؤقتة
-            if filepath and os.path.exists(filepath):
+        # إذا سبق رفع نفس الوسائط بنفس الصيغة، نعيد إرسال file_id مباشرة
+        extractor = media_info.get('extractor')
+        video_id = media_info.get('video_id')
+        if extractor and video_id:
+            cached = get_cached_file(extractor, video_id, media_type, format_id)
+            if cached:
+                cached_file_id, cached_type = cached
                 try:
-                    os.remove(filepath)
-                    logger.info(f"تم حذف الملف المؤقت: {filepath}")
-                except Exception as e:
-                    logger.error(f"خطأ في حذف الملف المؤقت: {e}")
-            
-            # تنظيف chat_data
-            context.chat_data.pop(original_message_id, None)
+                    await send_media_file(context.bot, query.message.chat_id, cached_type, cached_file_id)
+                    await query.message.delete()
+                    pending_menus.pop(context.chat_data, original_message_id)
+                    return
+                except TelegramError as e:
+                    # file_id غير صالح، نحذفه ونكمل بالتحميل العادي
+                    logger.warning(f"فشل إعادة إرسال file_id المخزن لـ {extractor}:{video_id}: {e}")
+                    delete_cached_file(extractor, video_id, media_type, format_id)
+
+        # إضافة المهمة إلى الطابور الدائم لتنفذها عمليات العمال. إذا كان نفس الملف بنفس الصيغة
+        # قيد التحميل لطلب آخر، تُربط المهمة به ويصل الملف عند انتهائه دون تحميل ثانٍ.
+        # المعلومات المستخرجة تُحفظ مع المهمة لأن العمال لا يرون ذاكرة هذه العملية
+        cached_info = metadata_cache.get(download_url)
+        job_id, parent_id = enqueue_job({
+            'user_id': user_id,
+            'chat_id': query.message.chat_id,
+            'status_message_id': query.message.message_id,
+            'url': download_url,
+            'extractor': extractor,
+            'video_id': video_id,
+            'media_type': media_type,
+            'format_id': format_id,
+            'size': selected_format['size'],
+            'duration': media_info.get('duration'),
+            'info': json.dumps(cached_info) if cached_info else None,
+        })
+        pending_menus.pop(context.chat_data, original_message_id)
+        if parent_id:
+            await query.edit_message_text(text="🔗 نفس الملف قيد التحميل لطلب آخر، سيصلك عند انتهائه...")
+        else:
+            position = get_job_position(job_id)
+            queue_positions.shown(job_id, position)
+            await query.edit_message_text(text=queue_position_text(position))
 
 # تعريف الحالات
 ADMIN_PANEL, AWAITING_BROADCAST, AWAITING_CHANNEL_ID = range(3)
@@ -776,6 +3275,7 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         [InlineKeyboardButton("📢 إذاعة", callback_data="admin_broadcast")],
         [InlineKeyboardButton("📺 ضبط القناة", callback_data="admin_setchannel")],
         [InlineKeyboardButton("🗑️ حذف القناة", callback_data="admin_delchannel")],
+        [InlineKeyboardButton("🧹 مسح ذاكرة الاشتراك", callback_data="admin_flushmembership")],
         [InlineKeyboardButton("❌ إغلاق", callback_data="admin_close")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -802,8 +3302,83 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     query = update.callback_query
     await query.answer()
     user_count = get_user_count()
+    blocked_count = get_blocked_user_count()
+    cached_files = get_file_cache_count()
+    db_transactions = DB_WRITE_STATS['transactions']
+    db_avg_ms = DB_WRITE_STATS['total_time'] / db_transactions * 1000 if db_transactions else 0.0
+    # التحميل والمعالجة تتم في عمليات العمال، فنعرض مجموع ما نشروه من إحصائيات
+    job_counts = get_job_counts()
+    workers = get_worker_stats()
+    # مقاييس المراحل: مجموع العمال مع مقاييس هذه العملية (جلب المعلومات واستدعاءات Bot API)
+    worker_totals = sum_worker_stats(workers + [{'metrics': metrics.snapshot()}])
+    compress = worker_totals['compress']
+    storage = worker_totals['storage']
+    transcode = worker_totals['transcode']
+    compress_done = compress['completed'] + compress['failed']
+    compress_queue_avg = compress['total_queue_time'] / compress_done if compress_done else 0.0
+    compress_speed = compress['total_media_time'] / compress['total_encode_time'] if compress['total_encode_time'] else 0.0
+    disk_usage = await asyncio.get_running_loop().run_in_executor(None, storage_manager.disk_usage)
+    reserved = storage_manager.reserved
+    transcode_lines = "\n".join(
+        f"• {label}: {transcode[mode]['count']} (متوسط {transcode[mode]['time'] / max(transcode[mode]['count'], 1):.1f} ث)"
+        for mode, label in (('none', 'بدون معالجة'), ('remux', 'إعادة تغليف'), ('transcode', 'إعادة ترميز'))
+    )
+    stages = Metrics.summarize(worker_totals['metrics'], 'bot_stage_duration_seconds', 'stage')
+    speeds = Metrics.summarize(worker_totals['metrics'], 'bot_transfer_speed_bytes_per_second', 'direction')
+    api_calls = Metrics.summarize(worker_totals['metrics'], 'bot_telegram_api_duration_seconds', 'method')
+    stage_lines = "\n".join(
+        f"• {label}: {stages[stage][0]} (متوسط {stages[stage][1]:.1f} ث | p95 ≤ {stages[stage][2]} ث)"
+        for stage, label in (
+            ('extract', 'جلب المعلومات'), ('queue_wait', 'انتظار الطابور'), ('download', 'التحميل'),
+            ('postprocess', 'المعالجة'), ('compress', 'الضغط'), ('upload', 'الرفع'),
+        ) if stage in stages
+    ) or "• لا توجد بيانات بعد"
+    api_count = sum(count for count, _, _ in api_calls.values())
+    api_avg_ms = sum(count * avg for count, avg, _ in api_calls.values()) / api_count * 1000 if api_count else 0.0
+    speed_line = " | ".join(
+        f"{label}: {format_bytes(speeds[direction][1])}/ث"
+        for direction, label in (('download', '⬇️ تحميل'), ('upload', '⬆️ رفع')) if direction in speeds
+    )
     await query.edit_message_text(
-        f"📊 <b>إحصائيات البوت</b>\n\n👥 عدد المستخدمين: {user_count}",
+        f"📊 <b>إحصائيات البوت</b>\n\n👥 عدد المستخدمين: {user_count}\n"
+        f"🚫 حظروا البوت: {blocked_count}\n"
+        f"📢 الإذاعات الجارية: {len(active_broadcasts)}\n\n"
+        f"🗂️ <b>ذاكرة file_id</b>\n"
+        f"📦 الملفات المخزنة: {cached_files}\n"
+        f"✅ الإصابات: {FILE_CACHE_STATS['hits']}\n"
+        f"❌ الإخفاقات: {FILE_CACHE_STATS['misses']}\n\n"
+        f"🔎 <b>جلب المعلومات</b>\n"
+        f"⏳ في الطابور: {extraction_pool.queued} (الأقصى: {extraction_pool.peak_queued})\n"
+        f"⚙️ قيد التنفيذ: {extraction_pool.running}\n"
+        f"✔️ مكتملة: {extraction_pool.completed} | ❌ فاشلة: {extraction_pool.failed}\n\n"
+        f"📥 <b>طابور التحميل</b>\n"
+        f"👷 العمال: {len(workers)} | ⚙️ قيد التنفيذ: {job_counts.get('running', 0)} | "
+        f"⬇️ يحمّل الآن: {worker_totals['downloading']}/{len(workers) * DOWNLOAD_SLOTS}\n"
+        f"🕒 في الطابور: {job_counts.get('queued', 0)} | 🔗 مرتبطة بتحميل جارٍ: {job_counts.get('attached', 0)}\n"
+        f"📃 قوائم تشغيل جارية: {count_active_playlists()}\n"
+        f"✔️ مكتملة: {job_counts.get('done', 0)} | ❌ فاشلة: {job_counts.get('failed', 0)}\n\n"
+        f"💽 <b>التخزين</b>\n"
+        f"📁 الاستخدام الفعلي: {format_bytes(disk_usage)}\n"
+        f"📌 المحجوز: {format_bytes(reserved)} من {format_bytes(storage_manager.budget)}\n"
+        f"🕒 بانتظار المساحة: {storage['waiting']} | ⛔ مرفوضة: {storage['rejected']}\n"
+        f"🧹 ملفات يتيمة محذوفة: {storage['swept_files']} ({format_bytes(storage['swept_bytes'])})\n\n"
+        f"⏱️ <b>زمن المراحل</b>\n{stage_lines}\n"
+        f"{speed_line + chr(10) if speed_line else ''}"
+        f"📡 استدعاءات Bot API: {api_count} (متوسط {api_avg_ms:.0f} ms)\n\n"
+        f"🎞️ <b>معالجة mp4</b>\n{transcode_lines}\n\n"
+        f"🗜️ <b>الضغط</b>\n"
+        f"⏳ في الطابور: {compress['queued']} | ⚙️ قيد التنفيذ: {compress['running']}\n"
+        f"✔️ مكتملة: {compress['completed']} | ❌ فاشلة: {compress['failed']}\n"
+        f"🕒 متوسط الانتظار: {compress_queue_avg:.1f} ث | ⚡ سرعة الترميز: {compress_speed:.2f}x\n\n"
+        f"🧠 <b>ذاكرة معلومات الروابط</b>\n"
+        f"📦 المدخلات: {len(metadata_cache)} ({format_bytes(metadata_cache.size)} من {METADATA_CACHE_MAX_MB} MB)\n"
+        f"✅ الإصابات: {metadata_cache.hits} | ❌ الإخفاقات: {metadata_cache.misses}\n\n"
+        f"👤 <b>ذاكرة الاشتراك</b>\n"
+        f"📦 المدخلات: {len(membership_cache)}\n"
+        f"✅ الإصابات: {membership_cache.hits} | ❌ الإخفاقات: {membership_cache.misses}\n\n"
+        f"💾 <b>قاعدة البيانات</b>\n"
+        f"🧾 المعاملات: {db_transactions} ({DB_WRITE_STATS['rows']} صف)\n"
+        f"⏱️ زمن الكتابة: متوسط {db_avg_ms:.1f} ms | آخر {DB_WRITE_STATS['last_time'] * 1000:.1f} ms | أقصى {DB_WRITE_STATS['max_time'] * 1000:.1f} ms",
         parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_back_to_panel")]])
     )
@@ -839,6 +3414,7 @@ async def handle_set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ADMIN_PANEL
 
     set_setting('force_channel', channel_id)
+    membership_cache.flush()
     await update.message.reply_text(f"✅ تم تعيين قناة الاشتراك الإجباري إلى: {channel_id}")
     await admin_panel_command(update, context)
     return ADMIN_PANEL
@@ -848,32 +3424,232 @@ async def admin_del_channel(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     set_setting('force_channel', '')
+    membership_cache.flush()
     await query.edit_message_text(
         "✅ تم حذف قناة الاشتراك الإجباري بنجاح.",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_back_to_panel")]])
     )
     return ADMIN_PANEL
 
-async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """ينفذ الإذاعة."""
-    users = get_all_users()
-    sent_count = 0
-    failed_count = 0
-    status_msg = await update.message.reply_text(f"⏳ جارٍ بدء الإذاعة إلى `{len(users)}` مستخدم\.\.\.", parse_mode=ParseMode.MARKDOWN_V2)
+async def admin_flush_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يمسح الذاكرة المؤقتة لنتائج التحقق من الاشتراك."""
+    query = update.callback_query
+    await query.answer()
+    flushed = len(membership_cache)
+    membership_cache.flush()
+    await query.edit_message_text(
+        f"✅ تم مسح ذاكرة الاشتراك ({flushed} نتيجة).",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_back_to_panel")]])
+    )
+    return ADMIN_PANEL
+
+class TokenBucket:
+    """
+    دلو رموز لتحديد معدل الإرسال. يمكن إيقافه مؤقتاً عند استلام RetryAfter من تليجرام.
+    """
+    def __init__(self, rate: float, capacity: float | None = None):
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """يوقف الإرسال للجميع لعدد من الثواني."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
 
-    for user_id in users:
+    async def acquire(self):
+        """ينتظر حتى يتوفر رمز واحد."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+# حد تليجرام لكل محادثة: رسالة واحدة في الثانية تقريباً
+_PER_CHAT_INTERVAL = 1.0
+
+class BroadcastJob:
+    """
+    إذاعة واحدة: تقرأ المستخدمين من قاعدة البيانات على صفحات، وترسل بشكل متزامن
+    تحت حد المعدل، وتحفظ تقدمها بعد كل صفحة حتى تُستأنف بعد إعادة التشغيل.
+    """
+    def __init__(self, bot: Bot, row: dict):
+        self._bot = bot
+        self.id = row['id']
+        self._from_chat_id = row['from_chat_id']
+        self._message_id = row['message_id']
+        self._status_chat_id = row.get('status_chat_id')
+        self._status_message_id = row.get('status_message_id')
+        self.total = row['total']
+        self.sent = row['sent']
+        self.failed = row['failed']
+        self._cursor = row['last_user_id']
+        self._bucket = TokenBucket(BROADCAST_RATE)
+        self._semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        self._last_sent_at: dict[int, float] = {}
+        self._failures: list[tuple[int, str, bool]] = []
+        self._started = time.monotonic()
+        self._started_done = self.sent + self.failed
+
+    async def _send_one(self, user_id: int):
+        """يرسل الرسالة لمستخدم واحد مع احترام RetryAfter وإعادة المحاولة عند أخطاء الشبكة."""
+        async with self._semaphore:
+            for _ in range(3):
+                wait = self._last_sent_at.get(user_id, 0) + _PER_CHAT_INTERVAL - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self._bucket.acquire()
+                self._last_sent_at[user_id] = time.monotonic()
+                try:
+                    await self._bot.copy_message(chat_id=user_id, from_chat_id=self._from_chat_id, message_id=self._message_id)
+                    self.sent += 1
+                    return
+                except RetryAfter as e:
+                    logger.warning(f"تجاوز حد الإرسال أثناء الإذاعة {self.id}، انتظار {e.retry_after} ثانية")
+                    self._bucket.pause(e.retry_after)
+                except Forbidden as e:
+                    # المستخدم حظر البوت أو حذف حسابه: لن نرسل له في الإذاعات القادمة
+                    self._failures.append((user_id, str(e), True))
+                    break
+                except BadRequest as e:
+                    logger.warning(f"فشل إرسال الإذاعة إلى {user_id}: {e}")
+                    self._failures.append((user_id, str(e), "chat not found" in str(e).lower()))
+                    break
+                except NetworkError as e:
+                    logger.warning(f"خطأ شبكة أثناء إرسال الإذاعة إلى {user_id}، إعادة المحاولة: {e}")
+                    await asyncio.sleep(1)
+                except TelegramError as e:
+                    logger.warning(f"فشل إرسال الإذاعة إلى {user_id}: {e}")
+                    self._failures.append((user_id, str(e), False))
+                    break
+            else:
+                self._failures.append((user_id, "تجاوز عدد المحاولات", False))
+            self.failed += 1
+
+    def _status_text(self, finished: bool = False) -> str:
+        """ينشئ نص رسالة الحالة مع المعدل والوقت المتبقي المتوقع."""
+        done = self.sent + self.failed
+        if finished:
+            return (
+                f"✅ اكتملت الإذاعة!\n\n"
+                f"✔️ تم الإرسال بنجاح إلى: {self.sent} مستخدم\n"
+                f"❌ فشل الإرسال إلى: {self.failed} مستخدم"
+            )
+        elapsed = time.monotonic() - self._started
+        rate = (done - self._started_done) / elapsed if elapsed > 0 else 0
+        remaining = max(self.total - done, 0)
+        eta = format_duration(remaining / rate) if rate > 0 else "غير معروف"
+        percentage = done / self.total * 100 if self.total else 100
+        return (
+            f"📢 جارٍ الإذاعة...\n{generate_progress_bar(min(percentage, 100))}\n\n"
+            f"✔️ نجح: {self.sent} | ❌ فشل: {self.failed} | الإجمالي: {self.total}\n"
+            f"⚡ المعدل: {rate:.1f} رسالة/ثانية\n"
+            f"⏱️ الوقت المتبقي: {eta}"
+        )
+
+    async def _update_status(self, finished: bool = False):
+        """يعدّل رسالة الحالة إن وجدت."""
+        if not self._status_message_id:
+            return
         try:
-            await context.bot.copy_message(chat_id=user_id, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            sent_count += 1
+            await self._bot.edit_message_text(
+                chat_id=self._status_chat_id,
+                message_id=self._status_message_id,
+                text=self._status_text(finished)
+            )
         except TelegramError as e:
-            logger.warning(f"فشل إرسال الإذاعة إلى {user_id}: {e}")
-            failed_count += 1
-    
-    await status_msg.edit_text(
-        f"✅ اكتملت الإذاعة!\n\n"
-        f"✔️ تم الإرسال بنجاح إلى: {sent_count} مستخدم\n"
-        f"❌ فشل الإرسال إلى: {failed_count} مستخدم"
-    )
+            if "Message is not modified" not in str(e):
+                logger.warning(f"فشل تحديث رسالة حالة الإذاعة {self.id}: {e}")
+
+    async def _status_loop(self):
+        """يحدّث رسالة الحالة بشكل دوري حتى انتهاء الإذاعة."""
+        while True:
+            await asyncio.sleep(BROADCAST_STATUS_INTERVAL)
+            await self._update_status()
+
+    async def run(self):
+        """ينفذ الإذاعة من آخر نقطة محفوظة حتى النهاية."""
+        status_task = asyncio.create_task(self._status_loop())
+        try:
+            while True:
+                page = get_users_page(self._cursor, BROADCAST_PAGE_SIZE)
+                if not page:
+                    break
+                await asyncio.gather(*(self._send_one(user_id) for user_id in page))
+                self._cursor = page[-1]
+                self._last_sent_at.clear()
+                record_delivery_failures(self._failures)
+                self._failures.clear()
+                save_broadcast_progress(self.id, self._cursor, self.sent, self.failed)
+            save_broadcast_progress(self.id, self._cursor, self.sent, self.failed, status='done')
+        finally:
+            status_task.cancel()
+        await self._update_status(finished=True)
+        logger.info(f"اكتملت الإذاعة {self.id}: نجح {self.sent}، فشل {self.failed}")
+
+# المهام الخلفية في العملية الرئيسية (حلقات دائمة وإذاعات)، تُلغى عند الإيقاف.
+# لا تُنشأ عبر application.create_task لأن Application.stop ينتظر انتهاء تلك المهام
+_background_tasks: set[asyncio.Task] = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    """يشغّل مهمة خلفية تُلغى في post_shutdown وتُحذف من المجموعة عند انتهائها."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def cancel_background_tasks():
+    """يلغي المهام الخلفية وينتظر خروجها."""
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# الإذاعات الجارية حالياً في هذه العملية
+active_broadcasts: dict[int, BroadcastJob] = {}
+
+async def run_broadcast(bot: Bot, row: dict):
+    """يشغّل إذاعة (جديدة أو مستأنفة) ويزيلها من القائمة عند الانتهاء."""
+    job = BroadcastJob(bot, row)
+    active_broadcasts[job.id] = job
+    try:
+        await job.run()
+    except Exception as e:
+        # تبقى الحالة running في قاعدة البيانات لتُستأنف عند التشغيل القادم
+        logger.error(f"توقفت الإذاعة {job.id} بسبب خطأ: {e}", exc_info=True)
+    finally:
+        active_broadcasts.pop(job.id, None)
+
+async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """ينفذ الإذاعة في الخلفية حتى لا تتوقف لوحة التحكم أثناءها."""
+    total = get_user_count()
+    broadcast_id = create_broadcast(update.message.chat_id, update.message.message_id, total)
+    status_msg = await update.message.reply_text(f"⏳ جارٍ بدء الإذاعة إلى `{total}` مستخدم\.\.\.", parse_mode=ParseMode.MARKDOWN_V2)
+    set_broadcast_status_message(broadcast_id, status_msg.chat_id, status_msg.message_id)
+
+    row = {
+        'id': broadcast_id,
+        'from_chat_id': update.message.chat_id,
+        'message_id': update.message.message_id,
+        'status_chat_id': status_msg.chat_id,
+        'status_message_id': status_msg.message_id,
+        'total': total,
+        'sent': 0,
+        'failed': 0,
+        'last_user_id': 0,
+    }
+    # الإلغاء عند الإيقاف آمن: التقدم محفوظ بعد كل صفحة وتُستأنف الإذاعة عند التشغيل القادم
+    start_background_task(run_broadcast(context.bot, row))
     await admin_panel_command(update, context)
     return ADMIN_PANEL
 
@@ -894,17 +3670,404 @@ async def admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 # ٥. نقطة انطلاق البوت
 # ==============================================================================
 
-def main():
+# عمليات العمال التي يشغلها البوت محلياً
+_local_workers: list[subprocess.Popen] = []
+
+def _spawn_worker() -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker'])
+
+async def supervise_local_workers():
+    """يشغّل JOB_WORKERS عاملاً محلياً ويعيد تشغيل من يتوقف منهم."""
+    while True:
+        for i, process in enumerate(_local_workers):
+            if process.poll() is not None:
+                logger.warning(f"توقف العامل {process.pid} (رمز الخروج {process.returncode})، سيتم تشغيله من جديد")
+                _local_workers[i] = _spawn_worker()
+        while len(_local_workers) < JOB_WORKERS:
+            _local_workers.append(_spawn_worker())
+        await asyncio.sleep(10)
+
+def stop_local_workers():
+    """يوقف العمال المحليين؛ كل عامل يعيد مهامه الجارية إلى الطابور قبل خروجه."""
+    for process in _local_workers:
+        process.terminate()
+    for process in _local_workers:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    _local_workers.clear()
+
+class MetricsServer:
     """
-    الدالة الرئيسية لتشغيل البوت.
+    خادم HTTP صغير يعرض المقاييس بصيغة Prometheus على /metrics:
+    مقاييس هذه العملية مضافاً إليها آخر ما نشره كل عامل في قاعدة البيانات.
     """
-    # أولاً، قم بتهيئة قاعدة البيانات
-    init_db()
+    def __init__(self):
+        self._server: asyncio.AbstractServer | None = None
 
-    # إنشاء تطبيق البوت
-    application = Application.builder().token(BOT_TOKEN).build()
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"خادم المقاييس يستمع على {host}:{port}/metrics")
 
-    # إضافة معالجات الأوامر والرسائل
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            if method != 'GET' or target.split('?', 1)[0] != '/metrics':
+                status, body = "404 Not Found", b""
+            else:
+                snapshots = await asyncio.get_running_loop().run_in_executor(None, get_worker_stats)
+                totals = sum_worker_stats(snapshots + [{'metrics': metrics.snapshot()}])
+                status, body = "200 OK", metrics.render(totals['metrics']).encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+metrics_server = MetricsServer()
+
+async def post_init(application: Application):
+    """
+    يستأنف الأعمال الخلفية غير المكتملة بعد بدء تشغيل البوت.
+    """
+    if METRICS_PORT:
+        await metrics_server.start(METRICS_LISTEN, METRICS_PORT)
+    # مهام التحميل المنتظرة محفوظة في الطابور الدائم وتستأنفها العمال تلقائياً
+    if JOB_WORKERS > 0:
+        start_background_task(supervise_local_workers())
+    start_background_task(pending_menus.sweep_loop(application))
+    # ترتيب المهام المنتظرة يتحدث من هنا وحده مهما كان عدد العمال
+    start_background_task(queue_positions.run(application.bot))
+
+    for row in get_unfinished_broadcasts():
+        logger.info(f"استئناف الإذاعة {row['id']} من المستخدم {row['last_user_id']}")
+        start_background_task(run_broadcast(application.bot, row))
+
+async def post_stop(application: Application):
+    """
+    يلغي المهام الخلفية (ومنها الإذاعات) بعد توقف استقبال التحديثات وقبل إغلاق اتصال البوت،
+    حتى لا تفشل طلباتها الجارية بسبب إغلاق الاتصال.
+    """
+    await cancel_background_tasks()
+
+async def post_shutdown(application: Application):
+    """
+    تحرير الموارد الخلفية عند إيقاف البوت.
+    """
+    # إذا لم يصل التشغيل إلى post_stop (فشل أثناء البدء)
+    await cancel_background_tasks()
+    await metrics_server.stop()
+    extraction_pool.shutdown()
+    stop_local_workers()
+    await close_upload_client()
+    close_db()
+
+class InFlightUpdates:
+    """
+    يحصي معالجات التحديثات غير الحاجبة (block=False) الجارية، لأن التطبيق لا ينتظرها
+    فلا يظهر ضغطها في طول update_queue.
+    """
+    def __init__(self):
+        self.count = 0
+        self.peak = 0
+
+    def track(self, callback):
+        """يغلّف المعالج ليُحتسب طوال تنفيذه."""
+        @functools.wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            self.count += 1
+            self.peak = max(self.peak, self.count)
+            try:
+                return await callback(update, context)
+            finally:
+                self.count -= 1
+        return wrapper
+
+in_flight_updates = InFlightUpdates()
+
+class WebhookServer:
+    """
+    خادم HTTP بسيط فوق asyncio يستقبل تحديثات تليجرام ويضعها في update_queue الخاص بالتطبيق.
+    يتحقق من المسار ورمز السر، ويرد بـ 503 عند امتلاء الطابور أو تجاوز المعالجات الجارية حدها (ضغط عكسي)
+    حتى يعيد تليجرام الإرسال لاحقاً.
+    """
+    _MAX_BODY_SIZE = 1024 * 1024
+    _READ_TIMEOUT = 30
+    _REASONS = {
+        200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+        408: 'Request Timeout', 413: 'Payload Too Large', 503: 'Service Unavailable',
+    }
+
+    def __init__(self, application: Application, path: str, secret_token: str):
+        self._application = application
+        self._path = path
+        self._secret_token = secret_token
+        self._server: asyncio.AbstractServer | None = None
+        self.accepted = 0
+        self.rejected = 0
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"خادم webhook يستمع على {host}:{port}{self._path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _overloaded(self) -> bool:
+        """هل تجاوز البوت قدرته على استيعاب تحديثات جديدة؟"""
+        return (
+            self._application.update_queue.full()
+            or in_flight_updates.count >= MAX_IN_FLIGHT_UPDATES
+            or extraction_pool.queued >= MAX_EXTRACT_QUEUE
+        )
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool, extra_headers: dict | None = None):
+        headers = {'Content-Length': '0', 'Connection': 'keep-alive' if keep_alive else 'close', **(extra_headers or {})}
+        head = f"HTTP/1.1 {status} {self._REASONS[status]}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write((head + "\r\n").encode())
+        await writer.drain()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """يعالج طلبات متتالية على نفس الاتصال (keep-alive) حتى يغلقه الطرف الآخر."""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self._READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+    async def _handle_request(self, request_line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """يعالج طلباً واحداً ويعيد True إذا كان يمكن إبقاء الاتصال مفتوحاً."""
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self._READ_TIMEOUT)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close'
+
+        content_length = int(headers.get('content-length') or 0)
+        if content_length > self._MAX_BODY_SIZE:
+            await self._respond(writer, 413, False)
+            return False
+        body = await asyncio.wait_for(reader.readexactly(content_length), self._READ_TIMEOUT)
+
+        if target.split('?', 1)[0] != self._path:
+            await self._respond(writer, 404, keep_alive)
+            return keep_alive
+        if method != 'POST':
+            await self._respond(writer, 405, keep_alive, {'Allow': 'POST'})
+            return keep_alive
+        if headers.get('x-telegram-bot-api-secret-token') != self._secret_token:
+            await self._respond(writer, 403, keep_alive)
+            return keep_alive
+
+        try:
+            update = Update.de_json(json.loads(body), self._application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"تحديث webhook غير صالح: {e}")
+            await self._respond(writer, 400, keep_alive)
+            return keep_alive
+
+        if self._overloaded():
+            # نرفض التحديث ليعيد تليجرام إرساله لاحقاً بدلاً من تراكمه في الذاكرة
+            self.rejected += 1
+            await self._respond(writer, 503, keep_alive, {'Retry-After': '5'})
+            return keep_alive
+        try:
+            self._application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            await self._respond(writer, 503, keep_alive, {'Retry-After': '5'})
+            return keep_alive
+        self.accepted += 1
+        await self._respond(writer, 200, keep_alive)
+        return keep_alive
+
+async def run_webhook(application: Application):
+    """
+    يشغّل التطبيق يدوياً في وضع webhook: التهيئة، تسجيل الـ webhook لدى تليجرام،
+    تشغيل الخادم حتى وصول إشارة الإيقاف، ثم الإيقاف بالترتيب العكسي.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info("البوت قيد التشغيل (webhook)...")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def run_worker():
+    """
+    حلقة عامل التحميل: يستلم المهام من الطابور الدائم بعقود مؤقتة ويحمّل حتى DOWNLOAD_SLOTS منها في نفس الوقت.
+    المهمة تشغل منفذها حتى ينتهي التحميل فقط، ثم يستلم العامل مهمة جديدة بينما تُضغط السابقة أو تُرفع.
+    عند الإيقاف (SIGTERM) يعيد مهامه الجارية إلى الطابور ليستلمها عامل آخر.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    bot_kwargs = {}
+    if BOT_API_BASE_URL:
+        bot_kwargs = {'base_url': BOT_API_BASE_URL, 'local_mode': BOT_API_LOCAL_MODE}
+        if BOT_API_BASE_FILE_URL:
+            bot_kwargs['base_file_url'] = BOT_API_BASE_FILE_URL
+    bot = Bot(BOT_TOKEN, request=MetricsRequest(connection_pool_size=DOWNLOAD_SLOTS * 4), **bot_kwargs)
+
+    # مجلدات المهام التي لا يملك أي عامل عقدها بقايا تشغيل سابق
+    storage_manager.sweep(max_age=0)
+    sweep_task = asyncio.create_task(storage_manager.sweep_loop())
+    slots = asyncio.Semaphore(DOWNLOAD_SLOTS)
+    # المهام التي تشغل منفذ تحميل الآن
+    downloading: set[int] = set()
+    tasks: set[asyncio.Task] = set()
+
+    async def acquire_slot() -> bool:
+        """يحجز منفذ تحميل، ويعيد False إذا وصلت إشارة الإيقاف قبل توفره."""
+        acquire_task = asyncio.create_task(slots.acquire())
+        stop_task = asyncio.create_task(stop_event.wait())
+        await asyncio.wait({acquire_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        stop_task.cancel()
+        if acquire_task.done():
+            if not stop_event.is_set():
+                return True
+            slots.release()
+            return False
+        acquire_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await acquire_task
+        return False
+
+    def slot_releaser(job_id: int):
+        """يعيد دالة تحرر منفذ المهمة مرة واحدة: بعد التحميل، أو عند انتهاء المهمة إذا لم تصل إليه."""
+        def release(_=None):
+            if job_id in downloading:
+                downloading.discard(job_id)
+                slots.release()
+        return release
+
+    last_stats = last_prune = 0.0
+    logger.info(f"العامل {worker_id} قيد التشغيل...")
+
+    async with bot:
+        try:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if now - last_stats >= WORKER_STATS_INTERVAL:
+                    last_stats = now
+                    save_worker_stats(worker_id, worker_stats_snapshot(len(tasks), len(downloading)))
+                    # المهام التي استنفدت محاولاتها (عمالها توقفوا فجأة أكثر من مرة)
+                    expired = expire_exhausted_jobs()
+                    for job in expired:
+                        if job['playlist_id'] is not None:
+                            await update_playlist_message(bot, job['playlist_id'])
+                            continue
+                        with contextlib.suppress(TelegramError):
+                            await job_message(bot, job['chat_id'], job['status_message_id']).edit_text(
+                                "❌ فشل التحميل بعد عدة محاولات. حاول مرة أخرى."
+                            )
+                if now - last_prune >= JOB_RETENTION / 24:
+                    last_prune = now
+                    prune_finished_jobs()
+
+                # لا نستلم مهمة إلا عند توفر منفذ حتى لا تنتظر المهام المستلمة هنا بينما عمال آخرون متفرغون.
+                # انتظار المنفذ يتوقف عند إشارة الإيقاف حتى يصل العامل إلى إعادة مهامه إلى الطابور
+                if not await acquire_slot():
+                    break
+                job = claim_job(worker_id)
+                if not job:
+                    slots.release()
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(stop_event.wait(), JOB_POLL_INTERVAL)
+                    continue
+                logger.info(f"استلم العامل {worker_id} المهمة {job['id']} (المحاولة {job['attempts']})")
+                downloading.add(job['id'])
+                release_slot = slot_releaser(job['id'])
+                task = asyncio.create_task(process_job(bot, job, worker_id, release_slot))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(release_slot)
+        finally:
+            sweep_task.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await close_upload_client()
+            delete_worker_stats(worker_id)
+
+def worker_main():
+    """
+    نقطة انطلاق عملية العامل: python app.py worker
+    """
+    init_db()
+    try:
+        asyncio.run(run_worker())
+    finally:
+        compression_pool.shutdown()
+        close_db()
+
+def register_handlers(application: Application):
+    """
+    يسجل معالجات الأوامر والرسائل والأزرار، منفصلاً عن main حتى تمر التحديثات المصطنعة (عند القياس) بنفس التوجيه.
+    """
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     
@@ -917,6 +4080,7 @@ def main():
                 CallbackQueryHandler(lambda u, c: admin_request_input(u, c, "أرسل الآن الرسالة التي تريد إذاعتها...", AWAITING_BROADCAST), pattern="^admin_broadcast$"),
                 CallbackQueryHandler(lambda u, c: admin_request_input(u, c, "أرسل الآن معرف القناة (مثال: @username)...", AWAITING_CHANNEL_ID), pattern="^admin_setchannel$"),
                 CallbackQueryHandler(admin_del_channel, pattern="^admin_delchannel$"),
+                CallbackQueryHandler(admin_flush_membership, pattern="^admin_flushmembership$"),
                 CallbackQueryHandler(admin_close_panel, pattern="^admin_close$"),
                 CallbackQueryHandler(admin_panel_command, pattern="^admin_back_to_panel$"),
             ],
@@ -939,16 +4103,51 @@ def main():
     application.add_handler(admin_conv_handler)
 
     # معالج الرسائل النصية التي لا تبدأ بأمر
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # block=False: التطبيق لا ينتظر انتهاء جلب المعلومات قبل أخذ التحديث التالي، فتُعالج روابط
+    # المستخدمين وضغطات الأزرار وأوامر الأدمن في نفس الوقت ويحد مجمع الاستخراج من التزامن
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, in_flight_updates.track(handle_message), block=False))
 
     # معالج ضغطات الأزرار
     # استخدام نمط مختلف لكل نوع من الأزرار لتنظيم الكود
-    application.add_handler(CallbackQueryHandler(button_callback, pattern="^(download|cancel|noop)"))
+    # block=False: إعادة إرسال file_id المخزن لا توقف معالجة بقية التحديثات
+    application.add_handler(CallbackQueryHandler(
+        in_flight_updates.track(button_callback), pattern="^(download|cancel|noop|playlist)", block=False
+    ))
+
+def main():
+    """
+    الدالة الرئيسية لتشغيل البوت.
+    """
+    # أولاً، قم بتهيئة قاعدة البيانات
+    init_db()
+
+    # إنشاء تطبيق البوت
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    # تسجيل زمن استدعاءات Bot API في المقاييس (256 اتصالاً كما في الإعداد الافتراضي للتطبيق)
+    builder = builder.request(MetricsRequest(connection_pool_size=256))
+    if WEBHOOK_URL:
+        # طابور محدود حتى يرد خادم webhook بـ 503 بدلاً من تراكم التحديثات في الذاكرة
+        builder = builder.update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    if BOT_API_BASE_URL:
+        # استخدام خادم Bot API محلي بدلاً من الخادم الرسمي
+        builder = builder.base_url(BOT_API_BASE_URL).local_mode(BOT_API_LOCAL_MODE)
+        if BOT_API_BASE_FILE_URL:
+            builder = builder.base_file_url(BOT_API_BASE_FILE_URL)
+    application = builder.build()
+
+    # إضافة معالجات الأوامر والرسائل
+    register_handlers(application)
 
     # بدء تشغيل البوت
-    logger.info("البوت قيد التشغيل...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("البوت قيد التشغيل...")
+        application.run_polling()
 
 if __name__ == "__main__":
     # --- إعداد ملف الكوكيز ---
-    main()
+    if sys.argv[1:2] == ['worker']:
+        worker_main()
+    else:
+        main()
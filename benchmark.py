@@ -0,0 +1,642 @@
+"""
+أداة قياس أداء البوت بدون تليجرام أو مواقع حقيقية.
+
+تمرر تحديثات Update مصطنعة عبر update_queue الخاص بالتطبيق، فتمر بنفس معالجات البوت وتوجيهها
+(register_handlers) كما في التشغيل الفعلي: روابط وضغطات أزرار تحميل، قوائم تشغيل كاملة، وإذاعة عبر لوحة الأدمن.
+يعمل ذلك مع خادم Bot API وهمي يسجل الاستدعاءات بزمن استجابة قابل للضبط، ومستخرج yt-dlp وهمي
+يقدم ملفات وسائط محلية من خادم HTTP محلي، ثم تطبع زمن الاستجابة (p50/p99) وعدد التحديثات في الثانية
+والتحديثات التي لم يستلمها أي معالج وأقصى استهلاك للذاكرة والقرص لمقارنة التغييرات بين تشغيل وآخر.
+
+مثال:
+    python benchmark.py --users 50 --concurrency 10 --playlists 3 --api-latency 50 --output bench_output.txt
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+# معرفات ثابتة للمستخدمين المصطنعين
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+BENCH_TOKEN = "123456:bench"
+
+# ==============================================================================
+# خادم Bot API وهمي
+# ==============================================================================
+
+class FakeBotAPI:
+    """
+    خادم Bot API وهمي يرد على الدوال التي يستخدمها البوت ويسجل عدد استدعاءات كل دالة.
+    كل رد يتأخر بمقدار latency ثانية لمحاكاة زمن الوصول إلى تليجرام.
+    """
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/bot"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                params = api._parse_params(self.headers, self._read_body())
+                method = self.path.rsplit('/', 1)[-1]
+                with api._lock:
+                    api.calls[method] += 1
+                time.sleep(api.latency)
+                body = json.dumps({'ok': True, 'result': api._result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                # العميل قد يغلق الاتصال عند إلغاء الطلب أو إيقاف البوت
+                with contextlib.suppress(ConnectionError):
+                    self.wfile.write(body)
+
+            def _read_body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    chunks = []
+                    while size := int(self.rfile.readline().split(b';', 1)[0], 16):
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @staticmethod
+    def _parse_params(headers, body: bytes) -> dict:
+        content_type = headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl(body.decode()))
+        # multipart (رفع الملفات): لا نحتاج سوى حجم الطلب
+        return {}
+
+    def _result(self, method: str, params: dict):
+        chat_id = int(params.get('chat_id') or 1)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method in ('answerCallbackQuery', 'deleteMessage', 'setWebhook', 'deleteWebhook'):
+            return True
+        if method == 'copyMessage':
+            return {'message_id': next(self._message_ids)}
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if method == 'sendVideo':
+            message['video'] = {'file_id': f"video-{message['message_id']}", 'file_unique_id': 'v', 'width': 640, 'height': 360, 'duration': 1}
+        elif method == 'sendAudio':
+            message['audio'] = {'file_id': f"audio-{message['message_id']}", 'file_unique_id': 'a', 'duration': 1}
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f"document-{message['message_id']}", 'file_unique_id': 'd'}
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+# ==============================================================================
+# مستخرج yt-dlp وهمي وملفات الوسائط المحلية
+# ==============================================================================
+
+def generate_media(directory: str, duration: int):
+    """ينشئ ملف فيديو mp4 (360p) وملف صوت m4a بطول duration ثانية باستخدام ffmpeg."""
+    common = ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}"]
+    subprocess.run(
+        common + ['-f', 'lavfi', '-i', f"testsrc2=size=640x360:rate=25:duration={duration}",
+                  '-map', '1:v', '-map', '0:a', '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac',
+                  '-movflags', '+faststart', os.path.join(directory, 'clip.mp4')],
+        check=True
+    )
+    subprocess.run(common + ['-c:a', 'aac', '-b:a', '128k', os.path.join(directory, 'audio.m4a')], check=True)
+
+def start_media_server(directory: str) -> ThreadingHTTPServer:
+    """خادم HTTP محلي يقدم ملفات الوسائط للتحميل."""
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class BenchIE(InfoExtractor):
+    """مستخرج وهمي لروابط https://bench.invalid/<id> يعيد صيغاً تشير إلى خادم الوسائط المحلي."""
+    _VALID_URL = r'https?://bench\.invalid/(?P<id>[\w-]+)'
+    IE_NAME = 'bench'
+
+    # تُضبط قبل بدء القياس
+    media_url = ''
+    media_dir = ''
+    duration = 0
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        return {
+            'id': video_id,
+            'title': f"Benchmark {video_id}",
+            'duration': self.duration,
+            'formats': [{
+                'format_id': 'audio',
+                'url': f"{self.media_url}/audio.m4a",
+                'ext': 'm4a',
+                'vcodec': 'none',
+                'acodec': 'mp4a.40.2',
+                'abr': 128,
+                'filesize': os.path.getsize(os.path.join(self.media_dir, 'audio.m4a')),
+            }, {
+                'format_id': '360',
+                'url': f"{self.media_url}/clip.mp4",
+                'ext': 'mp4',
+                'vcodec': 'avc1.42c01e',
+                'acodec': 'mp4a.40.2',
+                'width': 640,
+                'height': 360,
+                'filesize': os.path.getsize(os.path.join(self.media_dir, 'clip.mp4')),
+            }],
+        }
+
+class BenchListIE(InfoExtractor):
+    """مستخرج وهمي لقوائم https://bench.invalid/list/<id>-<count> عناصرها روابط BenchIE."""
+    _VALID_URL = r'https?://bench\.invalid/list/(?P<id>\w+)-(?P<count>\d+)'
+    IE_NAME = 'benchlist'
+
+    def _real_extract(self, url):
+        playlist_id, count = self._match_valid_url(url).group('id', 'count')
+        return self.playlist_result(
+            (self.url_result(f"https://bench.invalid/{playlist_id}x{i}", BenchIE.ie_key(), f"{playlist_id}x{i}")
+             for i in range(int(count))),
+            playlist_id, f"Benchmark list {playlist_id}",
+        )
+
+def install_fake_extractor(app):
+    """يستبدل create_ydl بنسخة تجرب المستخرجات الوهمية قبل مستخرجات yt-dlp الافتراضية."""
+    def create_ydl(opts: dict, media_type: str | None = None) -> yt_dlp.YoutubeDL:
+        ydl = yt_dlp.YoutubeDL(opts, auto_init=False)
+        # روابط القوائم تطابق نمط BenchIE أيضاً، لذا يُجرب مستخرج القوائم أولاً
+        ydl.add_info_extractor(BenchListIE())
+        ydl.add_info_extractor(BenchIE())
+        ydl.add_default_info_extractors()
+        if media_type == 'video':
+            ydl.add_post_processor(app.SmartMp4PP(ydl), when='post_process')
+        return ydl
+
+    app.create_ydl = create_ydl
+
+# ==============================================================================
+# تحديثات مصطنعة والقياس
+# ==============================================================================
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+def message_update(update_id: int, user_id: int, message_id: int, text: str) -> dict:
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        # فلاتر الأوامر تعتمد على الكيان bot_command كما يرسله تليجرام
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def callback_update(update_id: int, user_id: int, message_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'},
+                'text': 'menu',
+            },
+        },
+    }
+
+def percentile(values: list[float], p: float) -> float:
+    """النسبة المئوية p بطريقة أقرب رتبة."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def latency_summary(values: list[float]) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values, default=0.0) * 1000,
+    }
+
+class DiskSampler:
+    """يقيس حجم مجلد العمل دورياً ويحتفظ بأقصى قيمة."""
+    def __init__(self, app, interval: float = 0.2):
+        self._app = app
+        self._interval = interval
+        self.peak = 0
+
+    def sample(self):
+        self.peak = max(self.peak, self._app._path_size('.'))
+
+    async def run(self):
+        while True:
+            await asyncio.get_running_loop().run_in_executor(None, self.sample)
+            await asyncio.sleep(self._interval)
+
+class UpdateTracker:
+    """
+    يضع التحديثات المصطنعة في update_queue الخاص بالتطبيق فتمر بنفس التوجيه والمعالجات الحقيقية،
+    ويقيس زمن كل تحديث من دخوله الطابور حتى انتهاء المعالج الذي استلمه (بما فيها معالجات block=False).
+    التحديث الذي لا يستلمه أي معالج خلال timeout يُحسب غير معالج، وهو غالباً خطأ في التوجيه.
+    """
+    def __init__(self, app, application, timeout: float):
+        self._app = app
+        self._application = application
+        self._timeout = timeout
+        self._pending: dict[int, asyncio.Future] = {}
+        self.ids = itertools.count(1)
+        self.timings: dict[str, list[float]] = {}
+        self.handled_by: Counter = Counter()
+        self.unhandled: Counter = Counter()
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self._wrap(handler)
+
+    def _wrap(self, handler):
+        """يلف callback المعالج (ومعالجات المحادثات المتداخلة) ليبلغ عن انتهاء التحديث."""
+        if isinstance(handler, self._app.ConversationHandler):
+            for inner in itertools.chain(handler.entry_points, handler.fallbacks, *handler.states.values()):
+                self._wrap(inner)
+            return
+        callback = handler.callback
+        name = getattr(callback, '__name__', type(handler).__name__)
+
+        @functools.wraps(callback)
+        async def tracked(update, context):
+            try:
+                return await callback(update, context)
+            finally:
+                future = self._pending.pop(update.update_id, None)
+                if future and not future.done():
+                    future.set_result(name)
+
+        handler.callback = tracked
+
+    async def send(self, kind: str, data: dict) -> str | None:
+        """يرسل التحديث وينتظر انتهاء معالجته، ويعيد اسم المعالج الذي استلمه أو None."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending[data['update_id']] = future
+        start = time.perf_counter()
+        await self._application.update_queue.put(self._app.Update.de_json(data, self._application.bot))
+        try:
+            name = await asyncio.wait_for(future, self._timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(data['update_id'], None)
+            self.unhandled[kind] += 1
+            return None
+        self.timings.setdefault(kind, []).append(time.perf_counter() - start)
+        self.handled_by[name] += 1
+        return name
+
+    def handled(self, *kinds: str) -> int:
+        return sum(len(self.timings.get(kind, [])) for kind in kinds)
+
+def job_rows(app) -> list[dict]:
+    with app.db_read() as cursor:
+        cursor.execute("SELECT user_id, status, created_at, updated_at FROM jobs WHERE playlist_id IS NULL")
+        return app._rows_to_dicts(cursor)
+
+def playlist_rows(app) -> list[dict]:
+    with app.db_read() as cursor:
+        cursor.execute("SELECT status, total, created_at, updated_at FROM playlists")
+        return app._rows_to_dicts(cursor)
+
+def bench_media_type(args) -> tuple[str, str]:
+    """نوع التحميل ومفتاح الصيغة في أزرار القائمة لقيمة --media."""
+    return {
+        'video': ('video', 'auto'), 'audio_m4a': ('audio_m4a', 'audio'), 'audio_mp3': ('audio_mp3', 'audio'),
+    }[args.media]
+
+async def wait_finished(rows, done_statuses: tuple[str, ...], timeout: float):
+    """ينتظر حتى تنتهي كل الصفوف الموجودة (لا شيء ينتظر إذا لم تصل أي ضغطة إلى معالجها)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(row['status'] in done_statuses for row in rows()):
+            return
+        await asyncio.sleep(0.2)
+
+async def bench_downloads(app, tracker: UpdateTracker, args) -> dict:
+    """كل مستخدم يرسل رابطاً ثم يضغط زر التحميل؛ العامل يعمل في نفس العملية."""
+    gate = asyncio.Semaphore(args.concurrency)
+    media_type, format_key = bench_media_type(args)
+
+    async def simulate_user(index: int):
+        user_id = FIRST_USER_ID + index
+        # عدة مستخدمين قد يطلبون نفس الفيديو لقياس أثر الذاكرات وربط التحميلات المتطابقة
+        url = f"https://bench.invalid/v{index % args.distinct}"
+        async with gate:
+            await tracker.send('handle_message', message_update(next(tracker.ids), user_id, 1, url))
+            await tracker.send('button_callback', callback_update(
+                next(tracker.ids), user_id, 2, f"download:{media_type}:{format_key}:1"
+            ))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(simulate_user(i) for i in range(args.users)))
+    handlers_time = time.perf_counter() - start
+
+    await wait_finished(lambda: job_rows(app), ('done', 'failed'), args.timeout)
+    total_time = time.perf_counter() - start
+
+    rows = job_rows(app)
+    finished = [row for row in rows if row['status'] in ('done', 'failed')]
+    return {
+        'handle_message': latency_summary(tracker.timings.get('handle_message', [])),
+        'button_callback': latency_summary(tracker.timings.get('button_callback', [])),
+        'updates_per_second': tracker.handled('handle_message', 'button_callback') / handlers_time,
+        'jobs': {
+            **latency_summary([row['updated_at'] - row['created_at'] for row in finished]),
+            'done': sum(row['status'] == 'done' for row in rows),
+            'failed': sum(row['status'] == 'failed' for row in rows),
+            'unfinished': len(rows) - len(finished),
+            'per_second': len(finished) / total_time,
+        },
+        'stages': {
+            stage: {'count': count, 'avg_s': avg, 'p95_le_s': p95}
+            for stage, (count, avg, p95) in app.Metrics.summarize(
+                app.metrics.snapshot(), 'bot_stage_duration_seconds', 'stage'
+            ).items()
+        },
+    }
+
+async def bench_playlists(app, tracker: UpdateTracker, args) -> dict:
+    """كل مستخدم يرسل رابط قائمة تشغيل ثم يضغط زر تحميلها كاملة، حتى تنتهي كل القوائم."""
+    media_type, _ = bench_media_type(args)
+
+    async def simulate_user(index: int):
+        # مستخدمون غير مستخدمي التحميل حتى لا يتأثروا بحد القوائم الجارية لكل مستخدم
+        user_id = FIRST_USER_ID + args.users + index
+        url = f"https://bench.invalid/list/l{index}-{args.playlist_size}"
+        await tracker.send('playlist_message', message_update(next(tracker.ids), user_id, 1, url))
+        await tracker.send('playlist_callback', callback_update(next(tracker.ids), user_id, 2, f"playlist:{media_type}:1"))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(simulate_user(i) for i in range(args.playlists)))
+    await wait_finished(lambda: playlist_rows(app), ('done', 'cancelled'), args.timeout)
+    total_time = time.perf_counter() - start
+
+    rows = playlist_rows(app)
+    finished = [row for row in rows if row['status'] != 'running']
+    with app.db_read() as cursor:
+        cursor.execute("SELECT status, COUNT(*) FROM jobs WHERE playlist_id IS NOT NULL GROUP BY status")
+        entries = dict(cursor.fetchall())
+    entries_finished = entries.get('done', 0) + entries.get('failed', 0)
+    return {
+        'playlist_message': latency_summary(tracker.timings.get('playlist_message', [])),
+        'playlist_callback': latency_summary(tracker.timings.get('playlist_callback', [])),
+        'playlists': {
+            **latency_summary([row['updated_at'] - row['created_at'] for row in finished]),
+            'started': len(rows),
+            'unfinished': len(rows) - len(finished),
+        },
+        'entries': {
+            'done': entries.get('done', 0),
+            'failed': entries.get('failed', 0),
+            'unfinished': sum(entries.values()) - entries_finished,
+            'per_second': entries_finished / total_time,
+        },
+    }
+
+async def bench_broadcast(app, tracker: UpdateTracker, args) -> dict:
+    """إذاعة إلى broadcast_users مستخدماً مصطنعاً عبر لوحة الأدمن (/admin ثم زر الإذاعة ثم الرسالة) حتى انتهائها."""
+    for user_id in range(FIRST_USER_ID, FIRST_USER_ID + args.broadcast_users):
+        app.add_user(user_id)
+    app.flush_pending_writes()
+
+    await tracker.send('admin', message_update(next(tracker.ids), ADMIN_ID, 10 ** 6, "/admin"))
+    await tracker.send('admin', callback_update(next(tracker.ids), ADMIN_ID, 10 ** 6 + 1, "admin_broadcast"))
+    start = time.perf_counter()
+    await tracker.send('handle_broadcast', message_update(next(tracker.ids), ADMIN_ID, 10 ** 6 + 2, "broadcast"))
+    # ننتظر ظهور الإذاعة في القائمة ثم انتهاءها
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+        if not app.active_broadcasts:
+            break
+    duration = time.perf_counter() - start
+    job_users = app.get_user_count()
+    return {
+        'handle_broadcast': latency_summary(tracker.timings.get('handle_broadcast', [])),
+        'recipients': job_users,
+        'duration_s': duration,
+        'messages_per_second': job_users / duration,
+    }
+
+async def run_benchmark(app, api: FakeBotAPI, args) -> dict:
+    application = (
+        app.Application.builder().token(BENCH_TOKEN).base_url(api.base_url)
+        .request(app.MetricsRequest(connection_pool_size=256)).updater(None).build()
+    )
+    # نفس معالجات البوت وتوجيهها، والتحديثات تدخل من update_queue كما في polling أو webhook
+    app.register_handlers(application)
+    tracker = UpdateTracker(app, application, args.update_timeout)
+    sampler = DiskSampler(app)
+    sampler_task = asyncio.create_task(sampler.run())
+    await application.initialize()
+    await application.start()
+    worker = asyncio.create_task(app.run_worker())
+    try:
+        results = {'downloads': await bench_downloads(app, tracker, args)}
+        if args.playlists:
+            results['playlists'] = await bench_playlists(app, tracker, args)
+        if args.broadcast_users:
+            results['broadcast'] = await bench_broadcast(app, tracker, args)
+    finally:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await application.stop()
+        await application.shutdown()
+        sampler_task.cancel()
+        sampler.sample()
+    results['peak_disk_bytes'] = sampler.peak
+    results['handled_by'] = dict(tracker.handled_by)
+    results['unhandled'] = dict(tracker.unhandled)
+    return results
+
+def print_report(report: dict):
+    downloads = report['downloads']
+    print(f"\n=== {report['started_at']} | users={report['config']['users']} "
+          f"concurrency={report['config']['concurrency']} api_latency={report['config']['api_latency']}ms ===")
+    for name in ('handle_message', 'button_callback'):
+        stats = downloads[name]
+        print(f"{name:<18} n={stats['count']:<5} p50={stats['p50_ms']:8.1f} ms  p99={stats['p99_ms']:8.1f} ms")
+    print(f"{'updates/s':<18} {downloads['updates_per_second']:.1f}")
+    jobs = downloads['jobs']
+    print(f"{'jobs':<18} n={jobs['count']:<5} p50={jobs['p50_ms']:8.1f} ms  p99={jobs['p99_ms']:8.1f} ms  "
+          f"done={jobs['done']} failed={jobs['failed']} unfinished={jobs['unfinished']} ({jobs['per_second']:.2f}/s)")
+    for stage, stats in downloads['stages'].items():
+        print(f"  {stage:<16} n={stats['count']:<5} avg={stats['avg_s'] * 1000:8.1f} ms  p95<={stats['p95_le_s']} s")
+    if 'playlists' in report:
+        playlists = report['playlists']
+        for name in ('playlist_message', 'playlist_callback'):
+            stats = playlists[name]
+            print(f"{name:<18} n={stats['count']:<5} p50={stats['p50_ms']:8.1f} ms  p99={stats['p99_ms']:8.1f} ms")
+        lists, entries = playlists['playlists'], playlists['entries']
+        print(f"{'playlists':<18} n={lists['started']:<5} p50={lists['p50_ms']:8.1f} ms  p99={lists['p99_ms']:8.1f} ms  "
+              f"unfinished={lists['unfinished']}  entries done={entries['done']} failed={entries['failed']} "
+              f"unfinished={entries['unfinished']} ({entries['per_second']:.2f}/s)")
+    if 'broadcast' in report:
+        broadcast = report['broadcast']
+        print(f"{'handle_broadcast':<18} p50={broadcast['handle_broadcast']['p50_ms']:8.1f} ms  "
+              f"{broadcast['recipients']} recipients in {broadcast['duration_s']:.1f} s "
+              f"({broadcast['messages_per_second']:.1f} msg/s)")
+    print(f"{'peak RSS':<18} {report['peak_rss_bytes'] / 2 ** 20:.1f} MB (children {report['peak_child_rss_bytes'] / 2 ** 20:.1f} MB)")
+    print(f"{'peak disk':<18} {report['peak_disk_bytes'] / 2 ** 20:.1f} MB")
+    print(f"{'handled by':<18} {dict(sorted(report['handled_by'].items()))}")
+    if report['unhandled']:
+        print(f"{'UNHANDLED':<18} {report['unhandled']} (لم يستلمها أي معالج خلال {report['config']['update_timeout']} ث)")
+    print(f"{'Bot API calls':<18} {dict(sorted(report['api_calls'].items()))}")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="قياس أداء البوت بتحديثات مصطنعة وخوادم محلية")
+    parser.add_argument('--users', type=int, default=20, help="عدد المستخدمين المصطنعين (رابط + ضغطة زر لكل منهم)")
+    parser.add_argument('--concurrency', type=int, default=10, help="عدد المستخدمين النشطين في نفس الوقت")
+    parser.add_argument('--distinct', type=int, default=0, help="عدد الفيديوهات المختلفة (الافتراضي: فيديو لكل مستخدم)")
+    parser.add_argument('--media', choices=('video', 'audio_m4a', 'audio_mp3'), default='video')
+    parser.add_argument('--playlists', type=int, default=2, help="عدد قوائم التشغيل المحملة كاملة (0 = تخطي)")
+    parser.add_argument('--playlist-size', type=int, default=5, help="عدد عناصر كل قائمة تشغيل")
+    parser.add_argument('--duration', type=int, default=5, help="مدة ملف الوسائط المصطنع بالثواني")
+    parser.add_argument('--api-latency', type=float, default=50, help="زمن استجابة Bot API الوهمي بالمللي ثانية")
+    parser.add_argument('--download-slots', type=int, default=3, help="قيمة DOWNLOAD_SLOTS للعامل")
+    parser.add_argument('--broadcast-users', type=int, default=200, help="عدد مستلمي الإذاعة (0 = تخطي)")
+    parser.add_argument('--timeout', type=float, default=600, help="أقصى انتظار لانتهاء المهام أو الإذاعة بالثواني")
+    parser.add_argument('--update-timeout', type=float, default=60,
+                        help="أقصى انتظار لمعالجة تحديث واحد قبل اعتباره غير معالج بالثواني")
+    parser.add_argument('--output', help="إلحاق النتيجة بصيغة JSON (سطر لكل تشغيل) بهذا الملف")
+    parser.add_argument('--keep', action='store_true', help="عدم حذف مجلد العمل المؤقت")
+    parser.add_argument('--verbose', action='store_true', help="إظهار سجلات البوت")
+    args = parser.parse_args()
+    args.distinct = args.distinct or args.users
+    return args
+
+def main():
+    args = parse_args()
+    if not shutil.which('ffmpeg'):
+        sys.exit("ffmpeg مطلوب لإنشاء ملفات الوسائط المصطنعة")
+    output = os.path.abspath(args.output) if args.output else None
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='bot-bench-')
+    media_dir = os.path.join(work_dir, 'media')
+    state_dir = os.path.join(work_dir, 'state')
+    os.makedirs(media_dir)
+    os.makedirs(state_dir)
+    generate_media(media_dir, args.duration)
+
+    api = FakeBotAPI(args.api_latency / 1000)
+    api.start()
+    media_server = start_media_server(media_dir)
+    BenchIE.media_url = f"http://127.0.0.1:{media_server.server_port}"
+    BenchIE.media_dir = media_dir
+    BenchIE.duration = args.duration
+
+    # الإعدادات تُقرأ عند استيراد app، لذا تُضبط قبله. قاعدة البيانات والتنزيلات داخل مجلد العمل
+    os.environ.update({
+        'BOT_TOKEN': BENCH_TOKEN,
+        'ADMIN_IDS': str(ADMIN_ID),
+        'BOT_API_BASE_URL': api.base_url,
+        'JOB_WORKERS': '0',
+        'METRICS_PORT': '0',
+        'EXTRACT_EXECUTOR': 'thread',
+        'DOWNLOAD_SLOTS': str(args.download_slots),
+        'DOWNLOAD_SLOTS_PER_USER': '1',
+    })
+    os.environ.pop('RAILWAY_VOLUME_MOUNT_PATH', None)
+    os.environ.pop('WEBHOOK_URL', None)
+    os.chdir(state_dir)
+    sys.path.insert(0, app_dir)
+    import app
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+    install_fake_extractor(app)
+    app.init_db()
+
+    started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    try:
+        results = asyncio.run(run_benchmark(app, api, args))
+    finally:
+        app.extraction_pool.shutdown()
+        app.compression_pool.shutdown()
+        app.close_db()
+        api.stop()
+        media_server.shutdown()
+        os.chdir(app_dir)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'started_at': started_at,
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'keep', 'verbose')},
+        **results,
+        # ru_maxrss بالكيلوبايت على لينكس
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'peak_child_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        'api_calls': dict(api.calls),
+    }
+    print_report(report)
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + "\n")
+    if args.keep:
+        print(f"مجلد العمل: {work_dir}")
+
+if __name__ == "__main__":
+    main()
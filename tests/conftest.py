@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# app يقرأ إعداداته من البيئة عند الاستيراد
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("JOB_WORKERS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """قاعدة بيانات جديدة في مجلد مؤقت لكل اختبار."""
+    app.close_db()
+    monkeypatch.setattr(app, "DATABASE_NAME", str(tmp_path / "bot_data.db"))
+    app.init_db()
+    yield
+    app.close_db()
@@ -0,0 +1,101 @@
+import app
+
+
+def enqueue(user_id: int, video_id: str) -> int:
+    job_id, _ = app.enqueue_job({
+        'user_id': user_id, 'chat_id': user_id, 'status_message_id': 1,
+        'url': f"https://example.com/{video_id}", 'extractor': 'example', 'video_id': video_id,
+        'media_type': 'video', 'format_id': '18', 'size': 0, 'duration': None,
+    })
+    return job_id
+
+
+def enqueue_playlist(user_id: int, count: int) -> int:
+    return app.enqueue_playlist(
+        {'user_id': user_id, 'chat_id': user_id, 'status_message_id': 1, 'title': 'list'},
+        [{'url': f"https://example.com/p{user_id}/{i}"} for i in range(count)],
+        'video', 'best',
+    )
+
+
+def test_claim_job_round_robin_across_users(db, monkeypatch):
+    monkeypatch.setattr(app, 'DOWNLOAD_SLOTS_PER_USER', 10)
+    burst = [enqueue(1, f"a{i}") for i in range(3)]
+    later = enqueue(2, "b0")
+
+    claimed = [app.claim_job('w1')['id'] for _ in range(4)]
+
+    assert claimed == [burst[0], later, burst[1], burst[2]]
+    assert app.claim_job('w1') is None
+
+
+def test_queue_positions_follow_claim_order(db, monkeypatch):
+    monkeypatch.setattr(app, 'DOWNLOAD_SLOTS_PER_USER', 10)
+    burst = [enqueue(1, f"a{i}") for i in range(2)]
+    later = enqueue(2, "b0")
+
+    assert [job['id'] for job in app.get_queued_jobs()] == [burst[0], later, burst[1]]
+    assert app.get_job_position(later) == 2
+
+
+def test_claim_job_respects_per_user_cap(db, monkeypatch):
+    monkeypatch.setattr(app, 'DOWNLOAD_SLOTS_PER_USER', 1)
+    first = enqueue(1, "a0")
+    second = enqueue(1, "a1")
+    other = enqueue(2, "b0")
+
+    assert app.claim_job('w1')['id'] == first
+    assert app.claim_job('w1')['id'] == other
+    assert app.claim_job('w1') is None
+
+    app.complete_job(first, 'w1', 'file-id', 'video', None)
+    assert app.claim_job('w1')['id'] == second
+
+
+def test_playlist_entries_use_playlist_cap_instead_of_user_cap(db, monkeypatch):
+    monkeypatch.setattr(app, 'DOWNLOAD_SLOTS_PER_USER', 1)
+    monkeypatch.setattr(app, 'PLAYLIST_CONCURRENCY', 2)
+    enqueue_playlist(1, 3)
+
+    claimed = [app.claim_job('w1') for _ in range(3)]
+
+    assert [job['position'] for job in claimed[:2]] == [1, 2]
+    assert claimed[2] is None
+
+
+def test_expired_lease_is_claimed_by_another_worker(db, monkeypatch):
+    job_id = enqueue(1, "a0")
+    monkeypatch.setattr(app, 'JOB_LEASE_SECONDS', -1)
+    assert app.claim_job('w1')['id'] == job_id
+
+    reclaimed = app.claim_job('w2')
+
+    assert reclaimed['id'] == job_id
+    assert reclaimed['lease_owner'] == 'w2'
+    assert reclaimed['attempts'] == 2
+    # العامل الأول فقد العقد ولا يستطيع تجديده
+    monkeypatch.setattr(app, 'JOB_LEASE_SECONDS', 60)
+    assert not app.renew_job_lease(job_id, 'w1')
+    assert app.renew_job_lease(job_id, 'w2')
+
+
+def test_job_fails_after_max_attempts(db, monkeypatch):
+    monkeypatch.setattr(app, 'JOB_LEASE_SECONDS', -1)
+    monkeypatch.setattr(app, 'JOB_MAX_ATTEMPTS', 2)
+    job_id = enqueue(1, "a0")
+    assert app.claim_job('w1')['id'] == job_id
+    assert app.claim_job('w2')['id'] == job_id
+
+    assert app.claim_job('w3') is None
+    assert [job['id'] for job in app.expire_exhausted_jobs()] == [job_id]
+    assert app.get_job_counts() == {'failed': 1}
+
+
+def test_requeue_job_returns_job_without_counting_attempt(db):
+    job_id = enqueue(1, "a0")
+    app.claim_job('w1')
+
+    app.requeue_job(job_id, 'w1')
+
+    assert app.is_job_queued(job_id)
+    assert app.claim_job('w2')['attempts'] == 1
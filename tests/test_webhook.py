@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from telegram.ext import ApplicationBuilder
+
+import app
+
+SECRET = "s3cret"
+
+
+async def post(server: app.WebhookServer, body: bytes, headers: dict | None = None, path: str = "/webhook") -> int:
+    port = server._server.sockets[0].getsockname()[1]
+    async with httpx.AsyncClient() as client:
+        response = await client.post(f"http://127.0.0.1:{port}{path}", content=body, headers=headers or {})
+    return response.status_code
+
+
+def run_with_server(scenario, queue_size: int = 10):
+    """يشغّل السيناريو مع خادم webhook على منفذ عشوائي ويعيد التطبيق والخادم ونتيجة السيناريو."""
+    async def main():
+        application = ApplicationBuilder().token(app.BOT_TOKEN).update_queue(asyncio.Queue(maxsize=queue_size)).build()
+        server = app.WebhookServer(application, "/webhook", SECRET)
+        await server.start("127.0.0.1", 0)
+        try:
+            return application, server, await scenario(server)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+def update_body(update_id: int = 1) -> bytes:
+    return json.dumps({'update_id': update_id}).encode()
+
+
+AUTH = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+
+
+def test_accepts_update_with_secret():
+    application, server, status = run_with_server(lambda server: post(server, update_body(), AUTH))
+
+    assert status == 200
+    assert server.accepted == 1
+    assert application.update_queue.get_nowait().update_id == 1
+
+
+@pytest.mark.parametrize("headers", [{}, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'}])
+def test_rejects_missing_or_wrong_secret(headers):
+    application, server, status = run_with_server(lambda server: post(server, update_body(), headers))
+
+    assert status == 403
+    assert application.update_queue.empty()
+
+
+def test_rejects_unknown_path():
+    _, _, status = run_with_server(lambda server: post(server, update_body(), AUTH, path="/other"))
+
+    assert status == 404
+
+
+def test_rejects_oversized_body():
+    body = b" " * (app.WebhookServer._MAX_BODY_SIZE + 1)
+
+    application, _, status = run_with_server(lambda server: post(server, body, AUTH))
+
+    assert status == 413
+    assert application.update_queue.empty()
+
+
+def test_rejects_invalid_json():
+    _, _, status = run_with_server(lambda server: post(server, b"not json", AUTH))
+
+    assert status == 400
+
+
+def test_returns_503_when_update_queue_is_full():
+    async def scenario(server):
+        return [await post(server, update_body(i), AUTH) for i in range(3)]
+
+    application, server, statuses = run_with_server(scenario, queue_size=2)
+
+    assert statuses == [200, 200, 503]
+    assert server.rejected == 1
+    assert application.update_queue.qsize() == 2
+
+
+def test_returns_503_when_too_many_handlers_in_flight(monkeypatch):
+    monkeypatch.setattr(app.in_flight_updates, 'count', app.MAX_IN_FLIGHT_UPDATES)
+
+    application, server, status = run_with_server(lambda server: post(server, update_body(), AUTH))
+
+    assert status == 503
+    assert application.update_queue.empty()
+
+
+def test_returns_503_when_extraction_queue_is_long(monkeypatch):
+    monkeypatch.setattr(app.extraction_pool, 'queued', app.MAX_EXTRACT_QUEUE)
+
+    _, _, status = run_with_server(lambda server: post(server, update_body(), AUTH))
+
+    assert status == 503
+
+
+def test_in_flight_updates_counts_running_handlers():
+    tracker = app.InFlightUpdates()
+    seen = []
+
+    async def handler(update, context):
+        seen.append(tracker.count)
+
+    asyncio.run(tracker.track(handler)(None, None))
+
+    assert seen == [1]
+    assert tracker.count == 0
+    assert tracker.peak == 1